@@ -0,0 +1,199 @@
+import os
+import json
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from rate_limits import TokenBucket
+
+# Управление допуском запросов к апстриму: адаптивный лимит одновременных запросов и очередь, выключено по умолчанию
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', '0').lower() in ('1', 'true', 'yes')
+ADMISSION_INITIAL_LIMIT = int(os.environ.get('ADMISSION_INITIAL_LIMIT', '50'))
+ADMISSION_MIN_LIMIT = int(os.environ.get('ADMISSION_MIN_LIMIT', '4'))
+ADMISSION_MAX_LIMIT = int(os.environ.get('ADMISSION_MAX_LIMIT', '1000'))
+# Ответ медленнее обычного для метода API во столько раз считается признаком перегрузки
+ADMISSION_LATENCY_TOLERANCE = float(os.environ.get('ADMISSION_LATENCY_TOLERANCE', '3'))
+# Во сколько раз уменьшается лимит при перегрузке
+ADMISSION_BACKOFF = float(os.environ.get('ADMISSION_BACKOFF', '0.9'))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', '1000'))
+# Сколько секунд запрос может ждать в очереди
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '30'))
+# Веса пользователей при разделении пропускной способности: {"<ключ пользователя>": 2}, по умолчанию 1
+USER_WEIGHTS = json.loads(os.environ.get('USER_WEIGHTS', '{}') or '{}')
+# Лимиты запросов в минуту по пользователям: {"<ключ пользователя или *>": 600}
+USER_RPM_LIMITS = json.loads(os.environ.get('USER_RPM_LIMITS', '{}') or '{}')
+
+# Лимит уменьшается не чаще, чем раз в столько секунд: одна перегрузка дает много медленных ответов сразу
+DECREASE_INTERVAL = 1.0
+MAX_RETRY_AFTER = 60
+
+admission_stats = {'admitted': 0, 'queued': 0, 'rejected_queue_full': 0, 'rejected_queue_timeout': 0, 'rejected_user_quota': 0}
+
+
+class AdmissionRejected(Exception):
+    """The request was not admitted; answer with `status` and `Retry-After: retry_after`."""
+
+    def __init__(self, status, retry_after, message):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdaptiveLimit:
+    """AIMD concurrency limit driven by 429 responses and latency compared to a per-route baseline.
+
+    The limit grows by about one per `limit` successful requests while it is in use, and
+    shrinks by ADMISSION_BACKOFF at most once per DECREASE_INTERVAL on overload.
+    """
+
+    def __init__(self, initial=ADMISSION_INITIAL_LIMIT, min_limit=ADMISSION_MIN_LIMIT, max_limit=ADMISSION_MAX_LIMIT):
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._baselines = {}
+        self._last_decrease = 0.0
+
+    def on_sample(self, route, seconds, status, in_flight):
+        baseline = self._baselines.get(route, seconds)
+        # Базовая задержка быстро следует за быстрыми ответами и медленно - за медленными
+        baseline += (seconds - baseline) * (0.5 if seconds < baseline else 0.01)
+        self._baselines[route] = baseline
+        overloaded = status in (429, 503) or seconds > baseline * ADMISSION_LATENCY_TOLERANCE
+        if overloaded:
+            now = time.monotonic()
+            if now - self._last_decrease >= DECREASE_INTERVAL:
+                self._last_decrease = now
+                self.limit = max(self.min_limit, self.limit * ADMISSION_BACKOFF)
+                logging.info("Admission limit lowered to %.0f (route %s, status %s, %.2fs)", self.limit, route, status, seconds)
+        elif in_flight >= self.limit / 2:
+            # Растем, только если лимит действительно используется
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+class AdmissionTicket:
+    """A granted slot; call answered() with the response status once the response headers are known.
+
+    The latency fed to the adaptive limit is the time to response headers, while the slot
+    itself is held until release(), which for a stream is when the stream ends.
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self.status = 500
+        self.started_at = time.monotonic()
+        self.latency = None
+
+    def answered(self, status):
+        self.status = status
+        self.latency = time.monotonic() - self.started_at
+
+
+class AdmissionController:
+    """Admits requests up to the adaptive limit; the rest wait in per-user queues served by weight.
+
+    Users are scheduled with stride scheduling: each admission advances the user's pass
+    by 1/weight and the waiting user with the smallest pass goes next. A user that
+    starts waiting again begins at the current pass, so idle time is not saved up.
+    """
+
+    def __init__(self):
+        self.limit = AdaptiveLimit()
+        self.in_flight = 0
+        self.queued = 0
+        self._queues = {}
+        self._passes = {}
+        self._virtual_time = 0.0
+        self._latency = None
+        self._user_buckets = {}
+
+    def _check_user_quota(self, user):
+        rpm = USER_RPM_LIMITS.get(user, USER_RPM_LIMITS.get('*'))
+        if not rpm:
+            return
+        bucket = self._user_buckets.get(user)
+        if bucket is None:
+            bucket = self._user_buckets[user] = TokenBucket(rpm, 60.0)
+        now = time.monotonic()
+        wait = bucket.seconds_until_available(now)
+        if wait > 0:
+            admission_stats['rejected_user_quota'] += 1
+            raise AdmissionRejected(429, math.ceil(wait), "User request quota exceeded")
+        bucket.consume(1, now)
+
+    def _retry_after(self):
+        """Rough time to drain the queue at the current limit and latency."""
+        latency = self._latency or 1.0
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(self.queued * latency / self.limit.limit)))
+
+    async def acquire(self, user, route):
+        """Waits for a slot and returns an AdmissionTicket, or raises AdmissionRejected."""
+        self._check_user_quota(user)
+        if self.in_flight < self.limit.limit and not self.queued:
+            self.in_flight += 1
+            admission_stats['admitted'] += 1
+            return AdmissionTicket(route)
+        if self.queued >= ADMISSION_QUEUE_SIZE:
+            admission_stats['rejected_queue_full'] += 1
+            raise AdmissionRejected(503, self._retry_after(), "Proxy is overloaded, try again later")
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(user)
+        if queue is None:
+            queue = self._queues[user] = deque()
+            self._passes[user] = max(self._passes.get(user, 0.0), self._virtual_time)
+        queue.append(future)
+        self.queued += 1
+        admission_stats['queued'] += 1
+        try:
+            await asyncio.wait_for(future, ADMISSION_QUEUE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Слот выдан одновременно с отменой ожидания - возвращаем его
+                self._release_slot()
+            else:
+                self._remove_waiter(user, future)
+            if isinstance(e, asyncio.TimeoutError):
+                admission_stats['rejected_queue_timeout'] += 1
+                raise AdmissionRejected(503, self._retry_after(), "Proxy is overloaded, try again later")
+            raise
+        admission_stats['admitted'] += 1
+        return AdmissionTicket(route)
+
+    def release(self, ticket):
+        """Returns the slot and feeds the outcome of the request to the adaptive limit."""
+        seconds = ticket.latency if ticket.latency is not None else time.monotonic() - ticket.started_at
+        self._latency = seconds if self._latency is None else self._latency + (seconds - self._latency) * 0.1
+        self.limit.on_sample(ticket.route, seconds, ticket.status, self.in_flight)
+        self._release_slot()
+
+    def _remove_waiter(self, user, future):
+        queue = self._queues.get(user)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self.queued -= 1
+            if not queue:
+                del self._queues[user]
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        while self.queued and self.in_flight < self.limit.limit:
+            user = min(self._queues, key=self._passes.__getitem__)
+            queue = self._queues[user]
+            future = queue.popleft()
+            self.queued -= 1
+            if not queue:
+                del self._queues[user]
+            if future.done():
+                # Ожидание уже отменено (таймаут или отключение клиента), но запрос еще не убрал себя из очереди
+                continue
+            self._virtual_time = self._passes[user]
+            self._passes[user] += 1 / float(USER_WEIGHTS.get(user, 1))
+            self.in_flight += 1
+            future.set_result(None)
+
+    def get_state(self):
+        return {'limit': self.limit.limit, 'in_flight': self.in_flight, 'queued': self.queued}
+
+
+admission = AdmissionController()
@@ -0,0 +1,182 @@
+"""Local fake of generativelanguage.googleapis.com for load testing the proxy.
+
+Run with: hypercorn -b 127.0.0.1:8990 benchmark.fake_gemini:app
+
+Behaviour is configured with environment variables:
+    FAKE_LATENCY_MS        delay before the response headers (default 50)
+    FAKE_JITTER_MS         random extra delay up to this value (default 0)
+    FAKE_429_RATE          share of requests answered with 429 RESOURCE_EXHAUSTED (default 0)
+    FAKE_500_RATE          share of requests answered with 500 INTERNAL (default 0)
+    FAKE_STREAM_CHUNKS     number of SSE events in streamGenerateContent (default 20)
+    FAKE_TOKEN_INTERVAL_MS delay between SSE events (default 20)
+    FAKE_SLOW_FACTOR       latency multiplier for keys starting with "slow" (default 10)
+    FAKE_GZIP              gzip responses for clients accepting it, like Google does (default 1)
+Keys starting with "bad" always get 403 PERMISSION_DENIED, for failover scenarios.
+embedContent and batchEmbedContents answer 400 INVALID_ARGUMENT for content without parts.
+Resumable uploads under /upload/v1beta check that every request of a session uses the key it was started with.
+cachedContents can be created, extended and deleted; a request using one must be sent with the key that created it.
+"""
+import os
+import json
+import zlib
+import uuid
+import random
+import asyncio
+from quart import Quart, request, Response
+
+LATENCY = float(os.environ.get('FAKE_LATENCY_MS', '50')) / 1000
+JITTER = float(os.environ.get('FAKE_JITTER_MS', '0')) / 1000
+RATE_429 = float(os.environ.get('FAKE_429_RATE', '0'))
+RATE_500 = float(os.environ.get('FAKE_500_RATE', '0'))
+STREAM_CHUNKS = int(os.environ.get('FAKE_STREAM_CHUNKS', '20'))
+TOKEN_INTERVAL = float(os.environ.get('FAKE_TOKEN_INTERVAL_MS', '20')) / 1000
+SLOW_FACTOR = float(os.environ.get('FAKE_SLOW_FACTOR', '10'))
+GZIP = os.environ.get('FAKE_GZIP', '1').lower() not in ('0', 'false', 'no')
+
+app = Quart(__name__)
+app.config['MAX_CONTENT_LENGTH'] = None
+
+# upload_id -> ключ, которым начата загрузка
+upload_sessions = {}
+# имя cachedContents -> ключ, которым создан кэш
+cached_contents = {}
+
+
+def error_response(code, status, message, details=None):
+    body = {'error': {'code': code, 'message': message, 'status': status}}
+    if details:
+        body['error']['details'] = details
+    return Response(json.dumps(body), status=code, content_type='application/json')
+
+
+def candidate_chunk(text, final=False):
+    chunk = {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'index': 0}]}
+    if final:
+        chunk['candidates'][0]['finishReason'] = 'STOP'
+        chunk['usageMetadata'] = {'promptTokenCount': 8, 'candidatesTokenCount': STREAM_CHUNKS, 'totalTokenCount': 8 + STREAM_CHUNKS}
+    return chunk
+
+
+def has_parts(embed_request):
+    return bool((embed_request.get('content') or {}).get('parts'))
+
+
+def accepts_gzip():
+    return GZIP and 'gzip' in request.headers.get('Accept-Encoding', '')
+
+
+async def gzip_stream(chunks):
+    # Каждое событие сжимается с flush, чтобы клиент мог распаковать его сразу
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+@app.after_request
+async def gzip_response(response):
+    if accepts_gzip() and response.mimetype == 'application/json' and 'Content-Encoding' not in response.headers:
+        response.set_data(zlib.compress(await response.get_data(), wbits=16 + zlib.MAX_WBITS))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def get_api_key():
+    return request.args.get('key') or request.headers.get('X-Goog-Api-Key') or request.headers.get('X-API-Key') or ''
+
+
+@app.route('/upload/v1beta/<path:subpath>', methods=['POST', 'PUT'])
+async def fake_upload(subpath):
+    api_key = get_api_key()
+    upload_id = request.args.get('upload_id')
+    if upload_id is None:
+        await request.get_data()
+        if api_key.startswith('bad'):
+            return error_response(403, 'PERMISSION_DENIED', 'API key not valid.')
+        upload_id = uuid.uuid4().hex
+        upload_sessions[upload_id] = api_key
+        upload_url = f"{request.host_url}upload/v1beta/{subpath}?key={api_key}&upload_id={upload_id}&upload_protocol=resumable"
+        return Response(b'', headers={'X-Goog-Upload-URL': upload_url, 'X-Goog-Upload-Status': 'active'})
+
+    if upload_id not in upload_sessions:
+        return error_response(404, 'NOT_FOUND', 'Unknown upload session.')
+    if api_key and api_key != upload_sessions[upload_id]:
+        return error_response(403, 'PERMISSION_DENIED', 'Upload session belongs to another key.')
+    size = 0
+    async for chunk in request.body:
+        size += len(chunk)
+    if 'finalize' not in request.headers.get('X-Goog-Upload-Command', ''):
+        return Response(b'', headers={'X-Goog-Upload-Status': 'active', 'X-Goog-Upload-Size-Received': str(size)})
+    del upload_sessions[upload_id]
+    return {'file': {'name': f'files/{upload_id[:12]}', 'uri': f"{request.host_url}v1beta/files/{upload_id[:12]}", 'sizeBytes': str(size), 'state': 'ACTIVE'}}
+
+
+@app.route('/v1beta/cachedContents', methods=['POST'])
+async def fake_create_cached_content():
+    api_key = get_api_key()
+    cached_content = await request.get_json()
+    if api_key.startswith('bad'):
+        return error_response(403, 'PERMISSION_DENIED', 'API key not valid.')
+    name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+    cached_contents[name] = api_key
+    return {'name': name, 'model': cached_content.get('model'), 'ttl': cached_content.get('ttl')}
+
+
+@app.route('/v1beta/cachedContents/<cache_id>', methods=['PATCH', 'DELETE'])
+async def fake_update_cached_content(cache_id):
+    name = f"cachedContents/{cache_id}"
+    await request.get_data()
+    if cached_contents.get(name) != get_api_key():
+        return error_response(403, 'PERMISSION_DENIED', 'CachedContent not found (or permission denied).')
+    if request.method == 'DELETE':
+        del cached_contents[name]
+        return {}
+    return {'name': name}
+
+
+@app.route('/v1beta/<path:subpath>', methods=['GET', 'POST'])
+async def fake_api(subpath):
+    api_key = get_api_key()
+    await request.get_data()
+    latency = LATENCY + random.random() * JITTER
+    await asyncio.sleep(latency * SLOW_FACTOR if api_key.startswith('slow') else latency)
+
+    if api_key.startswith('bad'):
+        return error_response(403, 'PERMISSION_DENIED', 'API key not valid.')
+    roll = random.random()
+    if roll < RATE_429:
+        return error_response(429, 'RESOURCE_EXHAUSTED', 'Quota exceeded.', [{'@type': 'type.googleapis.com/google.rpc.RetryInfo', 'retryDelay': '5s'}])
+    if roll < RATE_429 + RATE_500:
+        return error_response(500, 'INTERNAL', 'Internal error.')
+    if request.method == 'POST' and request.is_json:
+        cached_content = (await request.get_json()).get('cachedContent')
+        if cached_content is not None and cached_contents.get(cached_content) != api_key:
+            return error_response(403, 'PERMISSION_DENIED', 'CachedContent not found (or permission denied).')
+
+    if subpath.endswith(':streamGenerateContent'):
+        async def events():
+            for i in range(STREAM_CHUNKS):
+                if i:
+                    await asyncio.sleep(TOKEN_INTERVAL)
+                yield f"data: {json.dumps(candidate_chunk(f'token{i} ', final=i == STREAM_CHUNKS - 1))}\r\n\r\n".encode('utf-8')
+        if accepts_gzip():
+            response = Response(gzip_stream(events()), content_type='text/event-stream', headers={'Content-Encoding': 'gzip'})
+        else:
+            response = Response(events(), content_type='text/event-stream')
+        response.timeout = None
+        return response
+    if subpath.endswith(':countTokens'):
+        return {'totalTokens': 8}
+    if subpath.endswith(':embedContent'):
+        if not has_parts(await request.get_json()):
+            return error_response(400, 'INVALID_ARGUMENT', 'Content has no parts.')
+        return {'embedding': {'values': [0.1] * 768}}
+    if subpath.endswith(':batchEmbedContents'):
+        items = (await request.get_json()).get('requests', [])
+        if not all(has_parts(item) for item in items):
+            return error_response(400, 'INVALID_ARGUMENT', 'Content has no parts.')
+        return {'embeddings': [{'values': [0.1] * 768} for _ in items]}
+    if subpath.startswith('models') and ':' not in subpath:
+        return {'models': [{'name': 'models/gemini-2.0-flash'}]}
+    return candidate_chunk('fake answer', final=True)
@@ -0,0 +1,138 @@
+"""Load driver for the proxy.
+
+Example:
+    python -m benchmark.load --url http://127.0.0.1:5001 --user-key bench --mode stream --concurrency 50 --requests 2000
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import httpx
+
+REQUEST_BODY = {'contents': [{'parts': [{'text': 'Write a short story about a cat.'}]}]}
+EMBED_REQUEST_BODY = {'content': {'parts': [{'text': 'A short paragraph of a document to index.'}]}}
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def find_process_tree(pid):
+    """Returns the pid and all its descendants (hypercorn master and workers), Linux only."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def read_process_usage(pid):
+    """Returns (cpu seconds, rss bytes) of a process from /proc."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as f:
+            rss_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return cpu_seconds, rss_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+async def run_one(client, url, mode, headers, stats):
+    started_at = time.perf_counter()
+    try:
+        if mode == 'stream':
+            async with client.stream('POST', f"{url}/v1beta/models/gemini-2.0-flash:streamGenerateContent", params={'alt': 'sse'}, headers=headers, json=REQUEST_BODY) as response:
+                first_byte_at = None
+                async for _ in response.aiter_raw():
+                    if first_byte_at is None:
+                        first_byte_at = time.perf_counter()
+                if first_byte_at is not None:
+                    stats['ttfb'].append(first_byte_at - started_at)
+        elif mode == 'embed':
+            response = await client.post(f"{url}/v1beta/models/text-embedding-004:embedContent", headers=headers, json=EMBED_REQUEST_BODY)
+        else:
+            response = await client.post(f"{url}/v1beta/models/gemini-2.0-flash:generateContent", headers=headers, json=REQUEST_BODY)
+        status = response.status_code
+    except httpx.HTTPError:
+        status = 'error'
+    stats['latency'].append(time.perf_counter() - started_at)
+    stats['status'][str(status)] = stats['status'].get(str(status), 0) + 1
+
+
+async def run_load(url, user_key, mode='generate', concurrency=50, requests=1000, server_pid=None):
+    """Sends `requests` requests with `concurrency` parallel clients and returns a results dict."""
+    stats = {'latency': [], 'ttfb': [], 'status': {}}
+    headers = {'X-Goog-Api-Key': user_key}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    pids = find_process_tree(server_pid) if server_pid else []
+    usage_before = {pid: read_process_usage(pid) for pid in pids}
+
+    remaining = iter(range(requests))
+
+    async def worker(client):
+        for _ in remaining:
+            await run_one(client, url, mode, headers, stats)
+
+    started_at = time.perf_counter()
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(300)) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started_at
+
+    workers = []
+    for pid in pids:
+        before, after = usage_before.get(pid), read_process_usage(pid)
+        if before and after:
+            workers.append({'pid': pid, 'cpu_percent': round(100 * (after[0] - before[0]) / elapsed, 1), 'rss_mb': round(after[1] / 2 ** 20, 1)})
+
+    def ms(value):
+        return round(value * 1000, 1) if value is not None else None
+
+    return {
+        'mode': mode,
+        'concurrency': concurrency,
+        'requests': requests,
+        'elapsed_s': round(elapsed, 2),
+        'throughput_rps': round(requests / elapsed, 1),
+        'p50_ms': ms(percentile(stats['latency'], 0.50)),
+        'p95_ms': ms(percentile(stats['latency'], 0.95)),
+        'p99_ms': ms(percentile(stats['latency'], 0.99)),
+        'ttfb_p50_ms': ms(percentile(stats['ttfb'], 0.50)),
+        'ttfb_p99_ms': ms(percentile(stats['ttfb'], 0.99)),
+        'status': stats['status'],
+        'workers': workers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load driver for gemini-api-proxy')
+    parser.add_argument('--url', default='http://127.0.0.1:5001')
+    parser.add_argument('--user-key', required=True)
+    parser.add_argument('--mode', choices=['generate', 'stream', 'embed'], default='generate')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--server-pid', type=int, help='pid of the hypercorn master to report CPU and RSS per worker')
+    args = parser.parse_args()
+    result = asyncio.run(run_load(args.url, args.user_key, args.mode, args.concurrency, args.requests, args.server_pid))
+    print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
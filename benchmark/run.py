@@ -0,0 +1,133 @@
+"""Runs the benchmark scenarios against a local fake upstream and prints a summary table.
+
+Example:
+    python -m benchmark.run                      # all scenarios, pools of 10, 100 and 1000 keys
+    python -m benchmark.run --pools 10 --scenarios stream --requests 500
+
+Each run starts benchmark/fake_gemini.py and a fresh proxy (hypercorn main:app) in a
+temporary directory, so keys.db from the working copy is never touched.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from benchmark.load import run_load
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_KEY = 'bench-user-key'
+
+# Сценарий: режим нагрузки, доли "мертвых" и медленных ключей в пуле и дополнительные переменные окружения прокси
+SCENARIOS = {
+    'generate': {'mode': 'generate', 'bad_key_fraction': 0.0},
+    'stream': {'mode': 'stream', 'bad_key_fraction': 0.0},
+    'failover': {'mode': 'generate', 'bad_key_fraction': 0.3},
+    'slow-keys': {'mode': 'generate', 'bad_key_fraction': 0.0, 'slow_key_fraction': 0.3},
+    'embed': {'mode': 'embed', 'bad_key_fraction': 0.0},
+    'embed-batched': {'mode': 'embed', 'bad_key_fraction': 0.0, 'env': {'EMBED_BATCHING_ENABLED': '1'}},
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"Port {port} did not open in {timeout}s")
+
+
+def make_keys(pool_size, bad_key_fraction, slow_key_fraction=0.0):
+    bad_count = int(pool_size * bad_key_fraction)
+    slow_count = bad_count + int(pool_size * slow_key_fraction)
+    # Плохие и медленные ключи идут первыми: так прокси действительно приходится их обходить
+    return [f"{'bad' if i < bad_count else 'slow' if i < slow_count else 'key'}-{i:05d}-benchmark" for i in range(pool_size)]
+
+
+def start_server(app, port, env, cwd, workers=1):
+    command = [sys.executable, '-m', 'hypercorn', '-b', f'127.0.0.1:{port}', '-w', str(workers), app]
+    process = subprocess.Popen(command, env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def run_scenario(name, pool_size, args, upstream_url):
+    scenario = SCENARIOS[name]
+    port = free_port()
+    env = dict(
+        os.environ,
+        PYTHONPATH=REPO_ROOT,
+        USER_KEYS=USER_KEY,
+        GOOGLE_KEYS='|'.join(make_keys(pool_size, scenario['bad_key_fraction'], scenario.get('slow_key_fraction', 0.0))),
+        GOOGLE_API_BASE_URL=upstream_url,
+        LOG_LEVEL=args.log_level,
+        **scenario.get('env', {}),
+    )
+    with tempfile.TemporaryDirectory() as workdir:
+        proxy = start_server('main:app', port, env, workdir, workers=args.workers)
+        try:
+            result = asyncio.run(run_load(f'http://127.0.0.1:{port}', USER_KEY, scenario['mode'], args.concurrency, args.requests, proxy.pid))
+        finally:
+            stop_server(proxy)
+    result.update(scenario=name, keys=pool_size)
+    return result
+
+
+def print_table(results):
+    columns = ['scenario', 'keys', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'ttfb_p50_ms', 'ttfb_p99_ms', 'status', 'workers']
+    print('\t'.join(columns))
+    for result in results:
+        workers = ' '.join(f"{w['cpu_percent']}%/{w['rss_mb']}MB" for w in result['workers'])
+        row = [str(result[column]) for column in columns[:-2]] + [json.dumps(result['status']), workers]
+        print('\t'.join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gemini-api-proxy against a local fake upstream')
+    parser.add_argument('--pools', default='10,100,1000', help='comma-separated key pool sizes')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated scenarios: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=1, help='hypercorn workers for the proxy')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', action='store_true', help='print raw results as JSON lines')
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    # Фейковый апстрим настраивается переменными FAKE_* из окружения
+    upstream = start_server('benchmark.fake_gemini:app', upstream_port, dict(os.environ, PYTHONPATH=REPO_ROOT), REPO_ROOT, workers=1)
+    results = []
+    try:
+        for pool_size in [int(size) for size in args.pools.split(',')]:
+            for name in args.scenarios.split(','):
+                result = run_scenario(name, pool_size, args, f'http://127.0.0.1:{upstream_port}')
+                results.append(result)
+                if args.json:
+                    print(json.dumps(result, ensure_ascii=False), flush=True)
+    finally:
+        stop_server(upstream)
+    if not args.json:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
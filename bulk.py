@@ -0,0 +1,143 @@
+import os
+import json
+import asyncio
+from request_body import has_request_body
+
+# Сколько элементов одного bulk запроса выполняется одновременно (клиент может уменьшить параметром concurrency)
+BULK_MAX_CONCURRENCY = int(os.environ.get('BULK_MAX_CONCURRENCY', '32'))
+# Максимальное число элементов в одном bulk запросе
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', '10000'))
+# Сколько секунд элемент может ждать восстановления квоты, когда все ключи исчерпали лимиты; 0 - не ждать
+BULK_RATE_LIMIT_WAIT = float(os.environ.get('BULK_RATE_LIMIT_WAIT', '120'))
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl', 'application/json-seq')
+
+bulk_stats = {'requests': 0, 'items': 0, 'failed_items': 0}
+
+
+class BulkInputError(ValueError):
+    pass
+
+
+def get_bulk_concurrency(args):
+    """Concurrency requested with the `concurrency` query parameter, capped by BULK_MAX_CONCURRENCY."""
+    try:
+        requested = int(args.get('concurrency', BULK_MAX_CONCURRENCY))
+    except ValueError:
+        raise BulkInputError("concurrency must be an integer")
+    return max(1, min(requested, BULK_MAX_CONCURRENCY))
+
+
+async def read_json_array_items(request):
+    """Returns [(index, body bytes)] of a JSON array body."""
+    try:
+        items = json.loads(await request.get_data())
+    except ValueError as e:
+        raise BulkInputError(f"Request body is not valid JSON: {e}")
+    if not isinstance(items, list):
+        raise BulkInputError("Request body must be a JSON array of request bodies")
+    if len(items) > BULK_MAX_ITEMS:
+        raise BulkInputError(f"At most {BULK_MAX_ITEMS} items are allowed")
+    return [(index, json.dumps(item, ensure_ascii=False).encode('utf-8')) for index, item in enumerate(items)]
+
+
+def _checked_line(line):
+    try:
+        json.loads(line)
+    except ValueError:
+        return None
+    return line
+
+
+async def iter_ndjson_items(chunks):
+    """Yields (index, line bytes) of an NDJSON body as lines arrive, so items start before the upload ends.
+
+    A line that is not valid JSON is yielded as (index, None).
+    """
+    index = 0
+    tail = b''
+    async for chunk in chunks:
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            if line.strip():
+                if index >= BULK_MAX_ITEMS:
+                    return
+                yield index, _checked_line(line)
+                index += 1
+    if tail.strip() and index < BULK_MAX_ITEMS:
+        yield index, _checked_line(tail)
+
+
+async def iter_bulk_items(request):
+    """Returns an async iterator of (index, body bytes) for a JSON array or NDJSON request body."""
+    if not has_request_body(request):
+        raise BulkInputError("Request body is empty")
+    if request.mimetype in NDJSON_MIMETYPES:
+        return iter_ndjson_items(request.body)
+    items = await read_json_array_items(request)
+
+    async def iterate():
+        for item in items:
+            yield item
+    return iterate()
+
+
+def format_result(index, status, body):
+    """One NDJSON output line: the upstream response, or the error, of one item."""
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        payload = body.decode('utf-8', errors='replace')
+    result = {'index': index, 'status': status, 'response' if status == 200 else 'error': payload}
+    return json.dumps(result, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+async def run_bulk(items, run_item, concurrency):
+    """Runs `run_item(index, body)` -> (status, body) with at most `concurrency` items at once.
+
+    Items whose body is None (not valid JSON) get a 400 result without an upstream call.
+
+    Yields NDJSON result lines in completion order. Results are handed over through a
+    bounded queue, so a slow client holds back new items instead of growing a buffer.
+    Closing the generator (client disconnect) cancels the items still running.
+    """
+    results = asyncio.Queue(maxsize=concurrency)
+    lock = asyncio.Lock()
+    bulk_stats['requests'] += 1
+
+    async def worker():
+        while True:
+            async with lock:
+                try:
+                    index, body = await items.__anext__()
+                except StopAsyncIteration:
+                    return
+            if body is None:
+                status, response_body = 400, b'Item is not valid JSON'
+            else:
+                status, response_body = await run_item(index, body)
+            bulk_stats['items'] += 1
+            if status != 200:
+                bulk_stats['failed_items'] += 1
+            await results.put(format_result(index, status, response_body))
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    all_done = asyncio.ensure_future(asyncio.gather(*workers))
+    try:
+        while True:
+            get_result = asyncio.ensure_future(results.get())
+            await asyncio.wait((get_result, all_done), return_when=asyncio.FIRST_COMPLETED)
+            if get_result.done():
+                yield get_result.result()
+                continue
+            get_result.cancel()
+            # Все элементы выполнены: отдаем оставшиеся в очереди результаты
+            while not results.empty():
+                yield results.get_nowait()
+            all_done.result()
+            return
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
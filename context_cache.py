@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import hashlib
+import asyncio
+import logging
+from collections import OrderedDict
+import httpx
+from upstream import GOOGLE_API_BASE_URL, send_upstream_request
+from logging_setup import mask_key
+
+# Автоматическое кэширование длинных повторяющихся префиксов промпта через cachedContents, выключено по умолчанию
+CONTEXT_CACHE_ENABLED = os.environ.get('CONTEXT_CACHE_ENABLED', '0').lower() in ('1', 'true', 'yes')
+# Префикс кэшируется, если в нем примерно столько токенов (не меньше минимума cachedContents для модели)
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get('CONTEXT_CACHE_MIN_TOKENS', '4096'))
+# После скольких запросов с одним префиксом для него создается кэш
+CONTEXT_CACHE_MIN_REPEATS = int(os.environ.get('CONTEXT_CACHE_MIN_REPEATS', '2'))
+# Время жизни кэша в Google (в секундах); кэш продлевается, пока им пользуются
+CONTEXT_CACHE_TTL = int(os.environ.get('CONTEXT_CACHE_TTL', '3600'))
+# Сколько кэшей держит воркер; при вытеснении кэш удаляется и в Google
+CONTEXT_CACHE_MAX_ENTRIES = int(os.environ.get('CONTEXT_CACHE_MAX_ENTRIES', '100'))
+
+CONTEXT_CACHE_ROUTES = ('generateContent', 'streamGenerateContent')
+# Поля запроса, которые входят в кэш вместе с начальными contents
+PREFIX_FIELDS = ('systemInstruction', 'tools', 'toolConfig')
+# Грубая оценка числа токенов по размеру JSON
+BYTES_PER_TOKEN = 4
+# Кэш перестает использоваться за столько секунд до истечения в Google
+EXPIRY_MARGIN = 60
+# Сколько префиксов-кандидатов запоминается для подсчета повторов
+MAX_SIGHTINGS = 10000
+
+context_cache_stats = {'hits': 0, 'created': 0, 'create_failures': 0, 'refreshed': 0, 'evicted': 0, 'fallbacks': 0}
+
+
+def _canonical(value):
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def iter_prefixes(model_path, request_json):
+    """Yields (prefix_len, fingerprint, size in bytes) of every prefix that can be cached, shortest first.
+
+    A prefix is the PREFIX_FIELDS of the request plus its first `prefix_len` contents;
+    the last content (the new question) is never part of it. Fingerprints are chained,
+    so a conversation that grows still matches the cache of its earlier part.
+    """
+    digest = hashlib.sha256(model_path.encode('utf-8'))
+    size = 0
+    for field in PREFIX_FIELDS:
+        value = _canonical(request_json.get(field))
+        digest.update(value)
+        size += len(value)
+    yield 0, digest.hexdigest(), size
+    for prefix_len, content in enumerate(request_json['contents'][:-1], start=1):
+        value = _canonical(content)
+        digest.update(b'\0' + value)
+        size += len(value)
+        yield prefix_len, digest.hexdigest(), size
+
+
+class ContextCacheEntry:
+    """A cachedContents entry of one prompt prefix; `name` is None if creating it failed."""
+
+    __slots__ = ('fingerprint', 'name', 'api_key', 'prefix_len', 'expire_at', 'refreshing')
+
+    def __init__(self, fingerprint, name, api_key, prefix_len, expire_at):
+        self.fingerprint = fingerprint
+        self.name = name
+        self.api_key = api_key
+        self.prefix_len = prefix_len
+        self.expire_at = expire_at
+        self.refreshing = False
+
+
+class ContextCache:
+    """Local LRU index of cachedContents entries created by this worker, by prompt prefix fingerprint.
+
+    A cachedContents entry exists only for the key that created it, so requests using it
+    must be sent with that key. Entries are created in the background once a large prefix
+    has been seen CONTEXT_CACHE_MIN_REPEATS times, extended while in use and deleted upstream
+    when evicted. Failed creations are remembered for CONTEXT_CACHE_TTL so they are not retried
+    on every request.
+    """
+
+    def __init__(self, max_entries=CONTEXT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._sightings = OrderedDict()
+        self._creating = set()
+        self._tasks = set()
+
+    def prepare(self, subpath, body, select_key):
+        """Returns (entry, rewritten body) if the request's prefix is cached, else None.
+
+        Counts the request's prefix otherwise and starts creating its cache with the key
+        from `select_key()` once it repeats.
+        """
+        model_path = subpath.rsplit(':', 1)[0]
+        try:
+            request_json = json.loads(body)
+        except ValueError:
+            return None
+        if not model_path.startswith('models/') or not isinstance(request_json, dict) or 'cachedContent' in request_json:
+            return None
+        if not isinstance(request_json.get('contents'), list) or not request_json['contents']:
+            return None
+
+        prefixes = list(iter_prefixes(model_path, request_json))
+        now = time.time()
+        for prefix_len, fingerprint, size in reversed(prefixes):
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                continue
+            if now >= entry.expire_at - EXPIRY_MARGIN:
+                # Кэш истек в Google (или истек запрет на повторное создание)
+                del self._entries[fingerprint]
+                continue
+            if entry.name is None:
+                continue
+            self._entries.move_to_end(fingerprint)
+            context_cache_stats['hits'] += 1
+            if entry.expire_at - now < CONTEXT_CACHE_TTL / 2 and not entry.refreshing:
+                self._spawn(self._refresh(entry))
+            return entry, self._rewrite(request_json, entry.prefix_len, entry.name)
+
+        prefix_len, fingerprint, size = prefixes[-1]
+        if size < CONTEXT_CACHE_MIN_TOKENS * BYTES_PER_TOKEN or fingerprint in self._entries or fingerprint in self._creating:
+            return None
+        count = self._sightings.pop(fingerprint, 0) + 1
+        if count < CONTEXT_CACHE_MIN_REPEATS:
+            self._sightings[fingerprint] = count
+            if len(self._sightings) > MAX_SIGHTINGS:
+                self._sightings.popitem(last=False)
+            return None
+        api_key = select_key()
+        if api_key is not None:
+            self._creating.add(fingerprint)
+            self._spawn(self._create(fingerprint, model_path, request_json, prefix_len, api_key))
+        return None
+
+    def invalidate(self, entry):
+        """Forgets an entry that the upstream no longer knows."""
+        if self._entries.get(entry.fingerprint) is entry:
+            del self._entries[entry.fingerprint]
+
+    @staticmethod
+    def _rewrite(request_json, prefix_len, name):
+        rewritten = {field: value for field, value in request_json.items() if field not in PREFIX_FIELDS}
+        rewritten['contents'] = request_json['contents'][prefix_len:]
+        rewritten['cachedContent'] = name
+        return json.dumps(rewritten, ensure_ascii=False).encode('utf-8')
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _store(self, entry):
+        self._entries[entry.fingerprint] = entry
+        self._entries.move_to_end(entry.fingerprint)
+        while len(self._entries) > self.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            if evicted.name is not None:
+                context_cache_stats['evicted'] += 1
+                # Удаляем кэш и в Google, чтобы не платить за его хранение
+                self._spawn(self._call(evicted.api_key, 'DELETE', evicted.name))
+
+    @staticmethod
+    async def _call(api_key, method, path, body=None, params=None):
+        """Calls the cachedContents API; returns (status, body), status 0 for network errors."""
+        try:
+            response = await send_upstream_request(
+                method, f"{GOOGLE_API_BASE_URL}/v1beta/{path}",
+                headers={'X-Goog-Api-Key': api_key, 'Content-Type': 'application/json'},
+                params=params, content=_canonical(body) if body is not None else None,
+            )
+        except httpx.HTTPError as e:
+            return 0, (str(e) or type(e).__name__).encode('utf-8')
+        return response.status_code, response.content
+
+    async def _create(self, fingerprint, model_path, request_json, prefix_len, api_key):
+        cached_content = {'model': model_path, 'ttl': f"{CONTEXT_CACHE_TTL}s"}
+        cached_content.update({field: request_json[field] for field in PREFIX_FIELDS if field in request_json})
+        if prefix_len:
+            cached_content['contents'] = request_json['contents'][:prefix_len]
+        try:
+            status, body = await self._call(api_key, 'POST', 'cachedContents', cached_content)
+            name = None
+            if status == 200:
+                try:
+                    name = json.loads(body)['name']
+                except (ValueError, KeyError, TypeError):
+                    pass
+            if name is None:
+                context_cache_stats['create_failures'] += 1
+                logging.warning("Не удалось создать кэш контекста для %s с ключом %s: %s %s", model_path, mask_key(api_key), status, body[:200])
+            else:
+                context_cache_stats['created'] += 1
+                logging.info("Создан кэш контекста %s для %s с ключом %s", name, model_path, mask_key(api_key))
+            self._store(ContextCacheEntry(fingerprint, name, api_key, prefix_len, time.time() + CONTEXT_CACHE_TTL))
+        finally:
+            self._creating.discard(fingerprint)
+
+    async def _refresh(self, entry):
+        entry.refreshing = True
+        try:
+            status, _ = await self._call(entry.api_key, 'PATCH', entry.name, {'ttl': f"{CONTEXT_CACHE_TTL}s"}, params={'updateMask': 'ttl'})
+            if status == 200:
+                context_cache_stats['refreshed'] += 1
+                entry.expire_at = time.time() + CONTEXT_CACHE_TTL
+            elif status in (403, 404):
+                self.invalidate(entry)
+        finally:
+            entry.refreshing = False
+
+
+context_cache = ContextCache()
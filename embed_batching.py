@@ -0,0 +1,131 @@
+import os
+import json
+import asyncio
+import logging
+from metrics import embed_batch_size, embed_batch_fill_ratio, model_labels
+
+# Объединение одновременных embedContent для одной модели в один batchEmbedContents, выключено по умолчанию
+EMBED_BATCHING_ENABLED = os.environ.get('EMBED_BATCHING_ENABLED', '0').lower() in ('1', 'true', 'yes')
+# Сколько (в миллисекундах) первый запрос пачки ждет остальные
+EMBED_BATCH_WINDOW_MS = float(os.environ.get('EMBED_BATCH_WINDOW_MS', '5'))
+# Пачка отправляется сразу, как только набралось столько запросов (batchEmbedContents принимает до 100)
+EMBED_BATCH_MAX_SIZE = int(os.environ.get('EMBED_BATCH_MAX_SIZE', '100'))
+
+embed_batch_stats = {'batches': 0, 'batched_requests': 0, 'fallbacks': 0}
+
+
+def parse_embed_request(subpath, body):
+    """Returns the embedContent request as an item of batchEmbedContents, or None if it cannot be batched."""
+    model_path = subpath.rsplit(':', 1)[0]
+    try:
+        item = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(item, dict) or 'content' not in item:
+        return None
+    # В пачке у каждого запроса должна быть указана модель, и она должна совпадать с моделью пути
+    if item.setdefault('model', model_path) != model_path:
+        return None
+    return item
+
+
+def build_batch_body(items):
+    return json.dumps({'requests': items}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _error_code(body):
+    try:
+        return json.loads(body)['error']['code']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def split_batch_response(status, headers, body, count):
+    """Maps a batchEmbedContents response to `count` embedContent results of (status, headers, body).
+
+    Returns None when results cannot be attributed to items (the batch was rejected
+    as a whole because of some item, or the answer has an unexpected shape); then
+    every request has to be sent on its own to get its own error.
+    """
+    if status == 400 or _error_code(body) == 400:
+        # Пул ключей отдает исчерпанную ошибку апстрима со статусом 500, но ее тело сохраняется
+        return None
+    if status != 200:
+        # Ошибка относится ко всей пачке (квота, ключ, сбой апстрима) - отдаем ее всем
+        return [(status, headers, body)] * count
+    try:
+        embeddings = json.loads(body)['embeddings']
+    except (ValueError, KeyError, TypeError):
+        return None
+    if not isinstance(embeddings, list) or len(embeddings) != count:
+        return None
+    return [(status, headers, json.dumps({'embedding': embedding}, ensure_ascii=False).encode('utf-8')) for embedding in embeddings]
+
+
+class _Batch:
+    def __init__(self, send):
+        self.send = send
+        self.items = []
+        self.futures = []
+        self.timer = None
+
+
+class EmbedBatcher:
+    """Collects concurrent embedContent requests per group and sends each group as one batch.
+
+    A batch is sent EMBED_BATCH_WINDOW_MS after its first request or as soon as it has
+    EMBED_BATCH_MAX_SIZE requests. `send(items)` of the first request of the batch does
+    the upstream call and returns one result per item (None - send the item on its own).
+    """
+
+    def __init__(self, window=EMBED_BATCH_WINDOW_MS / 1000, max_size=EMBED_BATCH_MAX_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self._batches = {}
+        self._sending = set()
+
+    async def submit(self, group, model, item, send):
+        """Adds an item to the open batch of `group` and waits for its result."""
+        batch = self._batches.get(group)
+        if batch is None:
+            batch = self._batches[group] = _Batch(send)
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, group, batch, model)
+        future = asyncio.get_running_loop().create_future()
+        batch.items.append(item)
+        batch.futures.append(future)
+        if len(batch.items) >= self.max_size:
+            batch.timer.cancel()
+            self._flush(group, batch, model)
+        # Пачка отправляется в своей задаче: отключение одного клиента не отменяет ее для остальных
+        return await asyncio.shield(future)
+
+    def _flush(self, group, batch, model):
+        if self._batches.get(group) is batch:
+            del self._batches[group]
+        embed_batch_stats['batches'] += 1
+        embed_batch_stats['batched_requests'] += len(batch.items)
+        model_label = model_labels.label(model)
+        embed_batch_size.observe(len(batch.items), model_label)
+        embed_batch_fill_ratio.observe(len(batch.items) / self.max_size, model_label)
+        task = asyncio.ensure_future(self._send(batch))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, batch):
+        try:
+            results = await batch.send(batch.items)
+        except Exception as e:
+            logging.error("Error sending embedding batch of %d requests: %s", len(batch.items), e)
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if results is None:
+            embed_batch_stats['fallbacks'] += 1
+            results = [None] * len(batch.futures)
+        for future, result in zip(batch.futures, results):
+            if not future.done():
+                future.set_result(result)
+
+
+embed_batcher = EmbedBatcher()
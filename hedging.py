@@ -0,0 +1,127 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+# Хеджирование: если первая попытка не ответила за HEDGE_DELAY, параллельно запускается вторая на другом ключе
+HEDGING_ENABLED = os.environ.get('HEDGING_ENABLED', '0').lower() in ('1', 'true', 'yes')
+# Задержка в секундах или "auto" - p95 задержки ответа для метода API
+HEDGE_DELAY = os.environ.get('HEDGE_DELAY', 'auto').lower()
+# Задержка для "auto", пока не накопилось достаточно замеров
+HEDGE_DEFAULT_DELAY = float(os.environ.get('HEDGE_DEFAULT_DELAY', '2'))
+# Доля дополнительных запросов к апстриму, которую может добавить хеджирование
+HEDGE_MAX_RATIO = float(os.environ.get('HEDGE_MAX_RATIO', '0.1'))
+
+LATENCY_WINDOW = 512
+MIN_SAMPLES_FOR_PERCENTILE = 20
+
+
+class LatencyTracker:
+    """Keeps recent time-to-response samples per API method to derive the hedge delay."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._samples = {}
+        self._window = window
+
+    def record(self, route, seconds):
+        samples = self._samples.get(route)
+        if samples is None:
+            samples = self._samples[route] = deque(maxlen=self._window)
+        samples.append(seconds)
+
+    def percentile(self, route, fraction):
+        samples = self._samples.get(route)
+        if not samples or len(samples) < MIN_SAMPLES_FOR_PERCENTILE:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class HedgeBudget:
+    """Retry-budget style cap: every primary attempt earns HEDGE_MAX_RATIO of a hedge."""
+
+    def __init__(self, ratio, max_tokens=10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = 1.0
+
+    def on_attempt(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+latency_tracker = LatencyTracker()
+hedge_budget = HedgeBudget(HEDGE_MAX_RATIO)
+hedge_stats = {'hedges': 0, 'hedge_wins': 0, 'cancelled': 0}
+
+
+def get_hedge_delay(route):
+    if HEDGE_DELAY != 'auto':
+        return float(HEDGE_DELAY)
+    p95 = latency_tracker.percentile(route, 0.95)
+    return p95 if p95 is not None else HEDGE_DEFAULT_DELAY
+
+
+async def discard_response(response):
+    """Releases the body of a response that will not be sent (e.g. a losing streaming attempt)."""
+    async with response.response:
+        pass
+
+
+async def run_hedged(route, first_key, attempt, pick_hedge_key):
+    """Runs `attempt(key)` on `first_key` and, if it is slow, once more on a second key.
+
+    `attempt` must return (response, success) and do its own per-key accounting, so attempts
+    that get cancelled are not counted as key errors. Returns (key, response, success)
+    of the first successful attempt, or of the last failed one.
+    """
+    started_at = time.monotonic()
+    hedge_budget.on_attempt()
+    tasks = {asyncio.ensure_future(attempt(first_key)): first_key}
+    hedged = False
+    result = None
+    try:
+        pending = set(tasks)
+        timeout = get_hedge_delay(route)
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            timeout = None
+            for task in done:
+                key = tasks[task]
+                response, success = task.result()
+                if success:
+                    latency_tracker.record(route, time.monotonic() - started_at)
+                    if hedged and key != first_key:
+                        hedge_stats['hedge_wins'] += 1
+                    if result is None or not result[2]:
+                        result = (key, response, success)
+                elif result is None or not result[2]:
+                    result = (key, response, success)
+            if result is not None and result[2]:
+                break
+            if not done and not hedged:
+                hedge_key = pick_hedge_key(set(tasks.values()))
+                if hedge_key is not None and hedge_budget.try_spend():
+                    hedged = True
+                    hedge_stats['hedges'] += 1
+                    logging.info("Первая попытка медленнее %.2f с, запускаем параллельную на другом ключе", get_hedge_delay(route))
+                    hedge_task = asyncio.ensure_future(attempt(hedge_key))
+                    tasks[hedge_task] = hedge_key
+                    pending.add(hedge_task)
+        return result
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                hedge_stats['cancelled'] += 1
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+        # Успешные ответы проигравших попыток (например, открытые стримы) закрываем
+        for outcome in outcomes:
+            if isinstance(outcome, tuple) and outcome[1] and (result is None or outcome[0] is not result[1]):
+                await discard_response(outcome[0])
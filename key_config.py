@@ -0,0 +1,148 @@
+import os
+import signal
+import asyncio
+import logging
+import sqlite3
+from key_manager import initialize_db, apply_config_keys, load_key_rows, key_scheduler
+
+# Файл с ключами в формате .env (USER_KEYS, GOOGLE_KEYS, REMOVE_GOOGLE_KEYS), значения из него важнее переменных окружения.
+# Изменения файла применяются без перезапуска
+KEYS_FILE = os.environ.get('KEYS_FILE', '')
+# Как часто (в секундах) проверяется изменение файла ключей и ключи, добавленные или отключенные другими воркерами
+KEYS_RELOAD_INTERVAL = float(os.environ.get('KEYS_RELOAD_INTERVAL', '10'))
+
+CONFIG_NAMES = ('USER_KEYS', 'GOOGLE_KEYS', 'REMOVE_GOOGLE_KEYS')
+
+key_config_stats = {'reloads': 0, 'reload_errors': 0}
+
+# Ключи пользователей прокси; множество заменяется целиком при перезагрузке
+_user_keys = frozenset()
+_keys_file_mtime = None
+_started = False
+
+
+def split_keys(value):
+    return [key.strip() for key in (value or '').split('|') if key.strip()]
+
+
+def read_keys_file(path):
+    """Reads USER_KEYS, GOOGLE_KEYS and REMOVE_GOOGLE_KEYS from a .env style file."""
+    values = {}
+    with open(path, encoding='utf-8') as keys_file:
+        for line in keys_file:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            name, value = line.split('=', 1)
+            name = name.strip()
+            if name.startswith('export '):
+                name = name[len('export '):].strip()
+            if name in CONFIG_NAMES:
+                values[name] = value.strip().strip('"\'')
+    return values
+
+
+def read_key_config():
+    """Returns {name: [keys]} for CONFIG_NAMES from the environment, overridden by KEYS_FILE."""
+    values = {name: os.environ.get(name, '') for name in CONFIG_NAMES}
+    if KEYS_FILE:
+        values.update(read_keys_file(KEYS_FILE))
+    return {name: split_keys(value) for name, value in values.items()}
+
+
+def _keys_file_version():
+    try:
+        stat = os.stat(KEYS_FILE)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def is_user_key(key):
+    """True if `key` is a key of a proxy user (USER_KEYS)."""
+    return key in _user_keys
+
+
+def _apply_config(config):
+    """Writes the Google keys of `config` to the database and swaps in its user keys; returns (added, removed)."""
+    global _user_keys
+    added_count, removed_count = apply_config_keys(config['GOOGLE_KEYS'], config['REMOVE_GOOGLE_KEYS'])
+    _user_keys = frozenset(config['USER_KEYS'])
+    return added_count, removed_count
+
+
+def setup_keys():
+    """Creates the database and applies the configured keys; runs once per process, later calls do nothing."""
+    global _started, _keys_file_mtime
+    if _started:
+        return
+    _started = True
+    initialize_db()
+    _keys_file_mtime = _keys_file_version() if KEYS_FILE else None
+    added_count, removed_count = _apply_config(read_key_config())
+    logging.info("Ключи загружены: добавлено %d, отключено %d, пользователей %d", added_count, removed_count, len(_user_keys))
+
+
+def _reload_in_thread():
+    global _keys_file_mtime
+    if KEYS_FILE:
+        _keys_file_mtime = _keys_file_version()
+    config = read_key_config()
+    added_count, removed_count = apply_config_keys(config['GOOGLE_KEYS'], config['REMOVE_GOOGLE_KEYS'])
+    return config, added_count, removed_count, load_key_rows()
+
+
+async def reload_key_config():
+    """Re-reads the key configuration and applies it to this worker.
+
+    New requests see the new user keys and key pool as soon as this returns; requests
+    already running keep the key they were started with. Returns a summary of the changes.
+    """
+    global _user_keys
+    try:
+        config, added_count, removed_count, rows = await asyncio.to_thread(_reload_in_thread)
+    except (OSError, sqlite3.Error):
+        key_config_stats['reload_errors'] += 1
+        raise
+    # Замена множества одним присваиванием: запросы видят либо старые, либо новые ключи пользователей
+    _user_keys = frozenset(config['USER_KEYS'])
+    changed = key_scheduler.sync_rows(rows)
+    key_config_stats['reloads'] += 1
+    logging.info("Ключи перезагружены: добавлено %d, отключено %d, изменено в пуле %d, пользователей %d", added_count, removed_count, changed, len(_user_keys))
+    return {'added': added_count, 'removed': removed_count, 'pool_changes': changed, 'user_keys': len(_user_keys), 'active_keys': key_scheduler.active_count()}
+
+
+async def _sync_pool():
+    """Picks up keys added or toggled by other workers (web interface, their reloads)."""
+    key_scheduler.sync_rows(await asyncio.to_thread(load_key_rows))
+
+
+async def run_key_config_watcher(interval=None):
+    """Background task: reloads keys on SIGHUP or KEYS_FILE change and keeps the pool in sync with the database."""
+    interval = KEYS_RELOAD_INTERVAL if interval is None else interval
+    loop = asyncio.get_running_loop()
+    reload_requested = asyncio.Event()
+    try:
+        loop.add_signal_handler(signal.SIGHUP, reload_requested.set)
+    except (NotImplementedError, RuntimeError, AttributeError):
+        # Windows или не главный поток: остается перезагрузка по изменению файла и через веб-интерфейс
+        logging.info("SIGHUP недоступен, перезагрузка ключей по сигналу отключена")
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(reload_requested.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if reload_requested.is_set() or (KEYS_FILE and _keys_file_version() != _keys_file_mtime):
+                    reload_requested.clear()
+                    await reload_key_config()
+                else:
+                    await _sync_pool()
+            except (OSError, sqlite3.Error) as e:
+                logging.error("Error syncing keys: %s", e)
+    finally:
+        try:
+            loop.remove_signal_handler(signal.SIGHUP)
+        except (NotImplementedError, RuntimeError, AttributeError, ValueError):
+            pass
@@ -2,13 +2,45 @@ import sqlite3
 import os
 import time
 import json
+import heapq
+import asyncio
+import logging
+import itertools
+from rate_limits import rate_limiter
 
 DATABASE_FILE = 'keys.db'
+# Как часто (в секундах) накопленная статистика ключей записывается в БД
+KEY_STATS_FLUSH_INTERVAL = float(os.environ.get('KEY_STATS_FLUSH_INTERVAL', '5'))
+# За сколько секунд без новых ответов оценка здоровья ключа наполовину возвращается к нейтральной
+KEY_HEALTH_HALF_LIFE = float(os.environ.get('KEY_HEALTH_HALF_LIFE', '300'))
+
+# Вес нового ответа в скользящих средних доли успехов и задержки ключа
+KEY_HEALTH_ALPHA = 0.2
+# Вес нового ответа в средней задержке метода API по всем ключам
+LATENCY_BASELINE_ALPHA = 0.05
+# Как часто (в секундах) пересчитываются оценки всех ключей, чтобы ключи без запросов восстанавливались
+KEY_SCORE_REFRESH_INTERVAL = 5.0
+# Доля успехов, с которой ключ возвращается из карантина: трафик на него растет по мере успешных ответов
+READMITTED_SUCCESS_RATE = 0.5
+
+# Колонки, добавленные в api_keys после первой версии, и их типы
+ADDED_COLUMNS = {
+    'quarantined_at': 'REAL NULL',
+    'quarantine_reason': 'TEXT NULL',
+    'last_probe_at': 'REAL NULL',
+    'last_probe_status': 'INTEGER NULL',
+    'probe_successes': 'INTEGER DEFAULT 0',
+    'probe_failures': 'INTEGER DEFAULT 0',
+}
 
 def initialize_db():
     """Initializes the SQLite database for storing API keys."""
     conn = sqlite3.connect(DATABASE_FILE)
     cursor = conn.cursor()
+    # WAL: читатели не блокируют запись, несколько воркеров работают с одним файлом без "database is locked"
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # Воркеры запускаются одновременно: схема создается и мигрирует в одной транзакции, по очереди
+    cursor.execute("BEGIN IMMEDIATE")
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS api_keys (
             key TEXT PRIMARY KEY,
@@ -21,52 +53,52 @@ def initialize_db():
             removed INTEGER DEFAULT 0 -- New flag for removal
         )
     ''')
+    # Миграция БД, созданной предыдущими версиями
+    existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(api_keys)")}
+    for column, column_type in ADDED_COLUMNS.items():
+        if column not in existing_columns:
+            cursor.execute(f"ALTER TABLE api_keys ADD COLUMN {column} {column_type}")
     conn.commit()
     conn.close()
 
-def add_keys_from_env():
-    """Adds keys from the GOOGLE_KEYS environment variable to the database."""
-    google_keys_str = os.environ.get('GOOGLE_KEYS')
-    if not google_keys_str:
-        print("GOOGLE_KEYS environment variable not set.")
-        return
+def apply_config_keys(google_keys, removed_keys):
+    """Adds `google_keys` and marks `removed_keys` as removed in one transaction; returns (added, removed) counts.
 
-    keys = [key.strip() for key in google_keys_str.split('|') if key.strip()]
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    added_count = 0
-    for key in keys:
-        try:
-            cursor.execute("INSERT OR IGNORE INTO api_keys (key, added_at) VALUES (?, ?)", (key, time.time()))
-            if cursor.rowcount > 0:
-                added_count += 1
-        except sqlite3.Error as e:
-            print(f"Error adding key {key} to database: {e}")
-    conn.commit()
-    conn.close()
-    print(f"Added {added_count} new keys from GOOGLE_KEYS.")
+    Keys already in the database keep their state and stats, so running it again
+    (another worker, a config reload) changes nothing.
+    """
+    conn = sqlite3.connect(DATABASE_FILE, timeout=10)
+    try:
+        with conn:
+            added_at = time.time()
+            added_count = sum(conn.execute("INSERT OR IGNORE INTO api_keys (key, added_at) VALUES (?, ?)", (key, added_at)).rowcount for key in google_keys)
+            removed_count = sum(conn.execute("UPDATE api_keys SET removed = 1 WHERE key = ? AND removed = 0", (key,)).rowcount for key in removed_keys)
+        return added_count, removed_count
+    finally:
+        conn.close()
 
-def remove_keys_from_env():
-    """Removes keys specified in the REMOVE_GOOGLE_KEYS environment variable from the database."""
-    remove_keys_str = os.environ.get('REMOVE_GOOGLE_KEYS')
-    if not remove_keys_str:
-        print("REMOVE_GOOGLE_KEYS environment variable not set.")
-        return
+def load_key_rows():
+    """Returns all rows of api_keys, to pick up keys added or removed by other workers."""
+    conn = get_db_connection()
+    try:
+        return conn.execute("SELECT * FROM api_keys").fetchall()
+    finally:
+        conn.close()
+
+def load_key_page(sort_by, descending, limit, offset):
+    """Returns (one page of api_keys rows ordered by the `sort_by` column, number of all rows).
+
+    `sort_by` goes into the query as is, so it must be a checked column name.
+    """
+    conn = get_db_connection()
+    try:
+        total = conn.execute("SELECT COUNT(*) FROM api_keys").fetchone()[0]
+        # Ключ - второй порядок сортировки, чтобы строки с равными значениями не переходили между страницами
+        rows = conn.execute(f"SELECT * FROM api_keys ORDER BY {sort_by} {'DESC' if descending else 'ASC'}, key LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+        return rows, total
+    finally:
+        conn.close()
 
-    keys_to_remove = [key.strip() for key in remove_keys_str.split('|') if key.strip()]
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    removed_count = 0
-    for key in keys_to_remove:
-        try:
-            cursor.execute("UPDATE api_keys SET removed = 1 WHERE key = ?", (key,))
-            if cursor.rowcount > 0:
-                removed_count += 1
-        except sqlite3.Error as e:
-            print(f"Error marking key {key} as removed in database: {e}")
-    conn.commit()
-    conn.close()
-    print(f"Marked {removed_count} keys as removed specified in REMOVE_GOOGLE_KEYS.")
 def get_db_connection():
     """Creates a database connection."""
     conn = sqlite3.connect(DATABASE_FILE)
@@ -74,52 +106,428 @@ def get_db_connection():
     return conn
 
 def update_key_stats(key, success=True):
-    """Updates statistics for a given key."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    current_time = time.time()
+    """Updates statistics for a given key in memory; they are persisted by the periodic flush."""
+    key_scheduler.record_result(key, success)
 
-    try:
+
+def _empty_pending():
+    # success/error - counter deltas, streak - errors after the last success, reset - a success happened
+    return {'success': 0, 'error': 0, 'streak': 0, 'reset': False}
+
+
+class KeyHealth:
+    """Recent success rate and relative TTFB of one key.
+
+    Both are EWMAs over recent responses that also decay back to neutral (1.0) with
+    KEY_HEALTH_HALF_LIFE while the key gets no responses, so a key that was slow or
+    failing a while ago gets tried again. TTFB is relative to the average of the
+    API method and model over all keys, so keys serving different models compare fairly.
+    """
+
+    __slots__ = ('success_rate', 'latency_ratio', 'updated_at')
+
+    def __init__(self):
+        self.success_rate = 1.0
+        self.latency_ratio = 1.0
+        self.updated_at = time.monotonic()
+
+    def _decay(self, now):
+        keep = 0.5 ** ((now - self.updated_at) / KEY_HEALTH_HALF_LIFE)
+        self.success_rate = 1.0 + (self.success_rate - 1.0) * keep
+        self.latency_ratio = 1.0 + (self.latency_ratio - 1.0) * keep
+        self.updated_at = now
+
+    def record_result(self, success, now):
+        self._decay(now)
+        self.success_rate += ((1.0 if success else 0.0) - self.success_rate) * KEY_HEALTH_ALPHA
+
+    def record_latency(self, ratio, now):
+        self._decay(now)
+        self.latency_ratio += (ratio - self.latency_ratio) * KEY_HEALTH_ALPHA
+
+    def cost(self, in_flight, now):
+        """Expected relative latency of one successful response: lower is better, 1.0 for an idle neutral key."""
+        self._decay(now)
+        return self.latency_ratio * (in_flight + 1) / max(self.success_rate, 0.05)
+
+
+class KeyScheduler:
+    """In-memory priority queue of Google API keys with write-behind persistence.
+
+    Keys are ordered by (errors_since_last_success, cost, successful_requests + error_requests).
+    The cost combines the key's recent success rate and TTFB (see KeyHealth) with its
+    requests in flight, so requests go to keys that answer fast now and spread over
+    equally good ones. The cost is rounded, so keys that differ only by noise are
+    balanced by total usage. In-flight counts include other workers' requests when
+    key state is shared (see shared_state.py). Costs of keys without responses are
+    refreshed every KEY_SCORE_REFRESH_INTERVAL seconds. Removed and quarantined keys
+    (see key_probe.py) are never selected. The heap uses lazy
+    invalidation (see the heapq docs recipe), so picking the best key and updating
+    its stats are both O(log n). Counter changes are accumulated as deltas and
+    written to the api_keys table in one transaction by write_pending_stats().
+    """
+
+    def __init__(self):
+        self._rows = {}
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._pending = {}
+        self._loaded = False
+        self._in_flight = {}
+        self._remote_in_flight = {}
+        self._changed_streaks = set()
+        self._health = {}
+        self._latency_baselines = {}
+        self._rescored_at = 0.0
+
+    def load(self):
+        """(Re)loads all keys from the database, dropping unflushed state."""
+        conn = get_db_connection()
+        try:
+            rows = conn.execute("SELECT * FROM api_keys").fetchall()
+        finally:
+            conn.close()
+        self._rows = {row['key']: dict(row) for row in rows}
+        self._pending = {}
+        self._rebuild_heap()
+        self._loaded = True
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def _health_of(self, key):
+        health = self._health.get(key)
+        if health is None:
+            health = self._health[key] = KeyHealth()
+        return health
+
+    def _cost(self, key, now):
+        in_flight = self._in_flight.get(key, 0) + self._remote_in_flight.get(key, 0)
+        return self._health_of(key).cost(in_flight, now)
+
+    def _priority(self, row):
+        return (row['errors_since_last_success'], round(self._cost(row['key'], time.monotonic()), 1), row['successful_requests'] + row['error_requests'])
+
+    @staticmethod
+    def _is_selectable(row):
+        return not row['removed'] and row['quarantined_at'] is None
+
+    def _rebuild_heap(self):
+        self._rescored_at = time.monotonic()
+        self._entries = {}
+        self._heap = []
+        for key, row in self._rows.items():
+            if self._is_selectable(row):
+                entry = [*self._priority(row), next(self._counter), key]
+                self._entries[key] = entry
+                self._heap.append(entry)
+        heapq.heapify(self._heap)
+
+    def _push(self, key):
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            old_entry[-1] = None  # Lazily invalidated, skipped when popped
+        row = self._rows[key]
+        if not self._is_selectable(row):
+            return
+        entry = [*self._priority(row), next(self._counter), key]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        # Compact the heap once stale entries dominate it
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [entry for entry in self._heap if entry[-1] is not None]
+            heapq.heapify(self._heap)
+
+    def select_key(self, exclude=(), is_available=None):
+        """Returns the best active key not in `exclude` that passes `is_available`, or None."""
+        self.ensure_loaded()
+        if time.monotonic() - self._rescored_at >= KEY_SCORE_REFRESH_INTERVAL:
+            self._rebuild_heap()
+        skipped = []
+        best = None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if entry[-1] is None:
+                continue
+            skipped.append(entry)
+            if entry[-1] not in exclude and (is_available is None or is_available(entry[-1])):
+                best = entry[-1]
+                break
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return best
+
+    def sorted_keys(self):
+        """Returns all active keys in priority order."""
+        self.ensure_loaded()
+        return [entry[-1] for entry in sorted(self._entries.values())]
+
+    def is_selectable(self, key):
+        """True if the key is in rotation (not removed or quarantined)."""
+        self.ensure_loaded()
+        return key in self._entries
+
+    def active_count(self):
+        self.ensure_loaded()
+        return len(self._entries)
+
+    def record_result(self, key, success):
+        """Updates in-memory stats for a key and queues the change for the next flush."""
+        self.ensure_loaded()
+        row = self._rows.get(key)
+        if row is None:
+            # Key is not managed by the proxy (e.g. a user's own Google key passed through)
+            return
+        self._health_of(key).record_result(success, time.monotonic())
+        pending = self._pending.setdefault(key, _empty_pending())
+        if not success or row['errors_since_last_success']:
+            # Серия ошибок меняется: об этом узнают другие воркеры при синхронизации
+            self._changed_streaks.add(key)
         if success:
-            cursor.execute("""
-                UPDATE api_keys
-                SET successful_requests = successful_requests + 1,
-                    errors_since_last_success = 0,
-                    first_error_at = NULL,
-                    error_counter_started_at = NULL
-                WHERE key = ?
-            """, (key,))
+            row['successful_requests'] += 1
+            row['errors_since_last_success'] = 0
+            row['first_error_at'] = None
+            row['error_counter_started_at'] = None
+            pending['success'] += 1
+            pending['streak'] = 0
+            pending['reset'] = True
         else:
-            cursor.execute("SELECT first_error_at, error_counter_started_at FROM api_keys WHERE key = ?", (key,))
-            row = cursor.fetchone()
+            current_time = time.time()
+            row['error_requests'] += 1
+            row['errors_since_last_success'] += 1
+            if row['first_error_at'] is None:
+                row['first_error_at'] = current_time
+            if row['error_counter_started_at'] is None:
+                row['error_counter_started_at'] = current_time
+            pending['error'] += 1
+            pending['streak'] += 1
+        self._push(key)
+
+    def record_latency(self, key, route, model, seconds):
+        """Feeds the time to response headers of a successful upstream call into the key's health."""
+        if key not in self._rows:
+            return
+        baseline = self._latency_baselines.get((route, model))
+        if baseline is None:
+            baseline = seconds
+        ratio = seconds / baseline if baseline > 0 else 1.0
+        self._latency_baselines[(route, model)] = baseline + (seconds - baseline) * LATENCY_BASELINE_ALPHA
+        self._health_of(key).record_latency(ratio, time.monotonic())
+        self._push(key)
+
+    def acquire(self, key):
+        """Counts a request in flight on the key until release()."""
+        if key in self._rows:
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            self._push(key)
+
+    def release(self, key):
+        count = self._in_flight.get(key)
+        if count is None:
+            return
+        if count > 1:
+            self._in_flight[key] = count - 1
+        else:
+            del self._in_flight[key]
+        self._push(key)
+
+    def local_in_flight(self):
+        return dict(self._in_flight)
+
+    def set_remote_in_flight(self, counts):
+        """Replaces in-flight counts of other workers, re-prioritizing only keys whose count changed."""
+        changed = {key for key in counts.keys() | self._remote_in_flight.keys() if counts.get(key) != self._remote_in_flight.get(key)}
+        self._remote_in_flight = counts
+        for key in changed:
+            if key in self._rows:
+                self._push(key)
+
+    def take_changed_streaks(self):
+        """Returns {key: errors_since_last_success} of keys whose error streak changed since the last call."""
+        changed, self._changed_streaks = self._changed_streaks, set()
+        return {key: self._rows[key]['errors_since_last_success'] for key in changed if key in self._rows}
+
+    def restore_changed_streaks(self, streaks):
+        self._changed_streaks.update(streaks)
+
+    def apply_shared_streaks(self, streaks):
+        """Applies error streaks observed by other workers; keys changed locally since the last sync keep the local value."""
+        for key, streak in streaks.items():
+            row = self._rows.get(key)
+            if row is None or key in self._changed_streaks or row['errors_since_last_success'] == streak:
+                continue
+            row['errors_since_last_success'] = streak
+            self._push(key)
+
+    def all_keys(self):
+        self.ensure_loaded()
+        return list(self._rows)
+
+    def key_count(self):
+        self.ensure_loaded()
+        return len(self._rows)
+
+    def sync_rows(self, rows):
+        """Adds keys that are new in the database and applies enable/disable changes; in-memory stats are kept.
+
+        Returns the number of keys added or toggled. Requests already running
+        on a removed key finish on it; new requests no longer get it.
+        """
+        self.ensure_loaded()
+        changed = 0
+        for db_row in rows:
+            key = db_row['key']
+            row = self._rows.get(key)
             if row is None:
-                # Handle case where key is not found, though this shouldn't happen if key was just used.
-                # For robustness, we can log this or initialize these vars to None or current_time.
-                print(f"Warning: Key {key} not found in database during stat update.")
-                first_error_at, error_counter_started_at = current_time, current_time
+                self._rows[key] = dict(db_row)
+            elif row['removed'] != db_row['removed']:
+                row['removed'] = db_row['removed']
             else:
-                first_error_at, error_counter_started_at = row
-
-            if first_error_at is None:
-                first_error_at = current_time
-            if error_counter_started_at is None:
-                error_counter_started_at = current_time
-
-            cursor.execute("""
-                UPDATE api_keys
-                SET error_requests = error_requests + 1,
-                    errors_since_last_success = errors_since_last_success + 1,
-                    first_error_at = ?,
-                    error_counter_started_at = ?
-                WHERE key = ?
-            """, (first_error_at, error_counter_started_at, key))
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"Error updating stats for key {key}: {e}")
+                continue
+            changed += 1
+            self._push(key)
+        return changed
+
+    def set_removed(self, key, removed_status):
+        """Applies an enable/disable made in the database to the in-memory state."""
+        row = self._rows.get(key)
+        if row is not None:
+            row['removed'] = removed_status
+            self._push(key)
+
+    def apply_probe_state(self, key, state):
+        """Applies probe columns of api_keys (see key_probe.py) to the in-memory row.
+
+        A key with quarantined_at set is out of selection. A key back from quarantine
+        starts with a low recent success rate, so it gets a growing share of traffic
+        as it answers successfully instead of all of it at once.
+        """
+        row = self._rows.get(key)
+        if row is None:
+            return
+        was_quarantined = row['quarantined_at'] is not None
+        row.update(state)
+        is_quarantined = row['quarantined_at'] is not None
+        if was_quarantined and not is_quarantined:
+            health = self._health[key] = KeyHealth()
+            health.success_rate = READMITTED_SUCCESS_RATE
+        if was_quarantined != is_quarantined:
+            self._push(key)
+
+    def quarantined_keys(self):
+        self.ensure_loaded()
+        return {key for key, row in self._rows.items() if row['quarantined_at'] is not None and not row['removed']}
+
+    def add_key(self, key, added_at):
+        """Registers a key just inserted into the database."""
+        if key not in self._rows:
+            self._rows[key] = {
+                'key': key, 'added_at': added_at, 'successful_requests': 0, 'error_requests': 0,
+                'errors_since_last_success': 0, 'first_error_at': None, 'error_counter_started_at': None, 'removed': 0,
+                **{column: 0 if column in ('probe_successes', 'probe_failures') else None for column in ADDED_COLUMNS},
+            }
+            self._push(key)
+
+    def get_rows(self, rows=None):
+        """Returns copies of key rows, including removed ones, with their current health for display.
+
+        `rows` are api_keys rows read from the database, whose counters include all workers;
+        by default the in-memory rows of this worker are used.
+        """
+        self.ensure_loaded()
+        now = time.monotonic()
+        if rows is None:
+            rows = self._rows.values()
+        result = []
+        for row in rows:
+            key = row['key']
+            health = self._health_of(key)
+            row = dict(row)
+            row['in_flight'] = self._in_flight.get(key, 0) + self._remote_in_flight.get(key, 0)
+            row['cost'] = self._cost(key, now)
+            row['recent_success_rate'] = health.success_rate
+            row['ttfb_ratio'] = health.latency_ratio
+            result.append(row)
+        return result
+
+    def take_pending(self):
+        """Detaches accumulated stats changes so they can be written outside the event loop."""
+        pending, self._pending = self._pending, {}
+        return [(key, changes, dict(self._rows[key])) for key, changes in pending.items()]
+
+    def restore_pending(self, batch):
+        """Puts back a batch that failed to flush so it is retried next time."""
+        for key, changes, _ in batch:
+            pending = self._pending.setdefault(key, _empty_pending())
+            pending['success'] += changes['success']
+            pending['error'] += changes['error']
+            # Newer changes win for the error streak unless they did not reset it
+            if not pending['reset']:
+                pending['streak'] += changes['streak']
+                pending['reset'] = changes['reset']
+
+
+def write_pending_stats(batch):
+    """Writes a batch from KeyScheduler.take_pending() to the database in one transaction."""
+    if not batch:
+        return
+    conn = sqlite3.connect(DATABASE_FILE)
+    try:
+        with conn:
+            for key, changes, row in batch:
+                if changes['reset']:
+                    # A success happened in this batch: the error streak restarts from the errors after it
+                    conn.execute("""
+                        UPDATE api_keys
+                        SET successful_requests = successful_requests + ?,
+                            error_requests = error_requests + ?,
+                            errors_since_last_success = ?,
+                            first_error_at = ?,
+                            error_counter_started_at = ?
+                        WHERE key = ?
+                    """, (changes['success'], changes['error'], changes['streak'], row['first_error_at'], row['error_counter_started_at'], key))
+                else:
+                    conn.execute("""
+                        UPDATE api_keys
+                        SET error_requests = error_requests + ?,
+                            errors_since_last_success = errors_since_last_success + ?,
+                            first_error_at = COALESCE(first_error_at, ?),
+                            error_counter_started_at = COALESCE(error_counter_started_at, ?)
+                        WHERE key = ?
+                    """, (changes['error'], changes['streak'], row['first_error_at'], row['error_counter_started_at'], key))
     finally:
         conn.close()
 
 
+key_scheduler = KeyScheduler()
+
+
+async def flush_key_stats():
+    """Persists accumulated key stats without blocking the event loop."""
+    batch = key_scheduler.take_pending()
+    if not batch:
+        return
+    try:
+        await asyncio.to_thread(write_pending_stats, batch)
+    except sqlite3.Error as e:
+        logging.error("Error flushing key stats (%d keys): %s", len(batch), e)
+        key_scheduler.restore_pending(batch)
+
+
+async def run_key_stats_flusher(interval=None):
+    """Background task that periodically flushes key stats until cancelled."""
+    interval = interval or KEY_STATS_FLUSH_INTERVAL
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await flush_key_stats()
+    finally:
+        # Final flush on shutdown
+        await flush_key_stats()
+
+
 def get_available_keys():
     """Retrieves all keys from the database."""
     conn = sqlite3.connect(DATABASE_FILE)
@@ -129,25 +537,20 @@ def get_available_keys():
     conn.close()
     return keys
 
-def select_best_key():
-    """Selects the best key based on error count and total requests using get_sorted_keys."""
-    sorted_keys = get_sorted_keys()
-    if sorted_keys:
-        return sorted_keys[0]
-    return None
+def select_best_key(exclude=(), model=None):
+    """Selects the best key based on error count and total requests.
+
+    Keys in `exclude` and keys that are rate limited or cooling down for `model` are skipped.
+    """
+    return key_scheduler.select_key(exclude, is_available=lambda key: rate_limiter.is_available(key, model))
+
+def get_active_key_count():
+    """Returns the number of keys that are not removed."""
+    return key_scheduler.active_count()
 
 def get_sorted_keys():
-    """Retrieves all keys from the database, sorted by priority."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT key FROM api_keys
-        WHERE removed = 0
-        ORDER BY errors_since_last_success ASC, (successful_requests + error_requests) ASC
-    """)
-    keys = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return keys
+    """Retrieves all active keys sorted by priority."""
+    return key_scheduler.sorted_keys()
 
 
 def toggle_key_removed_status(key, removed_status):
@@ -157,6 +560,8 @@ def toggle_key_removed_status(key, removed_status):
     try:
         cursor.execute("UPDATE api_keys SET removed = ? WHERE key = ?", (removed_status, key))
         conn.commit()
+        if cursor.rowcount > 0:
+            key_scheduler.set_removed(key, removed_status)
         return cursor.rowcount > 0
     except sqlite3.Error as e:
         print(f"Error toggling removed status for key {key}: {e}")
@@ -169,8 +574,11 @@ def add_new_key(key):
     conn = sqlite3.connect(DATABASE_FILE)
     cursor = conn.cursor()
     try:
-        cursor.execute("INSERT OR IGNORE INTO api_keys (key, added_at) VALUES (?, ?)", (key, time.time()))
+        added_at = time.time()
+        cursor.execute("INSERT OR IGNORE INTO api_keys (key, added_at) VALUES (?, ?)", (key, added_at))
         conn.commit()
+        if cursor.rowcount > 0:
+            key_scheduler.add_key(key, added_at)
         return cursor.rowcount > 0
     except sqlite3.Error as e:
         print(f"Error adding new key {key} to database: {e}")
@@ -179,19 +587,10 @@ def add_new_key(key):
         conn.close()
 
 
-# Initial setup
-initialize_db()
-add_keys_from_env()
-remove_keys_from_env()
-
 if __name__ == '__main__':
     # Example usage (for testing)
-    # Set GOOGLE_KEYS and REMOVE_GOOGLE_KEYS environment variables before running
-    # os.environ['GOOGLE_KEYS'] = 'key1,key2,key3'
-    # os.environ['REMOVE_GOOGLE_KEYS'] = 'key2'
     # initialize_db()
-    # add_keys_from_env()
-    # remove_keys_from_env()
+    # apply_config_keys(['key1', 'key2', 'key3'], ['key2'])
 
     # print("Available keys:", get_available_keys())
 
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+import httpx
+from key_manager import DATABASE_FILE, ADDED_COLUMNS, key_scheduler
+from upstream import GOOGLE_API_BASE_URL, send_upstream_request
+from logging_setup import mask_key
+
+# Фоновая проверка ключей дешевым запросом (список моделей) с карантином неработающих, выключено по умолчанию
+KEY_PROBE_ENABLED = os.environ.get('KEY_PROBE_ENABLED', '0').lower() in ('1', 'true', 'yes')
+# Как часто (в секундах) проверяется каждый ключ в ротации
+KEY_PROBE_INTERVAL = float(os.environ.get('KEY_PROBE_INTERVAL', '300'))
+# Как часто (в секундах) проверяется ключ в карантине
+KEY_PROBE_QUARANTINE_INTERVAL = float(os.environ.get('KEY_PROBE_QUARANTINE_INTERVAL', '60'))
+# Сколько проверок выполняется одновременно
+KEY_PROBE_CONCURRENCY = int(os.environ.get('KEY_PROBE_CONCURRENCY', '4'))
+# Сколько успешных проверок подряд нужно ключу, чтобы выйти из карантина
+KEY_PROBE_READMIT_SUCCESSES = int(os.environ.get('KEY_PROBE_READMIT_SUCCESSES', '2'))
+
+# Как часто (в секундах, со случайным разбросом) ищутся ключи, которым пора на проверку
+PROBE_TICK = 5.0
+PROBE_BATCH_SIZE = 100
+# Внеплановая проверка одного ключа - не чаще, чем раз в столько секунд
+URGENT_PROBE_MIN_GAP = 10.0
+# После неудачной проверки интервал до следующей удваивается, но не больше чем в 2**PROBE_MAX_BACKOFF раз
+PROBE_MAX_BACKOFF = 5
+# Ответы, по которым ключ считается недействительным; другие 401/403 (нет доступа к методу, регион) ключ в карантин не помещают
+KEY_ERROR_MARKERS = (b'API_KEY_INVALID', b'API key not valid')
+PROBE_COLUMNS = tuple(ADDED_COLUMNS)
+
+key_probe_stats = {'probes': 0, 'transient_failures': 0, 'quarantined': 0, 'readmitted': 0}
+
+
+def is_key_error(status, body):
+    """True if an upstream error says the key itself is invalid, not that a call with it failed (access, quota, outage)."""
+    return status in (400, 401, 403) and any(marker in body for marker in KEY_ERROR_MARKERS)
+
+
+def get_error_reason(status, body):
+    """Short reason of an upstream error for the web interface, e.g. API_KEY_INVALID."""
+    try:
+        error = json.loads(body)['error']
+        for detail in error.get('details', []):
+            if detail.get('reason'):
+                return detail['reason']
+        return error.get('status') or f"HTTP {status}"
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return f"HTTP {status}"
+
+
+def _connect():
+    conn = sqlite3.connect(DATABASE_FILE, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _state(row):
+    return {column: row[column] for column in PROBE_COLUMNS}
+
+
+def claim_due_keys(now, urgent_keys):
+    """Marks keys due for a probe (and `urgent_keys`) as probed now and returns them.
+
+    The probe interval doubles with each failed probe in a row, up to 2**PROBE_MAX_BACKOFF times.
+    The claim is one transaction, so workers sharing keys.db do not probe the same key twice.
+    """
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute("""
+                SELECT key FROM api_keys
+                WHERE removed = 0 AND (
+                    last_probe_at IS NULL
+                    OR last_probe_at < ? - (CASE WHEN quarantined_at IS NULL THEN ? ELSE ? END) * (1 << MIN(COALESCE(probe_failures, 0), ?))
+                )
+                ORDER BY last_probe_at IS NOT NULL, last_probe_at
+                LIMIT ?
+            """, (now, KEY_PROBE_INTERVAL, KEY_PROBE_QUARANTINE_INTERVAL, PROBE_MAX_BACKOFF, PROBE_BATCH_SIZE)).fetchall()
+            keys = {row['key'] for row in rows}
+            for key in urgent_keys:
+                if conn.execute("SELECT 1 FROM api_keys WHERE key = ? AND removed = 0", (key,)).fetchone():
+                    keys.add(key)
+            conn.executemany("UPDATE api_keys SET last_probe_at = ? WHERE key = ?", [(now, key) for key in keys])
+        return list(keys)
+    finally:
+        conn.close()
+
+
+def record_probe_result(key, status, key_error, reason):
+    """Stores a probe result; returns (probe state of the key, 'quarantined' | 'readmitted' | None).
+
+    A key error quarantines the key. A quarantined key is readmitted after
+    KEY_PROBE_READMIT_SUCCESSES successful probes in a row. Other failures
+    (429, 5xx, network errors, 401/403 without a key error) change neither,
+    but back off the next probe of the key.
+    """
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT * FROM api_keys WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, None
+            state = _state(row)
+            state['last_probe_status'] = status
+            change = None
+            # Серия неудачных проверок, от которой зависит интервал до следующей
+            state['probe_failures'] = 0 if key_error or 200 <= status < 300 else (state['probe_failures'] or 0) + 1
+            if key_error:
+                state['probe_successes'] = 0
+                if state['quarantined_at'] is None:
+                    state['quarantined_at'], state['quarantine_reason'] = time.time(), reason
+                    change = 'quarantined'
+            elif 200 <= status < 300 and state['quarantined_at'] is not None:
+                state['probe_successes'] = (state['probe_successes'] or 0) + 1
+                if state['probe_successes'] >= KEY_PROBE_READMIT_SUCCESSES:
+                    state.update(quarantined_at=None, quarantine_reason=None, probe_successes=0)
+                    change = 'readmitted'
+            conn.execute(
+                "UPDATE api_keys SET last_probe_status = ?, quarantined_at = ?, quarantine_reason = ?, probe_successes = ?, probe_failures = ? WHERE key = ?",
+                (status, state['quarantined_at'], state['quarantine_reason'], state['probe_successes'], state['probe_failures'], key),
+            )
+        return state, change
+    finally:
+        conn.close()
+
+
+def load_probe_states():
+    """Returns {key: probe columns} of all keys, to pick up decisions of other workers."""
+    conn = _connect()
+    try:
+        return {row['key']: _state(row) for row in conn.execute("SELECT * FROM api_keys")}
+    finally:
+        conn.close()
+
+
+async def probe_key(key):
+    """Makes the cheap probe call with the key; returns (status, body), status 0 for network errors."""
+    try:
+        response = await send_upstream_request('GET', f"{GOOGLE_API_BASE_URL}/v1beta/models", headers={'X-Goog-Api-Key': key}, params={'pageSize': '1'})
+    except httpx.HTTPError as e:
+        return 0, (str(e) or type(e).__name__).encode('utf-8')
+    return response.status_code, response.content
+
+
+class KeyProber:
+    """Probes keys in the background so dead keys are found by probes rather than by user requests."""
+
+    def __init__(self):
+        self._urgent = set()
+        self._last_urgent = {}
+        self._wake = None
+
+    def request_probe(self, key):
+        """Asks for an early probe of a key that just failed a user request with a key error."""
+        if self._wake is None:
+            return
+        now = time.monotonic()
+        if now - self._last_urgent.get(key, -URGENT_PROBE_MIN_GAP) < URGENT_PROBE_MIN_GAP:
+            return
+        self._last_urgent[key] = now
+        self._urgent.add(key)
+        self._wake.set()
+
+    async def _probe(self, key, semaphore, delay):
+        # Разброс по времени: проверки пачки не уходят апстриму одновременно
+        await asyncio.sleep(delay)
+        async with semaphore:
+            status, body = await probe_key(key)
+        key_probe_stats['probes'] += 1
+        key_error = is_key_error(status, body)
+        if not key_error and not 200 <= status < 300:
+            key_probe_stats['transient_failures'] += 1
+            logging.info("Проверка ключа %s: ошибка %s, следующая проверка позже", mask_key(key), status)
+        state, change = await asyncio.to_thread(record_probe_result, key, status, key_error, get_error_reason(status, body) if key_error else None)
+        if state is None:
+            return
+        key_scheduler.apply_probe_state(key, state)
+        if change == 'quarantined':
+            key_probe_stats['quarantined'] += 1
+            logging.warning("Ключ %s помещен в карантин: %s", mask_key(key), state['quarantine_reason'])
+        elif change == 'readmitted':
+            key_probe_stats['readmitted'] += 1
+            logging.info("Ключ %s вышел из карантина", mask_key(key))
+
+    async def run(self):
+        self._wake = asyncio.Event()
+        semaphore = asyncio.Semaphore(KEY_PROBE_CONCURRENCY)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), PROBE_TICK * random.uniform(0.5, 1.5))
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+                urgent, self._urgent = self._urgent, set()
+                try:
+                    keys = await asyncio.to_thread(claim_due_keys, time.time(), urgent)
+                    await asyncio.gather(*(self._probe(key, semaphore, 0 if key in urgent else random.uniform(0, PROBE_TICK)) for key in keys))
+                    # Решения других воркеров о карантине
+                    for key, state in (await asyncio.to_thread(load_probe_states)).items():
+                        key_scheduler.apply_probe_state(key, state)
+                except sqlite3.Error as e:
+                    logging.error("Error probing keys: %s", e)
+        finally:
+            self._wake = None
+
+
+key_prober = KeyProber()
+
+
+async def run_key_prober():
+    """Background task that probes keys until cancelled."""
+    if not KEY_PROBE_ENABLED:
+        return
+    await key_prober.run()
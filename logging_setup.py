@@ -0,0 +1,139 @@
+import os
+import re
+import sys
+import json
+import uuid
+import queue
+import atexit
+import logging
+import logging.handlers
+import contextvars
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# text - привычный формат строк, json - одна JSON запись на строку
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+# Логировать каждый N-й чанк стрима на уровне DEBUG; 0 - не логировать чанки
+LOG_STREAM_CHUNK_SAMPLE = int(os.environ.get('LOG_STREAM_CHUNK_SAMPLE', '100'))
+
+log_levels = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL
+}
+
+request_id_var = contextvars.ContextVar('request_id', default='-')
+
+# Google API ключи, ключ в query string и значения заголовков с ключами
+SECRET_PATTERNS = [
+    (re.compile(r'AIza[0-9A-Za-z_\-]{35}'), lambda match: mask_key(match.group(0))),
+    (re.compile(r'([?&]key=)([^&\s\'"]+)'), lambda match: match.group(1) + mask_key(match.group(2))),
+    (re.compile(r'((?:x-goog-api-key|x-api-key|authorization)[\'"]?\s*[:=]\s*[\'"]?(?:Bearer\s+)?)([^\s\'",}]+)', re.IGNORECASE), lambda match: match.group(1) + mask_key(match.group(2))),
+]
+
+SENSITIVE_HEADERS = {'x-goog-api-key', 'x-api-key', 'authorization'}
+
+_listener = None
+
+
+def mask_key(key):
+    """Shortens an API key to a form that is safe to show in logs and metrics."""
+    if not key:
+        return str(key)
+    if len(key) <= 10:
+        return '***'
+    return f"{key[:4]}...{key[-4:]}"
+
+
+def mask_secrets(text):
+    for pattern, replacement in SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def mask_headers(headers):
+    """Returns headers as a dict with API key values masked, for debug logging."""
+    return {key: mask_key(value) if key.lower() in SENSITIVE_HEADERS else value for key, value in headers.items()}
+
+
+def new_request_id(incoming=None):
+    """Sets the request id for the current task (taken from X-Request-ID if sane) and returns it."""
+    if incoming and len(incoming) <= 64 and incoming.isprintable():
+        request_id = incoming
+    else:
+        request_id = uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+    return request_id
+
+
+class RequestIdFilter(logging.Filter):
+    """Attaches the current request id; runs in the logging thread of the caller, so it must stay cheap."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class MaskingFormatter(logging.Formatter):
+    def format(self, record):
+        return mask_secrets(super().format(record))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return mask_secrets(json.dumps(entry, ensure_ascii=False))
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that leaves message formatting to the listener thread.
+
+    The standard QueueHandler formats the message in the caller's thread, which is
+    the event loop here; this one only enqueues the record.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging():
+    """Routes all logging through a queue to a background thread writing to stderr."""
+    global _listener
+    if _listener is not None:
+        return
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(MaskingFormatter('%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(log_levels.get(LOG_LEVEL, logging.INFO))
+    # httpx/httpcore пишут по строке на каждый запрос к апстриму; прокси логирует это сам
+    for name in ('httpx', 'httpcore', 'hpack'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flushes queued records and stops the background logging thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,232 +1,575 @@
-import os
 import logging
-import codecs
 from quart import Quart, request, Response
-import requests
+import time
+import httpx
 import asyncio
-from key_manager import select_best_key, update_key_stats, initialize_db, add_keys_from_env, remove_keys_from_env, get_sorted_keys, DATABASE_FILE
+from key_manager import select_best_key, update_key_stats, get_active_key_count, get_sorted_keys, key_scheduler, run_key_stats_flusher, DATABASE_FILE
 from web_interface import register_web_interface
+from logging_setup import setup_logging, new_request_id, mask_key, mask_headers
+from rate_limits import rate_limiter, get_model_from_subpath, get_route_from_subpath, extract_total_tokens, parse_retry_delay, track_stream_usage
+from response_cache import RESPONSE_CACHE_ENABLED, response_cache, is_cacheable, make_cache_key, run_disk_cache_sweeper
+from hedging import HEDGING_ENABLED, run_hedged, hedge_stats
+from metrics import requests_total, request_duration, requests_in_flight, upstream_attempts, keys_gauge, admission_gauge, observe_upstream_response, observe_stream, monitor_event_loop_lag, render_metrics, render_stats, model_labels, route_label
+from singleflight import SINGLE_FLIGHT_ENABLED, SINGLE_FLIGHT_STREAMING, SINGLE_FLIGHT_ROUTES, SharedResponse, single_flight
+from upstream import GOOGLE_API_BASE_URL, STREAM_CHUNK_SIZE, start_upstream_client, close_upstream_client, send_upstream_request, relay_stream, finish_stream, StreamBody, release_after_stream, read_body, upstream_accept_encoding, get_passthrough_encoding, make_decoder, decode_body, decode_for_client
+from shared_state import KEY_STATE_BACKEND, run_key_state_sync, key_state_stats
+from request_body import MAX_REQUEST_BODY_SIZE, RequestBody, DerivedRequest, is_small_body
+from embed_batching import EMBED_BATCHING_ENABLED, embed_batcher, embed_batch_stats, parse_embed_request, build_batch_body, split_batch_response
+from bulk import BULK_RATE_LIMIT_WAIT, BulkInputError, bulk_stats, get_bulk_concurrency, iter_bulk_items, run_bulk
+from key_probe import KEY_PROBE_ENABLED, key_prober, key_probe_stats, is_key_error, run_key_prober
+from request_timing import SERVER_TIMING_ENABLED, timing_history, timed, record_phase, time_stream, make_connect_trace, request_timing_var
+from key_config import setup_keys, is_user_key, run_key_config_watcher, key_config_stats
+from context_cache import CONTEXT_CACHE_ENABLED, CONTEXT_CACHE_ROUTES, context_cache, context_cache_stats
+from admission import ADMISSION_ENABLED, AdmissionRejected, admission, admission_stats
+from uploads import UPLOAD_START_ATTEMPTS, UPLOAD_KEY_PARAM, UPLOAD_SESSION_REQUIRE_KEY, is_upload_session_request, get_public_base_url, rewrite_upload_url, find_pinned_key
 
 app = Quart(__name__, template_folder='.')
+# Большие тела (inline видео, PDF, загрузка файлов) передаются апстриму потоком, поэтому лимит Quart в 16 МБ не нужен
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BODY_SIZE or None
 
 # Register web interface routes and filters
 register_web_interface(app)
 
-# Initial database setup and key loading
-initialize_db()
-add_keys_from_env()
-remove_keys_from_env()
-
 # http://localhost:5001
-# Настройка логирования
-log_level = os.environ.get('LOG_LEVEL', 'DEBUG').upper()
-log_levels = {
-    'DEBUG': logging.DEBUG,
-    'INFO': logging.INFO,
-    'WARNING': logging.WARNING,
-    'ERROR': logging.ERROR,
-    'CRITICAL': logging.CRITICAL
-}
-logging.basicConfig(level=log_levels.get(log_level, logging.DEBUG), format='%(asctime)s - %(levelname)s - %(message)s')
-
-# Получение ключей из переменных окружения
-USER_KEYS = [key.strip() for key in os.environ.get("USER_KEYS", "").split("|") if key.strip()]
+# Настройка логирования: запись в stderr идет из фонового потока
+setup_logging()
+
+# Создание БД и загрузка ключей из переменных окружения и KEYS_FILE, один раз на процесс
+setup_keys()
+
+# Фоновые задачи воркера, запускаются в startup и останавливаются в shutdown
+background_tasks = []
+
+
+@app.before_serving
+async def startup():
+    """Creates long-lived resources shared by all requests of this worker."""
+    await start_upstream_client()
+    key_scheduler.load()
+    background_tasks.append(asyncio.create_task(run_key_stats_flusher()))
+    background_tasks.append(asyncio.create_task(monitor_event_loop_lag()))
+    background_tasks.append(asyncio.create_task(run_key_state_sync()))
+    background_tasks.append(asyncio.create_task(run_key_prober()))
+    background_tasks.append(asyncio.create_task(run_key_config_watcher()))
+    background_tasks.append(asyncio.create_task(run_disk_cache_sweeper()))
+
+
+@app.after_serving
+async def shutdown():
+    """Releases long-lived resources on worker shutdown."""
+    await close_upstream_client()
+    # Отмена задач приводит к финальной записи статистики ключей в БД
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+
+def is_streaming_request(request, subpath):
+    """Checks whether the client expects a streaming (SSE) response."""
+    return request.headers.get('Accept') == 'text/event-stream' or request.args.get('alt') == 'sse' or 'streamGenerateContent' in subpath
+
+
+async def make_google_api_request(api_key, subpath, request, key_location, on_usage=None, on_done=None, request_body=None, api_prefix='v1beta'):
+    """Helper function to make the request to Google API.
+
+    `on_usage` is called with `usageMetadata.totalTokenCount` of a successful response.
+    `on_done` is called once the upstream exchange is over; for streams that is when the stream ends.
+    `request_body` is a RequestBody shared by retries; by default the body is sent once, without spooling.
+    """
+    if request_body is None:
+        request_body = RequestBody(request, replayable=False)
+    # Для успешного стрима on_done вызывается по его окончании, иначе - при выходе из функции
+    stream_started = False
+    try:
+        response, success = await _send_google_api_request(api_key, subpath, request, key_location, on_usage, on_done, request_body, api_prefix)
+        stream_started = success and on_done is not None and response.mimetype == 'text/event-stream'
+        return response, success
+    finally:
+        if on_done is not None and not stream_started:
+            on_done()
+
+
+async def _send_google_api_request(api_key, subpath, request, key_location, on_usage, on_done, request_body, api_prefix):
+    """Does the upstream call of make_google_api_request(); a successful stream calls `on_done` when it ends."""
+    google_api_url = f"{GOOGLE_API_BASE_URL}/{api_prefix}/{subpath}"
+    route = get_route_from_subpath(subpath)
+    model = get_model_from_subpath(subpath) or ''
+    logging.debug("URL для запроса к Google API: %s", google_api_url)
+
+    # Удаляем заголовки, которые могут вызвать проблемы или не нужны для проксирования, включая Remote-Addr
+    # Восстанавливаем Accept-Encoding для корректной работы сжатия
+    # Удаляем заголовки, которые могут вызвать проблемы или не нужны для проксирования, включая Remote-Addr и Authorization
+    # Восстанавливаем Accept-Encoding для корректной работы сжатия
+    headers = {key: value for key, value in request.headers if key.lower() not in ['host', 'x-api-key', 'x-goog-api-key', 'remote-addr', 'authorization', 'accept-encoding']}
+    # Ответ запрашивается сжатым: в кодировке клиента, если прокси тоже умеет ее распаковать
+    client_accept_encoding = request.headers.get('Accept-Encoding')
+    headers['Accept-Encoding'] = upstream_accept_encoding(client_accept_encoding)
+    params = request.args.copy()
+
+    # Ключ клиента и служебный параметр прокси апстриму не передаются
+    for name in ('key', UPLOAD_KEY_PARAM):
+        if name in params:
+            del params[name]
+
+    if key_location == 'header_bearer' or key_location == 'query':
+        params['key'] = api_key
+        logging.debug("Ключ добавлен в параметры запроса к Google API")
+    elif key_location == 'header_goog':
+        headers['X-Goog-Api-Key'] = api_key
+        logging.debug("Ключ добавлен в заголовок X-Goog-Api-Key для запроса к Google API")
+    elif key_location == 'header_xapi':
+         headers['X-API-Key'] = api_key
+         logging.debug("Ключ добавлен в заголовок X-API-Key для запроса к Google API")
+
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug("Заголовки запроса к Google API: %s", mask_headers(headers))
+        logging.debug("Параметры запроса к Google API: %s", [(name, mask_key(value) if name == 'key' else value) for name, value in params.items(multi=True)])
+
+    try:
+        is_streaming = request.headers.get('Accept') == 'text/event-stream' or request.args.get('alt') == 'sse' or 'streamGenerateContent' in subpath
+        logging.debug("Обработка %s запроса", 'стримингового' if is_streaming else 'обычного')
+
+        # Большое тело не читается в память: оно передается апстриму по мере получения от клиента
+        request_data = await request_body.content()
+
+        # Запрос идет через общий пул соединений (keep-alive, HTTP/2), без потоков из executor
+        sent_at = time.monotonic()
+        req = await send_upstream_request(
+            request.method,
+            google_api_url,
+            headers=headers,
+            params=list(params.items(multi=True)),
+            content=request_data,
+            content_length=request_body.content_length if request_data is not None else None,
+            # Тело читается отдельно: сжатое можно передать клиенту без распаковки
+            stream=True,
+            trace=make_connect_trace() if request_timing_var.get() is not None else None,
+        )
+        ttfb = time.monotonic() - sent_at
+        record_phase('upstream', ttfb)
+        observe_upstream_response(api_key, route, model, ttfb, not req.is_error)
+        if req.is_error:
+            # Читаем тело ошибки и освобождаем соединение
+            error_body = await req.aread()
+            await req.aclose()
+            logging.error("Ошибка при запросе к Google API с ключом %s: %s", mask_key(api_key), req.status_code)
+            return Response(error_body, status=req.status_code), False
+        logging.info("Получен ответ от Google API (%s): %s", 'стриминг' if is_streaming else 'обычный', req.status_code)
+        # Задержка ответа влияет на выбор ключа (ключи пользователей планировщик пропускает)
+        key_scheduler.record_latency(api_key, route, model, ttfb)
+
+        # Сжатое тело уходит клиенту как есть, если он принимает эту кодировку; иначе httpx его распаковывает
+        passthrough_encoding = get_passthrough_encoding(req, client_accept_encoding)
+        dropped_headers = ('transfer-encoding', 'content-length', 'connection') if passthrough_encoding else ('transfer-encoding', 'content-encoding', 'content-length', 'connection')
+        response_headers = {key: value for key, value in req.headers.items() if key.lower() not in dropped_headers}
+        if 'vary' not in (key.lower() for key in response_headers):
+            response_headers['Vary'] = 'Accept-Encoding'
+
+        if is_streaming:
+            # Байты апстрима пересылаются клиенту как есть, без декодирования и перекодирования.
+            # Google отдает SSE в UTF-8, поэтому явно указываем кодировку.
+            response_headers['Content-Type'] = 'text/event-stream; charset=utf-8'
+
+            body = relay_stream(req, chunk_size=STREAM_CHUNK_SIZE, raw=passthrough_encoding is not None)
+            if on_usage is not None:
+                body = track_stream_usage(body, on_usage, make_decoder(passthrough_encoding) if passthrough_encoding else None)
+            body = observe_stream(body, route, model)
+            timing = request_timing_var.get()
+            if timing is not None:
+                body = time_stream(body, timing)
+            if on_done is not None:
+                body = finish_stream(body, on_done)
+
+            async def close_unstarted():
+                # Генераторы выше не запускались, и их finally не выполнятся
+                await req.aclose()
+                if on_done is not None:
+                    on_done()
+
+            response = Response(StreamBody(body, close_unstarted), headers=response_headers)
+            # Стрим может длиться дольше RESPONSE_TIMEOUT Quart (60 секунд по умолчанию)
+            response.timeout = None
+            return response, True # Return response and success status
+        else:
+            with timed('upstream_body'):
+                content = await read_body(req, raw=passthrough_encoding is not None)
+            if on_usage is not None:
+                on_usage(extract_total_tokens(decode_body(content, passthrough_encoding) if passthrough_encoding else content))
+            return Response(content, status=req.status_code, headers=response_headers), True # Return response and success status
+
+    except httpx.HTTPError as e:
+        observe_upstream_response(api_key, route, model, time.monotonic() - sent_at, False)
+        logging.error("Ошибка при запросе к Google API с ключом %s: %s", mask_key(api_key), e)
+        return Response(str(e) or type(e).__name__, status=502 if not isinstance(e, httpx.TimeoutException) else 504), False # Return error response and failure status
+
+
+async def forward_with_key_pool(subpath, request, key_location):
+    """Sends the request upstream with Google keys from the pool, failing over between keys."""
+    model = get_model_from_subpath(subpath)
+    with timed('keys'):
+        current_key = select_best_key(model=model)
+
+    if current_key is None:
+        if get_active_key_count() == 0:
+            logging.warning("Нет доступных Google API ключей в БД.")
+            return Response("No available Google API keys", status=500)
+        # Все ключи исчерпали квоту или на паузе после 429
+        retry_after = rate_limiter.seconds_until_available(get_sorted_keys(), model)
+        logging.warning("Все Google API ключи исчерпали лимиты для модели %s, повтор через %.0f с", model, retry_after)
+        return Response("All Google API keys are rate limited", status=429, headers={'Retry-After': str(max(1, int(retry_after + 0.5)))})
+
+    route = get_route_from_subpath(subpath)
+    # Тело понадобится повторно при переключении ключа или хеджировании: большие тела пишутся во временный файл
+    request_body = RequestBody(request, replayable=True)
+    try:
+        return await _forward_with_retries(subpath, request, key_location, model, route, current_key, request_body)
+    finally:
+        request_body.close()
+
+
+async def send_with_pool_key(api_key, subpath, request, key_location, model, request_body):
+    """One upstream attempt with a pool key and its own accounting, so a cancelled hedge attempt is not counted."""
+    rate_limiter.record_request(api_key, model)
+    # Без лимита TPM расход токенов не нужен, и сжатый ответ не приходится распаковывать
+    on_usage = (lambda total_tokens: rate_limiter.record_usage(api_key, model, total_tokens)) if rate_limiter.tracks_tokens(model) else None
+    # Ключ считается занятым до конца ответа (для стрима - до конца стрима), это видят и другие воркеры
+    key_scheduler.acquire(api_key)
+    on_done = lambda: key_scheduler.release(api_key)
+    response, success = await make_google_api_request(api_key, subpath, request, key_location, on_usage=on_usage, on_done=on_done, request_body=request_body) # Await the async function
+    with timed('stats'):
+        update_key_stats(api_key, success=success)
+    if response.status_code == 429:
+        # Ключ исчерпал квоту: ставим на паузу
+        error_body = (await response.get_data()).decode('utf-8', errors='replace')
+        rate_limiter.record_rate_limited(api_key, model, parse_retry_delay(error_body))
+    elif KEY_PROBE_ENABLED and response.status_code in (400, 401, 403) and is_key_error(response.status_code, await response.get_data()):
+        # Похоже, ключ недействителен: проверяем его сразу, не дожидаясь плановой проверки
+        key_prober.request_probe(api_key)
+    return response, success
+
+
+async def _forward_with_retries(subpath, request, key_location, model, route, current_key, request_body):
+    """Failover loop of forward_with_key_pool()."""
+    attempt = lambda api_key: send_with_pool_key(api_key, subpath, request, key_location, model, request_body)
+
+    tried_keys = set()
+    current_key_usage_count = 0
+
+    last_exception = None
+    last_status = 500
+    attempts = 0
+    max_attempts = get_active_key_count() * 2 # Allow 2 attempts per key
+
+    while attempts < max_attempts and current_key is not None:
+        logging.info("Попытка %d/%d с Google API ключом из БД: %s", attempts + 1, max_attempts, mask_key(current_key))
+        if HEDGING_ENABLED:
+            pick_hedge_key = lambda busy_keys: select_best_key(exclude=tried_keys | busy_keys, model=model)
+            used_key, response, success = await run_hedged(route, current_key, attempt, pick_hedge_key)
+        else:
+            used_key = current_key
+            response, success = await attempt(current_key)
+
+        if success:
+            logging.info("Успешный запрос с ключом: %s", mask_key(used_key))
+            upstream_attempts.observe(attempts + 1, route_label(route))
+            return response
+        else:
+            last_exception_bytes = await response.data # Capture the error message bytes
+            last_exception = last_exception_bytes.decode('utf-8') # Decode the bytes
+            last_status = response.status_code
+            logging.warning("Неудачный запрос с ключом %s. Ошибка: %s", mask_key(used_key), last_exception)
+
+            current_key_usage_count += 1
+            if response.status_code == 429:
+                # Не тратим на ключ на паузе вторую попытку
+                tried_keys.add(used_key)
+                current_key_usage_count = 2
+            if current_key_usage_count >= 2:
+                # Переходим к следующему лучшему ключу, который еще не пробовали
+                tried_keys.add(current_key)
+                with timed('keys'):
+                    current_key = select_best_key(exclude=tried_keys, model=model)
+                current_key_usage_count = 0 # Reset usage count for the next key
+        attempts += 1
+
+    upstream_attempts.observe(attempts, route_label(route))
+    logging.error("Все доступные Google API ключи исчерпаны или не работают после всех попыток.")
+    if last_status == 429:
+        retry_after = rate_limiter.seconds_until_available(get_sorted_keys(), model)
+        return Response(last_exception, status=429, headers={'Retry-After': str(max(1, int(retry_after + 0.5)))})
+    return Response(last_exception if last_exception else "No available Google API keys", status=500)
+
+
+async def forward_batched_embedding(subpath, request, key_location):
+    """Sends an embedContent request upstream in one batchEmbedContents call with concurrent ones for the same model."""
+    item = parse_embed_request(subpath, await request.get_data())
+    if item is None:
+        return await forward_with_key_pool(subpath, request, key_location)
+    model_path = subpath.rsplit(':', 1)[0]
+    # Ответ зависит от параметров запроса (например, alt), поэтому пачки собираются отдельно для разных параметров
+    group = (model_path, tuple(sorted((name, value) for name, value in request.args.items(multi=True) if name != 'key')))
+
+    async def send(items):
+        if len(items) == 1:
+            # Одиночный запрос отправляется как есть
+            return [None]
+        logging.info("Отправка %d запросов embedContent одной пачкой: %s", len(items), model_path)
+        batch_request = DerivedRequest(request, build_batch_body(items))
+        response = await forward_with_key_pool(f"{model_path}:batchEmbedContents", batch_request, key_location)
+        headers = {key: value for key, value in response.headers.items() if key.lower() != 'content-length'}
+        return split_batch_response(response.status_code, headers, await response.get_data(), len(items))
+
+    result = await embed_batcher.submit(group, get_model_from_subpath(subpath) or '', item, send)
+    if result is None:
+        # Пачку отклонили целиком: запрос отправляется отдельно, чтобы получить свой ответ или ошибку
+        return await forward_with_key_pool(subpath, request, key_location)
+    status, headers, body = result
+    return Response(body, status=status, headers=headers)
+
+
+async def forward_with_context_cache(subpath, request, key_location):
+    """Sends a generateContent request that refers to the cachedContents entry of its prompt prefix, if there is one.
+
+    The entry belongs to the key that created it, so the request goes with that key only;
+    if the key is unavailable or the call fails, the original request goes through the pool.
+    """
+    model = get_model_from_subpath(subpath)
+    prepared = context_cache.prepare(subpath, await request.get_data(), lambda: select_best_key(model=model))
+    if prepared is None:
+        return await forward_with_key_pool(subpath, request, key_location)
+    entry, body = prepared
+    if key_scheduler.is_selectable(entry.api_key) and rate_limiter.is_available(entry.api_key, model):
+        cached_request = DerivedRequest(request, body, for_client=True)
+        request_body = RequestBody(cached_request, replayable=False)
+        try:
+            response, success = await send_with_pool_key(entry.api_key, subpath, cached_request, key_location, model, request_body)
+        finally:
+            request_body.close()
+        if success:
+            return response
+        error_body = await response.get_data()
+        if response.status_code in (403, 404) or b'cachedContent' in error_body:
+            # Кэш удален или истек в Google
+            context_cache.invalidate(entry)
+        logging.info("Запрос с кэшем контекста %s не выполнен (%s), отправка без кэша", entry.name, response.status_code)
+    context_cache_stats['fallbacks'] += 1
+    return await forward_with_key_pool(subpath, request, key_location)
+
+
+async def forward_to_upstream(subpath, request, key_location):
+    """Sends the request with pool keys, batching embedContent calls and using context caches when enabled."""
+    if EMBED_BATCHING_ENABLED and request.method == 'POST' and get_route_from_subpath(subpath) == 'embedContent' and is_small_body(request):
+        return await forward_batched_embedding(subpath, request, key_location)
+    if CONTEXT_CACHE_ENABLED and request.method == 'POST' and get_route_from_subpath(subpath) in CONTEXT_CACHE_ROUTES and is_small_body(request):
+        return await forward_with_context_cache(subpath, request, key_location)
+    return await forward_with_key_pool(subpath, request, key_location)
+
+
+def should_coalesce(request, subpath):
+    """Checks whether identical concurrent requests to this route may share one upstream call."""
+    if request.method != 'POST' or get_route_from_subpath(subpath) not in SINGLE_FLIGHT_ROUTES or not is_small_body(request):
+        return False
+    return SINGLE_FLIGHT_STREAMING or not is_streaming_request(request, subpath)
+
+
+async def forward_coalesced(subpath, request, key_location):
+    """Forwards the request through the key pool, sharing the upstream call with identical in-flight requests.
+
+    `request` must be the request object itself, not the `quart.request` proxy: the leader's
+    call may outlive its own request.
+    """
+    request_body = await request.get_data()
+    # Ответ отдается всем участникам как есть, поэтому кодировка ответа должна им всем подходить
+    flight_key = make_cache_key(request.method, subpath, request.args, request_body) + request.headers.get('Accept', '') + request.headers.get('Accept-Encoding', '')
+
+    async def call():
+        return await SharedResponse.from_response(await forward_to_upstream(subpath, request, key_location))
+
+    shared_response, shared = await single_flight.do(flight_key, call)
+    if shared:
+        logging.info("Запрос объединен с уже выполняющимся: %s %s", request.method, subpath)
+    response = shared_response.to_response()
+    if response is None:
+        # Начало общего стрима уже не хранится: делаем свой запрос
+        single_flight.stats['late_joins_refused'] += 1
+        return await forward_to_upstream(subpath, request, key_location)
+    return response
+
+
+async def forward_admitted(user_api_key, subpath, forward):
+    """Runs `forward()` once admission control lets the request through; otherwise answers with 429/503 and Retry-After."""
+    if not ADMISSION_ENABLED:
+        return await forward()
+    try:
+        with timed('admission'):
+            ticket = await admission.acquire(user_api_key, get_route_from_subpath(subpath))
+    except AdmissionRejected as e:
+        logging.warning("Запрос не допущен (%s): %s, повтор через %d с", mask_key(user_api_key), e, e.retry_after)
+        return Response(str(e), status=e.status, headers={'Retry-After': str(e.retry_after)})
+    try:
+        response = await forward()
+    except BaseException:
+        admission.release(ticket)
+        raise
+    ticket.answered(response.status_code)
+    if response.mimetype == 'text/event-stream':
+        # Стрим занимает апстрим до конца, поэтому слот освобождается только по его окончании
+        release_after_stream(response, lambda: admission.release(ticket))
+    else:
+        admission.release(ticket)
+    return response
 
 
 @app.route('/v1beta/<path:subpath>', methods=['GET', 'POST', 'PUT', 'DELETE'])
 async def proxy_gemini_api(subpath):
-    logging.info(f"Получен запрос: {request.method} {request.url}")
-    logging.debug(f"Заголовки запроса: {request.headers}")
-
+    """Proxies a Gemini API call and records request metrics."""
+    return await observe_request(get_route_from_subpath(subpath), get_model_from_subpath(subpath) or '', handle_gemini_api_request(subpath))
+
+
+@app.route('/upload/v1beta/<path:subpath>', methods=['POST', 'PUT'])
+async def proxy_upload_api(subpath):
+    """Proxies a File API upload (resumable protocol included) and records request metrics."""
+    return await observe_request('upload', '', handle_upload_request(subpath))
+
+
+@app.route('/bulk/v1beta/<path:subpath>', methods=['POST'])
+async def proxy_bulk_api(subpath):
+    """Runs many requests to one Gemini API method in one call and records request metrics."""
+    return await observe_request('bulk', get_model_from_subpath(subpath) or '', handle_bulk_request(subpath))
+
+
+async def observe_request(route, model, handling):
+    """Awaits the `handling` coroutine, tagging the response with the request id and recording metrics."""
+    started_at = time.monotonic()
+    # Метрики записываются и для неавторизованных запросов, поэтому метка не может быть любой строкой из пути
+    route = route_label(route)
+    status = 500
+    request_id = new_request_id(request.headers.get('X-Request-ID'))
+    timing = timing_history.start(request_id, request.method, request.path, route)
+    requests_in_flight.inc(route)
+    try:
+        response = await handling
+        status = response.status_code
+        response.headers['X-Request-ID'] = request_id
+        if SERVER_TIMING_ENABLED:
+            response.headers['Server-Timing'] = timing.server_timing()
+        return response
+    finally:
+        timing_history.finish(timing, status)
+        requests_in_flight.dec(route)
+        model_label = model_labels.label(model, status < 400)
+        requests_total.inc(route, model_label, str(status))
+        request_duration.observe(time.monotonic() - started_at, route, model_label, str(status))
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_endpoint():
+    """Exposes metrics of this worker in the Prometheus text format."""
+    active_keys = get_sorted_keys()
+    unavailable_keys = rate_limiter.get_unavailable_keys()
+    cooling_down = sum(1 for key in active_keys if key in unavailable_keys)
+    keys_gauge.set('in_use', value=len(active_keys) - cooling_down)
+    keys_gauge.set('cooling_down', value=cooling_down)
+    quarantined = len(key_scheduler.quarantined_keys())
+    keys_gauge.set('quarantined', value=quarantined)
+    keys_gauge.set('removed', value=key_scheduler.key_count() - len(active_keys) - quarantined)
+
+    if ADMISSION_ENABLED:
+        for state, value in admission.get_state().items():
+            admission_gauge.set(state, value=value)
+
+    extra_lines = render_stats('gemini_proxy_hedge_', hedge_stats)
+    extra_lines += render_stats('gemini_proxy_single_flight_', single_flight.stats)
+    extra_lines += render_stats('gemini_proxy_bulk_', bulk_stats)
+    extra_lines += render_stats('gemini_proxy_embed_', embed_batch_stats)
+    extra_lines += render_stats('gemini_proxy_key_config_', key_config_stats)
+    if ADMISSION_ENABLED:
+        extra_lines += render_stats('gemini_proxy_admission_', admission_stats)
+    if CONTEXT_CACHE_ENABLED:
+        extra_lines += render_stats('gemini_proxy_context_cache_', context_cache_stats)
+    if KEY_PROBE_ENABLED:
+        extra_lines += render_stats('gemini_proxy_key_probe_', key_probe_stats)
+    if KEY_STATE_BACKEND != 'local':
+        extra_lines += render_stats('gemini_proxy_key_state_', key_state_stats)
+    if RESPONSE_CACHE_ENABLED:
+        # Счетчики кэша ответов исторически без суффикса _total; размеры и число записей - gauge
+        cache_stats = response_cache.get_stats()
+        extra_lines += render_stats('gemini_proxy_response_cache_', {name: value for name, value in cache_stats.items() if name in response_cache.stats}, suffix='')
+        extra_lines += render_stats('gemini_proxy_response_cache_', {name: value for name, value in cache_stats.items() if name not in response_cache.stats}, suffix='', metric_type='gauge')
+    return Response(render_metrics(extra_lines), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def get_user_api_key(request):
+    """Finds the client's API key; returns (key, where it was found) or (None, None)."""
     user_api_key = None
     key_location = None # To track where the key was found
 
     if request.headers.get('Authorization', '').startswith('Bearer '):
         user_api_key = request.headers.get('Authorization').split(' ')[1]
         key_location = 'header_bearer'
-        logging.debug(f"API ключ найден в заголовке Authorization (Bearer)")
+        logging.debug("API ключ найден в заголовке Authorization (Bearer)")
     elif request.headers.get('X-Goog-Api-Key'):
         user_api_key = request.headers.get('X-Goog-Api-Key')
         key_location = 'header_goog'
-        logging.debug(f"API ключ найден в заголовке X-Goog-Api-Key")
+        logging.debug("API ключ найден в заголовке X-Goog-Api-Key")
     elif request.headers.get('X-API-Key'):
         user_api_key = request.headers.get('X-API-Key')
         key_location = 'header_xapi'
-        logging.debug(f"API ключ найден в заголовке X-API-Key")
+        logging.debug("API ключ найден в заголовке X-API-Key")
     elif request.args.get('key'):
         user_api_key = request.args.get('key')
         key_location = 'query'
-        logging.debug(f"API ключ найден в параметрах запроса")
-
-    logging.info(f"Получен user_api_key: {user_api_key} из {key_location}")
-
-    google_api_key = None
-
-    async def make_google_api_request(api_key, subpath, request, key_location):
-        """Helper function to make the request to Google API."""
-        google_api_url = f"https://generativelanguage.googleapis.com/v1beta/{subpath}"
-        logging.debug(f"URL для запроса к Google API: {google_api_url}")
-
-        # Удаляем заголовки, которые могут вызвать проблемы или не нужны для проксирования, включая Remote-Addr
-        # Восстанавливаем Accept-Encoding для корректной работы сжатия
-        # Удаляем заголовки, которые могут вызвать проблемы или не нужны для проксирования, включая Remote-Addr и Authorization
-        # Восстанавливаем Accept-Encoding для корректной работы сжатия
-        headers = {key: value for key, value in request.headers if key.lower() not in ['host', 'x-api-key', 'x-goog-api-key', 'remote-addr', 'authorization']}
-        params = request.args.copy()
-
-        if 'key' in params:
-            del params['key']
-
-        if key_location == 'header_bearer' or key_location == 'query':
-            params['key'] = api_key
-            logging.debug("Ключ добавлен в параметры запроса к Google API")
-        elif key_location == 'header_goog':
-            headers['X-Goog-Api-Key'] = api_key
-            logging.debug("Ключ добавлен в заголовок X-Goog-Api-Key для запроса к Google API")
-        elif key_location == 'header_xapi':
-             headers['X-API-Key'] = api_key
-             logging.debug("Ключ добавлен в заголовок X-API-Key для запроса к Google API")
-
-        logging.debug(f"Заголовки запроса к Google API: {headers}")
-        logging.debug(f"Параметры запроса к Google API: {params}")
-
-        try:
-            is_streaming = request.headers.get('Accept') == 'text/event-stream' or request.args.get('alt') == 'sse' or 'streamGenerateContent' in subpath
-            logging.info(f"Обработка {'стримингового' if is_streaming else 'обычного'} запроса")
-
-            # Await request.data before passing it to the synchronous requests call
-            request_data = await request.data
-
-            # Use asyncio.to_thread for the synchronous requests call
-            req = await asyncio.to_thread(
-                requests.request,
-                method=request.method,
-                url=google_api_url,
-                headers=headers,
-                params=params,
-                data=request_data, # Pass the awaited data
-                stream=is_streaming # Set stream based on the condition
-            )
-            req.raise_for_status()
-            logging.info(f"Получен ответ от Google API ({'стриминг' if is_streaming else 'обычный'}): {req.status_code}")
-
-            response_headers = dict(req.headers)
-            if 'Transfer-Encoding' in response_headers:
-                del response_headers['Transfer-Encoding']
-            if 'Content-Encoding' in response_headers:
-                del response_headers['Content-Encoding']
-
-            if is_streaming:
-                # Для текстового стриминга (SSE, streamGenerateContent) ожидаем UTF-8.
-                # Устанавливаем req.encoding, чтобы requests.iter_content(decode_unicode=True) работал корректно.
-                if req.encoding is None or req.encoding.lower() != 'utf-8':
-                    logging.debug(f"Original req.encoding for streaming: '{req.encoding}'. Forcing to 'utf-8'.")
-                    req.encoding = 'utf-8'
-                else:
-                    logging.debug(f"Using req.encoding for streaming: '{req.encoding}'.")
-
-                async def generate():
-                    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace') # Возвращаем 'replace' для большей устойчивости
-                    # Use asyncio.to_thread for iter_content as well
-                    for i, byte_chunk in enumerate(await asyncio.to_thread(req.iter_content, chunk_size=1024, decode_unicode=False)): # Получаем сырые байты
-                         logging.debug(f"Streaming byte_chunk {i}: type={type(byte_chunk)}, len={len(byte_chunk)}, content[:100]='{byte_chunk[:100]}'")
-                         try:
-                             # Декодируем инкрементально. final=False важно для стриминга.
-                             str_chunk = decoder.decode(byte_chunk, final=False)
-                             if str_chunk: # Отдаем только если есть результат декодирования
-                                 logging.debug(f"Manually decoded str_chunk {i} (replace): type={type(str_chunk)}, len={len(str_chunk)}, content[:100]='{str_chunk[:100]}'")
-                                 yield str_chunk
-                         except UnicodeDecodeError as e: # Эта ветка теперь менее вероятна с 'replace', но оставим для полноты
-                             logging.error(f"REPLACE UnicodeDecodeError in manual decode for chunk {i}: {e}. Input bytes: {byte_chunk[:200]}")
-                             # 'replace' должен был справиться, но если ошибка все же возникла, логируем и продолжаем
-                             yield f"ERROR_REPLACE_DECODING_CHUNK_{i}\n"
-                             continue
-                    # После цикла, декодируем все оставшиеся байты в буфере декодера
-                    try:
-                         str_chunk_final = decoder.decode(b'', final=True)
-                         if str_chunk_final:
-                             logging.debug(f"Final manually decoded str_chunk (replace): type={type(str_chunk_final)}, len={len(str_chunk_final)}, content[:100]='{str_chunk_final[:100]}'")
-                             yield str_chunk_final
-                    except UnicodeDecodeError as e: # Аналогично, менее вероятна
-                         logging.error(f"REPLACE UnicodeDecodeError in final manual decode: {e}")
-                         yield "ERROR_REPLACE_DECODING_FINAL_CHUNK\n"
-
-                # Обновляем Content-Type в заголовках ответа, чтобы он точно был UTF-8.
-                # Quart Response будет использовать это для кодирования строк из generate() обратно в байты.
-                # Условие is_streaming уже предполагает текстовый поток (SSE/streamGenerateContent).
-                response_headers['Content-Type'] = 'text/event-stream; charset=utf-8'
-
-                # Content-Length не применим для потоковых ответов и может вызвать проблемы
-                if 'Content-Length' in response_headers:
-                    del response_headers['Content-Length']
-
-                return Response(generate(), headers=response_headers), True # Return response and success status
-            else:
-                return Response(req.content, status=req.status_code, headers=response_headers), True # Return response and success status
-
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Ошибка при запросе к Google API с ключом {api_key}: {e}")
-            # Attempt to get a more specific error message from the response if available
-            error_message = str(e)
-            if e.response is not None:
-                 try:
-                     error_message = e.response.text
-                 except:
-                     pass # Ignore if response text is not accessible
-
-            return Response(error_message, status=e.response.status_code if e.response is not None else 500), False # Return error response and failure status
-
-
-    if user_api_key in USER_KEYS:
-        available_keys = get_sorted_keys()
-
-        if not available_keys:
-            logging.warning("Нет доступных Google API ключей в БД.")
-            return Response("No available Google API keys", status=500)
-
-        current_key_index = 0
-        current_key_usage_count = 0
+        logging.debug("API ключ найден в параметрах запроса")
 
-        last_exception = None
-        attempts = 0
-        max_attempts = len(available_keys) * 2 # Allow 2 attempts per key
+    logging.info("Получен user_api_key: %s из %s", mask_key(user_api_key), key_location)
+    return user_api_key, key_location
 
-        while attempts < max_attempts:
-            # Ensure index is within bounds (in case keys were removed or list changed)
-            if current_key_index >= len(available_keys):
-                current_key_index = 0
-                current_key_usage_count = 0 # Reset usage count when wrapping around
 
-            if not available_keys: # Check if available_keys became empty during attempts
-                 logging.error("Все доступные Google API ключи исчерпаны или не работают после всех попыток.")
-                 return Response(last_exception if last_exception else "No available Google API keys", status=500)
+async def handle_gemini_api_request(subpath):
+    logging.info("Получен запрос: %s %s", request.method, request.path)
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug("Заголовки запроса: %s", mask_headers(request.headers))
 
-            current_key = available_keys[current_key_index]
+    with timed('auth'):
+        user_api_key, key_location = get_user_api_key(request)
+        is_user = is_user_key(user_api_key)
 
-            logging.info(f"Попытка {attempts + 1}/{max_attempts} с Google API ключом из БД: {current_key}")
-            response, success = await make_google_api_request(current_key, subpath, request, key_location) # Await the async function
-            update_key_stats(current_key, success=success)
+    google_api_key = None
 
-            if success:
-                logging.info(f"Успешный запрос с ключом: {current_key}")
-                return response
-            else:
-                last_exception_bytes = await response.data # Capture the error message bytes
-                last_exception = last_exception_bytes.decode('utf-8') # Decode the bytes
-                logging.warning(f"Неудачный запрос с ключом {current_key}. Ошибка: {last_exception}")
-
-                current_key_usage_count += 1
-                if current_key_usage_count >= 2:
-                    current_key_index += 1
-                    current_key_usage_count = 0 # Reset usage count for the next key
-            attempts += 1
-
-        logging.error("Все доступные Google API ключи исчерпаны или не работают после всех попыток.")
-        return Response(last_exception, status=500)
+    if is_user:
+        cache_key = None
+        # Большие тела не кэшируются: для ключа кэша их пришлось бы прочитать в память
+        if RESPONSE_CACHE_ENABLED and is_small_body(request):
+            with timed('body'):
+                request_body = await request.get_data()
+            if is_cacheable(request.method, subpath, request_body):
+                cache_key = make_cache_key(request.method, subpath, request.args, request_body)
+                with timed('cache'):
+                    cached = await response_cache.get(cache_key)
+                if cached is not None:
+                    status, headers, body = cached
+                    # В кэше ответ хранится в том виде, в каком его получил первый клиент
+                    headers, body = decode_for_client(headers, body, request.headers.get('Accept-Encoding'))
+                    logging.info("Ответ взят из кэша: %s %s", request.method, subpath)
+                    return Response(body, status=status, headers=headers + [('X-Cache', 'HIT')])
+
+        # Дальше передается сам объект запроса, а не прокси: пачки и объединенные вызовы могут пережить запрос
+        current_request = request._get_current_object()
+        if SINGLE_FLIGHT_ENABLED and should_coalesce(request, subpath):
+            response = await forward_admitted(user_api_key, subpath, lambda: forward_coalesced(subpath, current_request, key_location))
+        else:
+            response = await forward_admitted(user_api_key, subpath, lambda: forward_to_upstream(subpath, current_request, key_location))
+
+        if cache_key is not None and response.status_code == 200 and response.mimetype != 'text/event-stream':
+            with timed('cache'):
+                await response_cache.put(cache_key, get_route_from_subpath(subpath), response.status_code, list(response.headers.items()), await response.get_data())
+            response.headers['X-Cache'] = 'MISS'
+        return response
 
     elif user_api_key:
         google_api_key = user_api_key
-        logging.info(f"Используется user_api_key как Google API ключ: {google_api_key}")
+        logging.info("Используется user_api_key как Google API ключ: %s", mask_key(google_api_key))
 
         if not google_api_key:
             logging.warning("API ключ отсутствует")
@@ -239,3 +582,112 @@ async def proxy_gemini_api(subpath):
     else:
         logging.warning("API ключ отсутствует")
         return Response("API key is missing", status=401)
+
+
+async def start_upload_with_key_pool(subpath, request, key_location):
+    """Starts an upload with a Google key from the pool, failing over to other keys; returns (response, key)."""
+    request_body = RequestBody(request, replayable=True)
+    tried_keys = set()
+    response = Response("No available Google API keys", status=500)
+    api_key = None
+    try:
+        for _ in range(UPLOAD_START_ATTEMPTS):
+            api_key = select_best_key(exclude=tried_keys)
+            if api_key is None:
+                break
+            tried_keys.add(api_key)
+            key_scheduler.acquire(api_key)
+            response, success = await make_google_api_request(api_key, subpath, request, key_location, on_done=lambda key=api_key: key_scheduler.release(key), request_body=request_body, api_prefix='upload/v1beta')
+            update_key_stats(api_key, success=success)
+            if success:
+                break
+            logging.warning("Не удалось начать загрузку с ключом %s: %s", mask_key(api_key), response.status_code)
+        return response, api_key
+    finally:
+        request_body.close()
+
+
+async def handle_upload_request(subpath):
+    logging.info("Получен запрос на загрузку: %s %s", request.method, request.path)
+    user_api_key, key_location = get_user_api_key(request)
+
+    if is_upload_session_request(request.args):
+        pinned_key = find_pinned_key(request.args, key_scheduler.all_keys())
+        if pinned_key is not None:
+            if UPLOAD_SESSION_REQUIRE_KEY and not is_user_key(user_api_key):
+                # Иначе upload_id из ссылки сам по себе давал бы доступ к ключу из пула
+                logging.warning("Запрос сессии загрузки без ключа пользователя прокси")
+                return Response("A proxy user key is required", status=401)
+            api_key, key_location = pinned_key, 'header_goog'
+        elif request.args.get(UPLOAD_KEY_PARAM):
+            logging.warning("Ключ сессии загрузки не найден в пуле")
+            return Response("Upload session key is not in the key pool", status=404)
+        elif is_user_key(user_api_key):
+            # Ключ пользователя прокси Google не передается
+            api_key, key_location = None, None
+        else:
+            api_key = user_api_key
+        key_scheduler.acquire(api_key)
+        # Данные файла передаются потоком одним запросом, без копии на диске: ключ сессии заменить нельзя
+        response, success = await make_google_api_request(api_key, subpath, request, key_location, on_done=lambda: key_scheduler.release(api_key), api_prefix='upload/v1beta')
+        update_key_stats(api_key, success=success)
+        return response
+
+    if is_user_key(user_api_key):
+        response, pinned_key = await start_upload_with_key_pool(subpath, request, key_location)
+    elif user_api_key:
+        pinned_key = None
+        response, success = await make_google_api_request(user_api_key, subpath, request, key_location, api_prefix='upload/v1beta')
+        update_key_stats(user_api_key, success=success)
+    else:
+        logging.warning("API ключ отсутствует")
+        return Response("API key is missing", status=401)
+
+    upload_url = response.headers.get('X-Goog-Upload-URL')
+    if upload_url:
+        # Дальнейшие запросы сессии идут через прокси и привязаны к ключу, которым она начата
+        response.headers['X-Goog-Upload-URL'] = rewrite_upload_url(upload_url, get_public_base_url(request), pinned_key)
+    return response
+
+
+async def handle_bulk_request(subpath):
+    """Sends every item of a JSON array or NDJSON body to `subpath` with pool keys; results are streamed as NDJSON.
+
+    Each item goes through forward_with_key_pool() on its own, so it fails over between
+    keys like a separate request. Result lines carry the item index and come in completion order.
+    """
+    logging.info("Получен bulk запрос: %s %s", request.method, request.path)
+    user_api_key, key_location = get_user_api_key(request)
+    if not is_user_key(user_api_key):
+        logging.warning("Bulk запрос без ключа пользователя прокси")
+        return Response("A proxy user key is required", status=401)
+    if is_streaming_request(request, subpath):
+        return Response("Streaming methods are not supported in bulk requests", status=400)
+
+    try:
+        concurrency = get_bulk_concurrency(request.args)
+        items = await iter_bulk_items(request)
+    except BulkInputError as e:
+        return Response(str(e), status=400)
+    # Параметр concurrency относится к прокси и апстриму не передается
+    item_args = request.args.copy()
+    item_args.pop('concurrency', None)
+    current_request = request._get_current_object()
+
+    async def run_item(index, body):
+        waited = 0.0
+        while True:
+            item_request = DerivedRequest(current_request, body, item_args)
+            response = await forward_admitted(user_api_key, subpath, lambda: forward_with_key_pool(subpath, item_request, key_location))
+            retry_after = response.headers.get('Retry-After')
+            if response.status_code not in (429, 503) or retry_after is None or waited >= BULK_RATE_LIMIT_WAIT:
+                return response.status_code, await response.get_data()
+            # Все ключи исчерпали лимиты или прокси перегружен: элемент ждет, а не возвращает ошибку
+            delay = min(float(retry_after), BULK_RATE_LIMIT_WAIT - waited)
+            await asyncio.sleep(delay)
+            waited += delay
+
+    response = Response(run_bulk(items, run_item, concurrency), content_type='application/x-ndjson')
+    # Bulk запрос может выполняться дольше RESPONSE_TIMEOUT Quart
+    response.timeout = None
+    return response
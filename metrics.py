@@ -0,0 +1,199 @@
+import os
+import time
+import asyncio
+from bisect import bisect_left
+from logging_setup import mask_key
+
+# Все метрики обновляются только из потока event loop, поэтому блокировки не нужны:
+# запись - это поиск в словаре и увеличение числа.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+ATTEMPT_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 32)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 100)
+FILL_RATIO_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 1)
+EVENT_LOOP_LAG_INTERVAL = 0.5
+# Сколько разных моделей получают свою метку model; остальные учитываются как "other"
+METRICS_MAX_MODELS = int(os.environ.get('METRICS_MAX_MODELS', '50'))
+
+# Методы API (и маршруты прокси), которые получают свою метку route; остальные пути учитываются как "other"
+KNOWN_ROUTES = frozenset({
+    'generateContent', 'streamGenerateContent', 'countTokens', 'embedContent', 'batchEmbedContents',
+    'batchGenerateContent', 'generateAnswer', 'predict', 'predictLongRunning',
+    'models', 'tunedModels', 'cachedContents', 'files', 'operations', 'batches', 'upload', 'bulk',
+})
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, *labels, value):
+        self._values[labels] = value
+
+    def dec(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, *labels):
+        series = self._values.get(labels)
+        if series is None:
+            # Счетчики по корзинам (последняя - +Inf), сумма наблюдений
+            series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format_value(bound)
+                bucket_label = 'le="' + le + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class ModelLabels:
+    """Bounds the values of the `model` label, which comes from the client's request path.
+
+    A model gets its own label once the upstream answered a request for it successfully,
+    for at most `max_models` models; any other model is reported as `other`.
+    """
+
+    def __init__(self, max_models=METRICS_MAX_MODELS):
+        self.max_models = max_models
+        self._known = set()
+
+    def label(self, model, success=False):
+        if not model or model in self._known:
+            return model
+        if success and len(self._known) < self.max_models:
+            self._known.add(model)
+            return model
+        return 'other'
+
+
+model_labels = ModelLabels()
+
+
+def route_label(route):
+    """Bounds the `route` label, which comes from the client's request path, to KNOWN_ROUTES and `other`."""
+    return route if route in KNOWN_ROUTES else 'other'
+
+requests_total = Counter('gemini_proxy_requests_total', 'Proxied requests by API method, model and status.', ('route', 'model', 'status'))
+request_duration = Histogram('gemini_proxy_request_duration_seconds', 'Time until the response headers are sent to the client.', ('route', 'model', 'status'))
+requests_in_flight = Gauge('gemini_proxy_requests_in_flight', 'Requests being processed (until response headers).', ('route',))
+streams_in_flight = Gauge('gemini_proxy_streams_in_flight', 'Streaming responses being relayed to clients.', ('route',))
+upstream_ttfb = Histogram('gemini_proxy_upstream_ttfb_seconds', 'Time from sending the upstream request to receiving its headers.', ('route', 'model'))
+stream_duration = Histogram('gemini_proxy_stream_duration_seconds', 'Total duration of relayed upstream streams.', ('route', 'model'))
+upstream_attempts = Histogram('gemini_proxy_upstream_attempts_per_request', 'Upstream attempts (including retries on other keys) per request.', ('route',), buckets=ATTEMPT_BUCKETS)
+key_attempts_total = Counter('gemini_proxy_key_attempts_total', 'Upstream attempts per Google key by outcome.', ('key', 'outcome'))
+key_upstream_duration = Histogram('gemini_proxy_key_upstream_duration_seconds', 'Upstream time to headers per Google key.', ('key',))
+keys_gauge = Gauge('gemini_proxy_keys', 'Google keys by state.', ('state',))
+event_loop_lag = Histogram('gemini_proxy_event_loop_lag_seconds', 'How late the event loop wakes up a sleeping task.', buckets=LOOP_LAG_BUCKETS)
+embed_batch_size = Histogram('gemini_proxy_embed_batch_size', 'embedContent requests sent upstream in one batchEmbedContents call.', ('model',), buckets=BATCH_SIZE_BUCKETS)
+embed_batch_fill_ratio = Histogram('gemini_proxy_embed_batch_fill_ratio', 'Batch size divided by EMBED_BATCH_MAX_SIZE.', ('model',), buckets=FILL_RATIO_BUCKETS)
+admission_gauge = Gauge('gemini_proxy_admission', 'Adaptive concurrency limit, admitted requests and queued requests.', ('state',))
+
+ALL_METRICS = [
+    requests_total, request_duration, requests_in_flight, streams_in_flight, upstream_ttfb, stream_duration,
+    upstream_attempts, key_attempts_total, key_upstream_duration, keys_gauge, event_loop_lag,
+    embed_batch_size, embed_batch_fill_ratio, admission_gauge,
+]
+
+
+def observe_upstream_response(api_key, route, model, seconds, success):
+    """Records time to upstream headers and the attempt outcome for a key."""
+    upstream_ttfb.observe(seconds, route_label(route), model_labels.label(model, success))
+    masked_key = mask_key(api_key)
+    key_upstream_duration.observe(seconds, masked_key)
+    key_attempts_total.inc(masked_key, 'success' if success else 'error')
+
+
+async def observe_stream(chunks, route, model):
+    """Passes stream chunks through while tracking in-flight streams and total stream duration."""
+    started_at = time.monotonic()
+    route = route_label(route)
+    streams_in_flight.inc(route)
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+        streams_in_flight.dec(route)
+        stream_duration.observe(time.monotonic() - started_at, route, model_labels.label(model))
+
+
+async def monitor_event_loop_lag(interval=EVENT_LOOP_LAG_INTERVAL):
+    """Background task measuring how much later than requested the loop resumes a sleep."""
+    while True:
+        started_at = time.monotonic()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, time.monotonic() - started_at - interval))
+
+
+def render_stats(prefix, stats, suffix='_total', metric_type='counter'):
+    """Renders a plain stats dict as one unlabeled series per entry, each with its # TYPE line."""
+    lines = []
+    for name, value in stats.items():
+        metric_name = f"{prefix}{name}{suffix}"
+        lines.append(f"# TYPE {metric_name} {metric_type}")
+        lines.append(f"{metric_name} {_format_value(value)}")
+    return lines
+
+
+def render_metrics(extra_lines=()):
+    """Renders all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    lines.extend(extra_lines)
+    return '\n'.join(lines) + '\n'
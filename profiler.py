@@ -0,0 +1,139 @@
+import io
+import os
+import sys
+import time
+import pstats
+import asyncio
+import cProfile
+import threading
+from collections import Counter
+from request_timing import request_timing_stats
+
+# Максимальная длительность профилирования по запросу из веб-интерфейса (в секундах)
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', '60'))
+# Интервал между снимками стека в режиме sampling (в секундах)
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))
+
+PROFILE_MODES = ('sampling', 'deterministic')
+# Как часто проверяется число выполненных запросов при профилировании до N запросов
+REQUEST_COUNT_POLL_INTERVAL = 0.05
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+
+class StackSampler:
+    """Samples the stack of one thread (the event loop's) from a background thread.
+
+    The loop thread is only read, never interrupted, so the overhead on requests is the
+    GIL held by the sampler while it walks one stack every PROFILE_SAMPLE_INTERVAL.
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        # Поток может дописывать последний стек: ждем его вне цикла событий
+        await asyncio.to_thread(self._thread.join)
+
+    def report(self, limit):
+        """Top functions by own and inclusive samples, then the stacks in collapsed format (for flame graphs)."""
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for name in set(stack):
+                inclusive[name] += count
+        total = max(self.samples, 1)
+        lines = [f"{self.samples} samples every {self.interval * 1000:g} ms", '', 'own%   incl%  function']
+        for name, count in own.most_common(limit):
+            lines.append(f"{count * 100 / total:5.1f}  {inclusive[name] * 100 / total:5.1f}  {name}")
+        lines += ['', 'incl%  function']
+        for name, count in inclusive.most_common(limit):
+            lines.append(f"{count * 100 / total:5.1f}  {name}")
+        lines += ['', '# collapsed stacks']
+        for stack, count in self.stacks.most_common():
+            lines.append(f"{';'.join(stack)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+class Profiler:
+    """Profiles this worker on demand: one profile at a time, for a number of seconds or requests."""
+
+    def __init__(self):
+        self.running = False
+
+    async def _wait(self, seconds, requests):
+        deadline = time.monotonic() + min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+        if not requests:
+            await asyncio.sleep(deadline - time.monotonic())
+            return
+        target = request_timing_stats['requests'] + requests
+        while request_timing_stats['requests'] < target and time.monotonic() < deadline:
+            await asyncio.sleep(REQUEST_COUNT_POLL_INTERVAL)
+
+    async def run(self, mode='sampling', seconds=None, requests=None, limit=40):
+        """Profiles for `seconds`, or until `requests` more requests finish (at most PROFILE_MAX_SECONDS); returns a text report.
+
+        `sampling` takes stack snapshots of the event loop thread and is cheap enough for
+        production traffic. `deterministic` runs cProfile on the event loop thread: exact
+        call counts, but every call of every request gets slower while it runs.
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"mode must be one of {', '.join(PROFILE_MODES)}")
+        if self.running:
+            raise ProfilerBusy("A profile is already running on this worker")
+        self.running = True
+        try:
+            started_at = time.monotonic()
+            finished_before = request_timing_stats['requests']
+            if mode == 'sampling':
+                sampler = StackSampler(threading.get_ident())
+                sampler.start()
+                try:
+                    await self._wait(seconds, requests)
+                finally:
+                    await sampler.stop()
+                report = sampler.report(limit)
+            else:
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    await self._wait(seconds, requests)
+                finally:
+                    profile.disable()
+                output = io.StringIO()
+                pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(limit)
+                report = output.getvalue()
+            header = f"# {mode} profile of worker {os.getpid()}: {time.monotonic() - started_at:.1f} s, {request_timing_stats['requests'] - finished_before} requests\n"
+            return header + report
+        finally:
+            self.running = False
+
+
+profiler = Profiler()
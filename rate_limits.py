@@ -0,0 +1,242 @@
+import os
+import re
+import json
+import time
+import logging
+from collections import OrderedDict
+from logging_setup import mask_key
+
+# Лимиты тарифа по моделям: {"<модель или *>": {"rpm": ..., "tpm": ..., "rpd": ...}}, 0 - без ограничения
+# Пример: RATE_LIMITS='{"*": {"rpm": 15, "tpm": 1000000, "rpd": 1500}, "gemini-2.5-pro": {"rpm": 5, "tpm": 250000, "rpd": 100}}'
+RATE_LIMITS = json.loads(os.environ.get('RATE_LIMITS', '{}') or '{}')
+# Пауза для ключа после 429, если Google не прислал retryDelay
+RATE_LIMIT_COOLDOWN = float(os.environ.get('RATE_LIMIT_COOLDOWN', '60'))
+# Сколько пар (ключ, модель) отслеживать самое большее: модель берется из пути клиента, и без предела их число не ограничено
+RATE_LIMIT_MAX_STATES = int(os.environ.get('RATE_LIMIT_MAX_STATES', '10000'))
+# Как часто (в секундах) удалять пары с полными бакетами и без паузы: они ничем не отличаются от новых
+RATE_LIMIT_PRUNE_INTERVAL = 60
+
+MODEL_PATTERN = re.compile(r'^(?:models|tunedModels)/([^:/]+)')
+TOTAL_TOKENS_PATTERN = re.compile(rb'"totalTokenCount"\s*:\s*(\d+)')
+RETRY_DELAY_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)s$')
+
+PERIODS = {'rpm': 60.0, 'tpm': 60.0, 'rpd': 86400.0}
+
+
+def get_model_from_subpath(subpath):
+    """Extracts the model name from a path like `models/gemini-2.0-flash:generateContent`."""
+    match = MODEL_PATTERN.match(subpath)
+    return match.group(1) if match else None
+
+
+def get_route_from_subpath(subpath):
+    """Returns the API method of a path (`generateContent`, `countTokens`, ...) or `models` for listings."""
+    if ':' in subpath:
+        return subpath.rsplit(':', 1)[1]
+    return subpath.split('/', 1)[0]
+
+
+def get_limits_for_model(model):
+    """Returns the configured limits for a model, falling back to the `*` entry."""
+    if model is None:
+        return {}
+    return RATE_LIMITS.get(model, RATE_LIMITS.get('*', {}))
+
+
+def extract_total_tokens(body):
+    """Returns the last `usageMetadata.totalTokenCount` found in a response body, or None."""
+    matches = TOTAL_TOKENS_PATTERN.findall(body)
+    return int(matches[-1]) if matches else None
+
+
+def parse_retry_delay(error_body):
+    """Extracts `retryDelay` (e.g. "39s") from a Gemini 429 error body, in seconds."""
+    try:
+        details = json.loads(error_body).get('error', {}).get('details', [])
+    except (ValueError, AttributeError):
+        return None
+    for detail in details:
+        if isinstance(detail, dict) and 'retryDelay' in detail:
+            match = RETRY_DELAY_PATTERN.match(str(detail['retryDelay']))
+            if match:
+                return float(match.group(1))
+    return None
+
+
+class TokenBucket:
+    """Token bucket refilled continuously up to `capacity` over `period` seconds."""
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def seconds_until_available(self, now):
+        """Seconds until at least one token is in the bucket."""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, amount, now):
+        self.refill(now)
+        # Может уйти в минус: реальный расход токенов становится известен только после ответа
+        self.tokens -= amount
+
+
+class KeyModelState:
+    """Buckets and 429 cooldown of one Google key for one model."""
+
+    def __init__(self, limits):
+        self.buckets = {name: TokenBucket(limit, PERIODS[name]) for name, limit in limits.items() if name in PERIODS and limit}
+        self.cooldown_until = 0.0
+
+    def is_idle(self, now):
+        """True if the state is the same as a fresh one: no cooldown and all buckets full."""
+        if self.cooldown_until > now:
+            return False
+        for bucket in self.buckets.values():
+            bucket.refill(now)
+            if bucket.tokens < bucket.capacity:
+                return False
+        return True
+
+    def seconds_until_available(self, now):
+        wait = max(self.cooldown_until - now, 0.0)
+        for bucket in self.buckets.values():
+            wait = max(wait, bucket.seconds_until_available(now))
+        return wait
+
+
+class RateLimiter:
+    """Tracks per-key, per-model request/token quotas and 429 cooldowns.
+
+    Idle states are dropped every RATE_LIMIT_PRUNE_INTERVAL seconds, and at most `max_states`
+    are kept, evicting the least recently used one.
+    """
+
+    def __init__(self, max_states=RATE_LIMIT_MAX_STATES):
+        self._states = OrderedDict()
+        self.max_states = max_states
+        self._pruned_at = time.monotonic()
+        # Включается синхронизацией состояния ключей (shared_state.py): новые паузы публикуются для других воркеров
+        self.share_cooldowns = False
+        self._new_cooldowns = []
+
+    def _state(self, key, model):
+        state = self._states.get((key, model))
+        if state is not None:
+            self._states.move_to_end((key, model))
+            return state
+        self._prune(time.monotonic())
+        state = KeyModelState(get_limits_for_model(model))
+        self._states[(key, model)] = state
+        if len(self._states) > self.max_states:
+            self._states.popitem(last=False)
+        return state
+
+    def _prune(self, now):
+        if now - self._pruned_at < RATE_LIMIT_PRUNE_INTERVAL:
+            return
+        self._pruned_at = now
+        for key_model in [key_model for key_model, state in self._states.items() if state.is_idle(now)]:
+            del self._states[key_model]
+
+    def is_available(self, key, model):
+        """True if the key is neither cooling down nor out of quota for the model."""
+        state = self._states.get((key, model))
+        return state is None or state.seconds_until_available(time.monotonic()) == 0
+
+    def seconds_until_available(self, keys, model):
+        """Shortest wait until any of the keys can be used for the model."""
+        now = time.monotonic()
+        waits = []
+        for key in keys:
+            state = self._states.get((key, model))
+            waits.append(state.seconds_until_available(now) if state is not None else 0.0)
+        return min(waits) if waits else RATE_LIMIT_COOLDOWN
+
+    def get_unavailable_keys(self):
+        """Returns keys that are cooling down or out of quota for at least one model."""
+        now = time.monotonic()
+        self._prune(now)
+        return {key for (key, model), state in self._states.items() if state.seconds_until_available(now) > 0}
+
+    def record_request(self, key, model):
+        """Consumes one request from the RPM and RPD buckets."""
+        limits = get_limits_for_model(model)
+        if not limits.get('rpm') and not limits.get('rpd'):
+            # Без лимитов запросов нечего учитывать, и состояние для пары не заводится
+            return
+        state = self._state(key, model)
+        now = time.monotonic()
+        for name in ('rpm', 'rpd'):
+            if name in state.buckets:
+                state.buckets[name].consume(1, now)
+
+    def tracks_tokens(self, model):
+        """True if a TPM limit is configured for the model, so response usage has to be read."""
+        return bool(get_limits_for_model(model).get('tpm'))
+
+    def record_usage(self, key, model, total_tokens):
+        """Consumes tokens reported in `usageMetadata` from the TPM bucket."""
+        if not total_tokens or not self.tracks_tokens(model):
+            return
+        self._state(key, model).buckets['tpm'].consume(total_tokens, time.monotonic())
+
+    def record_rate_limited(self, key, model, retry_delay=None):
+        """Puts the key into cooldown for the model after a 429 RESOURCE_EXHAUSTED."""
+        delay = retry_delay if retry_delay is not None else RATE_LIMIT_COOLDOWN
+        state = self._state(key, model)
+        state.cooldown_until = max(state.cooldown_until, time.monotonic() + delay)
+        if self.share_cooldowns:
+            self._new_cooldowns.append((key, model, time.time() + delay))
+        logging.info("Key %s cooling down for %.0fs on model %s", mask_key(key), delay, model)
+
+    def take_new_cooldowns(self):
+        """Returns [(key, model, until unix time)] of cooldowns started here since the last call."""
+        cooldowns, self._new_cooldowns = self._new_cooldowns, []
+        return cooldowns
+
+    def restore_new_cooldowns(self, cooldowns):
+        self._new_cooldowns[:0] = cooldowns
+
+    def apply_shared_cooldowns(self, cooldowns):
+        """Applies cooldowns started by other workers, given as [(key, model, until unix time)]."""
+        offset = time.monotonic() - time.time()
+        for key, model, until in cooldowns:
+            cooldown_until = until + offset
+            if cooldown_until > time.monotonic():
+                state = self._state(key, model)
+                state.cooldown_until = max(state.cooldown_until, cooldown_until)
+
+
+rate_limiter = RateLimiter()
+
+
+async def track_stream_usage(chunks, on_usage, decoder=None):
+    """Passes stream chunks through and reports the last `totalTokenCount` seen when the stream ends.
+
+    Compressed chunks are passed on unchanged; `decoder` decodes a copy for reading the usage.
+    """
+    tail = b''
+    total_tokens = None
+    try:
+        async for chunk in chunks:
+            # Хвост предыдущего чанка нужен, если число разрезано границей чанков
+            window = tail + (decoder.decompress(chunk) if decoder is not None else chunk)
+            tokens = extract_total_tokens(window)
+            if tokens is not None:
+                total_tokens = tokens
+            tail = window[-64:]
+            yield chunk
+    finally:
+        # Закрываем вложенный генератор сразу, чтобы при отключении клиента отменился и апстрим
+        await chunks.aclose()
+        if total_tokens is not None:
+            on_usage(total_tokens)
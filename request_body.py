@@ -0,0 +1,180 @@
+import os
+import asyncio
+import tempfile
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import RequestEntityTooLarge
+from request_timing import timed, to_thread
+
+# Тела запросов до этого размера читаются в память целиком, большие - передаются апстриму потоком
+REQUEST_BODY_MEMORY_LIMIT = int(os.environ.get('REQUEST_BODY_MEMORY_LIMIT', str(1024 * 1024)))
+# Максимальный размер тела запроса; 0 - без ограничения. По умолчанию - предел размера файла File API.
+# Он же ограничивает память под часть тела, которую клиент прислал, а апстрим еще не принял
+MAX_REQUEST_BODY_SIZE = int(os.environ.get('MAX_REQUEST_BODY_SIZE', str(2 * 1024 * 1024 * 1024)))
+# Каталог временных файлов для тел, которые могут понадобиться повторно; пусто - системный
+REQUEST_BODY_SPOOL_DIR = os.environ.get('REQUEST_BODY_SPOOL_DIR', '')
+
+SPOOL_READ_CHUNK_SIZE = 256 * 1024
+
+
+def has_request_body(request):
+    """Checks whether the client sends a request body."""
+    if request.content_length is not None:
+        return request.content_length > 0
+    return request.method in ('POST', 'PUT', 'PATCH')
+
+
+def is_small_body(request):
+    """True if the request body is known to fit in REQUEST_BODY_MEMORY_LIMIT, so it may be read into memory."""
+    if not has_request_body(request):
+        return True
+    return request.content_length is not None and request.content_length <= REQUEST_BODY_MEMORY_LIMIT
+
+
+async def limit_body_size(chunks, limit):
+    """Passes body chunks through, raising RequestEntityTooLarge (413) once more than `limit` bytes arrived.
+
+    Quart checks MAX_CONTENT_LENGTH against Content-Length and against the part of the body
+    it holds, but not against the total of a body without Content-Length that is read in chunks.
+    """
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > limit:
+            raise RequestEntityTooLarge()
+        yield chunk
+
+
+def _write_at(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+class BodySpool:
+    """Tees a streamed request body into a temporary file so later upstream attempts can replay it.
+
+    The first reader gets the body from the client as it arrives. A reader that has
+    caught up with the spooled part pulls the next chunk from the client itself, so
+    attempts running at the same time (hedging) share one copy of the body.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+        self._file = None
+        self._size = 0
+        self._complete = False
+        self._lock = asyncio.Lock()
+
+    async def _pull(self):
+        """Reads the next chunk from the client and appends it to the file; returns b'' at the end."""
+        try:
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            self._complete = True
+            return b''
+        if not chunk:
+            return b''
+        if self._file is None:
+            self._file = await to_thread(tempfile.TemporaryFile, buffering=0, dir=REQUEST_BODY_SPOOL_DIR or None)
+        await to_thread(_write_at, self._file.fileno(), chunk, self._size)
+        self._size += len(chunk)
+        return chunk
+
+    async def stream(self):
+        """Yields the whole body from the beginning; each upstream attempt uses its own stream()."""
+        offset = 0
+        while True:
+            if offset < self._size:
+                chunk = await to_thread(os.pread, self._file.fileno(), min(SPOOL_READ_CHUNK_SIZE, self._size - offset), offset)
+                offset += len(chunk)
+                yield chunk
+                continue
+            if self._complete:
+                return
+            async with self._lock:
+                if offset < self._size or self._complete:
+                    # Пока ждали, следующий чанк прочитал другой читатель
+                    continue
+                chunk = await self._pull()
+            offset += len(chunk)
+            if chunk:
+                yield chunk
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class RequestBody:
+    """Request body as it is sent upstream.
+
+    Small bodies are read into memory once. Large bodies (or bodies of unknown length)
+    are streamed from the client without being read whole; if `replayable`, they are also
+    spooled to a temporary file for failover retries and hedged attempts.
+
+    Quart keeps reading from the client while the upstream is slower, so a streamed body
+    still holds in memory whatever the client is ahead by, up to MAX_REQUEST_BODY_SIZE.
+    """
+
+    def __init__(self, request, replayable):
+        self._request = request
+        self.replayable = replayable
+        self._spool = None
+
+    @property
+    def content_length(self):
+        return self._request.content_length
+
+    async def content(self):
+        """Returns bytes, an async iterable of bytes, or None when there is no body."""
+        if not has_request_body(self._request):
+            return None
+        if is_small_body(self._request):
+            with timed('body'):
+                return await self._request.get_data()
+        chunks = self._request.body
+        if MAX_REQUEST_BODY_SIZE:
+            chunks = limit_body_size(chunks, MAX_REQUEST_BODY_SIZE)
+        if not self.replayable:
+            # Тело можно прочитать только один раз
+            return chunks
+        if self._spool is None:
+            self._spool = BodySpool(chunks)
+        return self._spool.stream()
+
+    def close(self):
+        """Removes the temporary file, if any. Call once no upstream attempt reads the body."""
+        if self._spool is not None:
+            self._spool.close()
+
+
+class DerivedRequest:
+    """A request made by the proxy on behalf of a client: the client's headers and query with its own JSON body.
+
+    Used for requests assembled from client requests (embedding batches, bulk items).
+    With `for_client` the response goes to the client as is (a rewritten request), so
+    the client's Accept and Accept-Encoding are kept.
+    """
+
+    method = 'POST'
+
+    def __init__(self, request, body, args=None, for_client=False):
+        self.headers = Headers(request.headers)
+        self.headers['Content-Type'] = 'application/json'
+        if not for_client:
+            # Ответ нужен прокси целиком и распакованным, а не стримом
+            self.headers.pop('Accept', None)
+            self.headers.pop('Accept-Encoding', None)
+        self.args = request.args if args is None else args
+        self.content_length = len(body)
+        self._body = body
+
+    async def get_data(self):
+        return self._body
+
+    @property
+    async def body(self):
+        yield self._body
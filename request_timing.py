@@ -0,0 +1,149 @@
+import os
+import time
+import asyncio
+import functools
+import contextlib
+import contextvars
+from collections import deque
+
+# Отдавать клиенту заголовок Server-Timing с разбивкой времени запроса по фазам; выключено по умолчанию,
+# так как он показывает клиентам внутреннее устройство прокси (попытки, ожидание ключей, новые соединения)
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', '0').lower() in ('1', 'true', 'yes')
+# Сколько последних запросов хранится для просмотра самых медленных в веб-интерфейсе
+REQUEST_TIMING_HISTORY = int(os.environ.get('REQUEST_TIMING_HISTORY', '1000'))
+
+request_timing_stats = {'requests': 0}
+
+request_timing_var = contextvars.ContextVar('request_timing', default=None)
+
+
+class RequestTiming:
+    """Time spent by one proxied request, by phase.
+
+    Phases that repeat (upstream attempts, key selection on failover) add up. For a
+    stream, `relay` is added when the stream ends, after the Server-Timing header was sent.
+    """
+
+    __slots__ = ('request_id', 'method', 'path', 'route', 'started_at', 'wall_time', 'status', 'duration', 'phases')
+
+    def __init__(self, request_id, method, path, route):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.route = route
+        self.started_at = time.monotonic()
+        self.wall_time = time.time()
+        self.status = None
+        self.duration = None
+        self.phases = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def finish(self, status):
+        self.status = status
+        self.duration = time.monotonic() - self.started_at
+
+    def total(self):
+        """Duration to the response headers plus the stream relay, if any."""
+        return (self.duration or 0.0) + self.phases.get('relay', 0.0)
+
+    def server_timing(self):
+        """Server-Timing header value, durations in milliseconds; `total` is the time so far."""
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phases.items()]
+        parts.append(f"total;dur={(time.monotonic() - self.started_at) * 1000:.1f}")
+        return ', '.join(parts)
+
+    def to_dict(self):
+        return {
+            'request_id': self.request_id, 'method': self.method, 'path': self.path, 'route': self.route,
+            'started_at': self.wall_time, 'status': self.status, 'total_ms': round(self.total() * 1000, 1),
+            'phases_ms': {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()},
+        }
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Adds the time of the block to phase `name` of the current request, if any."""
+    timing = request_timing_var.get()
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        if timing is not None:
+            timing.add(name, time.monotonic() - started_at)
+
+
+def record_phase(name, seconds):
+    timing = request_timing_var.get()
+    if timing is not None:
+        timing.add(name, seconds)
+
+
+# События httpcore, между которыми открывается новое соединение с апстримом
+CONNECT_EVENTS = ('connection.connect_tcp', 'connection.start_tls')
+
+
+def make_connect_trace():
+    """Returns an httpx `trace` extension adding the time to open a new upstream connection (TCP and TLS) to phase `upstream_connect`."""
+    started = {}
+
+    async def trace(event_name, info):
+        prefix, _, stage = event_name.rpartition('.')
+        if prefix not in CONNECT_EVENTS:
+            return
+        if stage == 'started':
+            started[prefix] = time.monotonic()
+        elif prefix in started:
+            record_phase('upstream_connect', time.monotonic() - started.pop(prefix))
+
+    return trace
+
+
+async def to_thread(func, *args, **kwargs):
+    """asyncio.to_thread() that adds the wait for a free executor thread to phase `thread_wait`."""
+    submitted_at = time.monotonic()
+    bound = functools.partial(func, *args, **kwargs)
+
+    def call():
+        return time.monotonic(), bound()
+
+    started_at, result = await asyncio.to_thread(call)
+    record_phase('thread_wait', started_at - submitted_at)
+    return result
+
+
+async def time_stream(chunks, timing):
+    """Passes stream chunks through, adding the time to relay them to phase `relay` of `timing`."""
+    started_at = time.monotonic()
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+        timing.add('relay', time.monotonic() - started_at)
+
+
+class TimingHistory:
+    """Ring buffer of the last REQUEST_TIMING_HISTORY request timings."""
+
+    def __init__(self, size=REQUEST_TIMING_HISTORY):
+        self._timings = deque(maxlen=size)
+
+    def start(self, request_id, method, path, route):
+        """Starts timing the current request; the timing is visible to the code it awaits."""
+        timing = RequestTiming(request_id, method, path, route)
+        request_timing_var.set(timing)
+        return timing
+
+    def finish(self, timing, status):
+        timing.finish(status)
+        request_timing_stats['requests'] += 1
+        self._timings.append(timing)
+
+    def slowest(self, limit=20):
+        """Returns the slowest of the recent requests as dicts, slowest first."""
+        return [timing.to_dict() for timing in sorted(self._timings, key=RequestTiming.total, reverse=True)[:limit]]
+
+
+timing_history = TimingHistory()
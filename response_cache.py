@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import hashlib
+import asyncio
+import logging
+from collections import OrderedDict
+from rate_limits import get_route_from_subpath
+from request_timing import to_thread
+
+# Кэш ответов детерминированных запросов выключен по умолчанию
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', '0').lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# TTL в секундах по методам API; маршруты без TTL не кэшируются
+RESPONSE_CACHE_TTLS = {'models': 3600, 'countTokens': 86400, 'generateContent': 3600}
+RESPONSE_CACHE_TTLS.update(json.loads(os.environ.get('RESPONSE_CACHE_TTLS', '{}') or '{}'))
+# Каталог для дискового уровня кэша; пусто - только память
+RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR', '')
+# Предел размера дискового уровня; при превышении удаляются давно не использованные файлы
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_DISK_MAX_BYTES', str(1024 * 1024 * 1024)))
+# Как часто (в секундах) с диска удаляются истекшие записи и файлы сверх предела
+RESPONSE_CACHE_DISK_SWEEP_INTERVAL = float(os.environ.get('RESPONSE_CACHE_DISK_SWEEP_INTERVAL', '300'))
+
+# Временный файл старше этого (в секундах) остался от прерванной записи
+TMP_FILE_MAX_AGE = 3600
+
+# Параметры запроса, которые не влияют на ответ
+IGNORED_QUERY_PARAMS = {'key'}
+
+
+def canonicalize_body(body):
+    """Returns a stable byte representation of a JSON request body (key order and whitespace ignored)."""
+    if not body:
+        return b''
+    try:
+        return json.dumps(json.loads(body), sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    except ValueError:
+        return body
+
+
+def is_cacheable(method, subpath, body):
+    """Checks whether a request is deterministic enough to be served from the cache."""
+    route = get_route_from_subpath(subpath)
+    if route not in RESPONSE_CACHE_TTLS:
+        return False
+    if route == 'models':
+        return method == 'GET'
+    if method != 'POST':
+        return False
+    if route == 'generateContent':
+        # Только запросы с temperature = 0
+        try:
+            generation_config = json.loads(body).get('generationConfig') or {}
+        except (ValueError, AttributeError):
+            return False
+        return generation_config.get('temperature') == 0
+    return True
+
+
+def make_cache_key(method, subpath, args, body):
+    """Builds a cache key from method, subpath, query (without the API key) and canonical body."""
+    params = sorted((name, value) for name, value in args.items(multi=True) if name not in IGNORED_QUERY_PARAMS)
+    digest = hashlib.sha256()
+    digest.update(f"{method} {subpath}?{params}\n".encode('utf-8'))
+    digest.update(canonicalize_body(body))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """LRU cache of upstream responses bounded by total body size, with an optional on-disk tier.
+
+    Headers are kept as a list of (name, value) pairs, so repeated headers survive. The
+    disk tier is shared by all workers and is swept periodically (see sweep_disk()).
+    """
+
+    def __init__(self, max_bytes, cache_dir='', disk_max_bytes=RESPONSE_CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._disk_size = 0
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'stores': 0, 'disk_removed': 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_stats(self):
+        stats = dict(self.stats, entries=len(self._entries), bytes=self._size, max_bytes=self.max_bytes)
+        if self.cache_dir:
+            stats['disk_bytes'] = self._disk_size
+        return stats
+
+    async def get(self, cache_key):
+        """Returns (status, headers, body) for a fresh entry, or None."""
+        entry = self._entries.get(cache_key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self._entries.move_to_end(cache_key)
+                self.stats['hits'] += 1
+                return entry[1:]
+            self._remove(cache_key)
+        if self.cache_dir:
+            entry = await to_thread(self._read_file, cache_key)
+            if entry is not None:
+                self.stats['disk_hits'] += 1
+                self._put_memory(cache_key, entry)
+                return entry[1:]
+        self.stats['misses'] += 1
+        return None
+
+    async def put(self, cache_key, route, status, headers, body):
+        """Stores a response; `headers` is a list of (name, value) pairs."""
+        ttl = RESPONSE_CACHE_TTLS.get(route)
+        if not ttl or len(body) > self.max_bytes:
+            return
+        entry = (time.time() + ttl, status, headers, body)
+        self._put_memory(cache_key, entry)
+        self.stats['stores'] += 1
+        if self.cache_dir:
+            try:
+                await to_thread(self._write_file, cache_key, entry)
+            except OSError as e:
+                logging.error("Error writing response cache file: %s", e)
+
+    def _put_memory(self, cache_key, entry):
+        if cache_key in self._entries:
+            self._remove(cache_key)
+        self._entries[cache_key] = entry
+        self._size += len(entry[3])
+        while self._size > self.max_bytes and self._entries:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.stats['evictions'] += 1
+
+    def _remove(self, cache_key):
+        entry = self._entries.pop(cache_key)
+        self._size -= len(entry[3])
+
+    def _path(self, cache_key):
+        return os.path.join(self.cache_dir, f"{cache_key}.bin")
+
+    def _read_file(self, cache_key):
+        path = self._path(cache_key)
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if meta['expires_at'] <= time.time():
+            self._remove_file(path)
+            return None
+        try:
+            # Время изменения файла служит меткой последнего использования при очистке
+            os.utime(path)
+        except OSError:
+            pass
+        headers = meta['headers']
+        # Файлы старых версий хранят заголовки словарем
+        headers = list(headers.items()) if isinstance(headers, dict) else [tuple(pair) for pair in headers]
+        return (meta['expires_at'], meta['status'], headers, body)
+
+    def _write_file(self, cache_key, entry):
+        expires_at, status, headers, body = entry
+        tmp_path = self._path(cache_key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps({'expires_at': expires_at, 'status': status, 'headers': headers}).encode('utf-8') + b'\n')
+            f.write(body)
+        os.replace(tmp_path, self._path(cache_key))
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _read_expiry(path):
+        try:
+            with open(path, 'rb') as f:
+                return json.loads(f.readline())['expires_at']
+        except (OSError, ValueError, KeyError, TypeError):
+            # Поврежденный файл удаляется как истекший
+            return 0
+
+    def _sweep_files(self):
+        """Removes expired and abandoned files, then the least recently used ones above disk_max_bytes.
+
+        Returns (files removed, bytes left).
+        """
+        now = time.time()
+        files = []
+        removed = 0
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith('.tmp'):
+                    if stat.st_mtime < now - TMP_FILE_MAX_AGE:
+                        removed += self._remove_file(entry.path)
+                elif entry.name.endswith('.bin'):
+                    if self._read_expiry(entry.path) <= now:
+                        removed += self._remove_file(entry.path)
+                    else:
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(file_size for _, file_size, _ in files)
+        files.sort()
+        for _, file_size, path in files:
+            if size <= self.disk_max_bytes:
+                break
+            if self._remove_file(path):
+                removed += 1
+            size -= file_size
+        return removed, size
+
+    async def sweep_disk(self):
+        """Keeps the disk tier within its limits; other workers may sweep the same directory at the same time."""
+        if not self.cache_dir:
+            return
+        try:
+            removed, self._disk_size = await to_thread(self._sweep_files)
+        except OSError as e:
+            logging.error("Error sweeping response cache directory: %s", e)
+            return
+        self.stats['disk_removed'] += removed
+        if removed:
+            logging.info("Из дискового кэша ответов удалено файлов: %d, осталось %d байт", removed, self._disk_size)
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_DIR)
+
+
+async def run_disk_cache_sweeper(interval=None):
+    """Background task that sweeps the on-disk cache tier until cancelled."""
+    if not RESPONSE_CACHE_ENABLED or not RESPONSE_CACHE_DIR:
+        return
+    interval = interval or RESPONSE_CACHE_DISK_SWEEP_INTERVAL
+    while True:
+        await response_cache.sweep_disk()
+        await asyncio.sleep(interval)
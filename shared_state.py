@@ -0,0 +1,254 @@
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import hashlib
+import logging
+from key_manager import DATABASE_FILE, key_scheduler
+from rate_limits import rate_limiter
+
+# Где воркеры обмениваются состоянием ключей: local - не обмениваются (по умолчанию), sqlite - через keys.db
+# (воркеры одного хоста), redis - через Redis-совместимый сервер (несколько хостов)
+KEY_STATE_BACKEND = os.environ.get('KEY_STATE_BACKEND', 'local').lower()
+KEY_STATE_REDIS_URL = os.environ.get('KEY_STATE_REDIS_URL', 'redis://localhost:6379/0')
+KEY_STATE_REDIS_PREFIX = os.environ.get('KEY_STATE_REDIS_PREFIX', 'gemini-proxy:')
+# Как часто (в секундах) воркер публикует свое состояние и забирает чужое
+KEY_STATE_SYNC_INTERVAL = float(os.environ.get('KEY_STATE_SYNC_INTERVAL', '1'))
+
+# Запросы в работе у воркера, который перестал синхронизироваться, забываются через столько интервалов
+WORKER_TTL_INTERVALS = 5
+# Серии ошибок, которые не менялись столько секунд (например, удаленных ключей), удаляются из общего хранилища
+STREAK_RETENTION = 86400
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+key_state_stats = {'syncs': 0, 'sync_errors': 0}
+
+
+def key_id(key):
+    """Fingerprint of an API key used in shared storage instead of the key itself."""
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+class SqliteKeyStateBackend:
+    """Shares key state between workers on one host through tables in keys.db (WAL mode)."""
+
+    errors = (sqlite3.Error,)
+
+    def __init__(self, database_file, worker_ttl):
+        self.database_file = database_file
+        self.worker_ttl = worker_ttl
+        self._streaks_seen_at = 0.0
+        conn = sqlite3.connect(database_file)
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS key_state_workers (worker_id TEXT PRIMARY KEY, heartbeat REAL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS key_state_in_flight (worker_id TEXT, key_id TEXT, count INTEGER, PRIMARY KEY (worker_id, key_id))")
+                conn.execute("CREATE TABLE IF NOT EXISTS key_state_cooldowns (key_id TEXT, model TEXT, until REAL, PRIMARY KEY (key_id, model))")
+                conn.execute("CREATE TABLE IF NOT EXISTS key_state_streaks (key_id TEXT PRIMARY KEY, errors_since_last_success INTEGER, updated_at REAL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_key_state_streaks_updated_at ON key_state_streaks (updated_at)")
+        finally:
+            conn.close()
+
+    async def exchange(self, worker_id, in_flight, cooldowns, streaks):
+        return await asyncio.to_thread(self._exchange, worker_id, in_flight, cooldowns, streaks)
+
+    def _exchange(self, worker_id, in_flight, cooldowns, streaks):
+        now = time.time()
+        conn = sqlite3.connect(self.database_file)
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO key_state_workers (worker_id, heartbeat) VALUES (?, ?)", (worker_id, now))
+                conn.execute("DELETE FROM key_state_in_flight WHERE worker_id = ?", (worker_id,))
+                conn.executemany("INSERT INTO key_state_in_flight (worker_id, key_id, count) VALUES (?, ?, ?)", [(worker_id, key, count) for key, count in in_flight.items()])
+                conn.executemany("""
+                    INSERT INTO key_state_cooldowns (key_id, model, until) VALUES (?, ?, ?)
+                    ON CONFLICT (key_id, model) DO UPDATE SET until = MAX(until, excluded.until)
+                """, cooldowns)
+                conn.executemany("INSERT OR REPLACE INTO key_state_streaks (key_id, errors_since_last_success, updated_at) VALUES (?, ?, ?)", [(key, streak, now) for key, streak in streaks.items()])
+                # Воркеры, которые давно не синхронизировались (упали или остановлены), не держат ключи
+                conn.execute("DELETE FROM key_state_in_flight WHERE worker_id IN (SELECT worker_id FROM key_state_workers WHERE heartbeat < ?)", (now - self.worker_ttl,))
+                conn.execute("DELETE FROM key_state_workers WHERE heartbeat < ?", (now - self.worker_ttl,))
+                conn.execute("DELETE FROM key_state_cooldowns WHERE until < ?", (now,))
+                conn.execute("DELETE FROM key_state_streaks WHERE updated_at < ?", (now - STREAK_RETENTION,))
+            remote_in_flight = dict(conn.execute("SELECT key_id, SUM(count) FROM key_state_in_flight WHERE worker_id != ? GROUP BY key_id", (worker_id,)).fetchall())
+            shared_cooldowns = conn.execute("SELECT key_id, model, until FROM key_state_cooldowns").fetchall()
+            # Серии ошибок читаем только измененные с прошлой синхронизации (с запасом на разницу часов)
+            shared_streaks = dict(conn.execute("SELECT key_id, errors_since_last_success FROM key_state_streaks WHERE updated_at >= ?", (self._streaks_seen_at,)).fetchall())
+        finally:
+            conn.close()
+        self._streaks_seen_at = now - self.worker_ttl
+        return remote_in_flight, shared_cooldowns, shared_streaks
+
+    async def close(self, worker_id):
+        def remove_worker():
+            conn = sqlite3.connect(self.database_file)
+            try:
+                with conn:
+                    conn.execute("DELETE FROM key_state_in_flight WHERE worker_id = ?", (worker_id,))
+                    conn.execute("DELETE FROM key_state_workers WHERE worker_id = ?", (worker_id,))
+            finally:
+                conn.close()
+        await asyncio.to_thread(remove_worker)
+
+
+class RedisKeyStateBackend:
+    """Shares key state between proxy replicas through a Redis-protocol server (Redis, Valkey, KeyDB, ...)."""
+
+    def __init__(self, url, prefix, worker_ttl):
+        # Зависимость нужна только для этого бэкенда
+        import redis.asyncio
+        import redis.exceptions
+        self.errors = (redis.exceptions.RedisError, OSError)
+        self.prefix = prefix
+        self.worker_ttl = worker_ttl
+        self._redis = redis.asyncio.from_url(url, decode_responses=True)
+        self._streaks_seen_at = 0.0
+
+    def _in_flight_key(self, worker_id):
+        return f"{self.prefix}in_flight:{worker_id}"
+
+    async def exchange(self, worker_id, in_flight, cooldowns, streaks):
+        now = time.time()
+        workers_key = f"{self.prefix}workers"
+        cooldowns_key = f"{self.prefix}cooldowns"
+        # Серии ошибок: значения в хэше, время изменения - в sorted set для чтения только измененных и очистки
+        streaks_key = f"{self.prefix}streaks"
+        streaks_updated_key = f"{self.prefix}streaks_updated"
+        in_flight_key = self._in_flight_key(worker_id)
+
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.delete(in_flight_key)
+        if in_flight:
+            pipe.hset(in_flight_key, mapping=in_flight)
+            pipe.expire(in_flight_key, int(self.worker_ttl) + 1)
+        pipe.zadd(workers_key, {worker_id: now})
+        pipe.zremrangebyscore(workers_key, '-inf', now - self.worker_ttl)
+        if cooldowns:
+            pipe.hset(cooldowns_key, mapping={f"{key}\t{model}": until for key, model, until in cooldowns})
+        if streaks:
+            pipe.hset(streaks_key, mapping=streaks)
+            pipe.zadd(streaks_updated_key, {key: now for key in streaks})
+        pipe.zrange(workers_key, 0, -1)
+        pipe.hgetall(cooldowns_key)
+        # Как и в sqlite, читаем только серии, измененные с прошлой синхронизации (с запасом на разницу часов)
+        pipe.zrangebyscore(streaks_updated_key, self._streaks_seen_at, '+inf')
+        pipe.zrangebyscore(streaks_updated_key, '-inf', now - STREAK_RETENTION)
+        workers, raw_cooldowns, changed_streaks, stale_streaks = (await pipe.execute())[-4:]
+
+        other_workers = [other_worker for other_worker in workers if other_worker != worker_id]
+        pipe = self._redis.pipeline(transaction=False)
+        if stale_streaks:
+            pipe.hdel(streaks_key, *stale_streaks)
+            pipe.zrem(streaks_updated_key, *stale_streaks)
+        if changed_streaks:
+            pipe.hmget(streaks_key, changed_streaks)
+        for other_worker in other_workers:
+            pipe.hgetall(self._in_flight_key(other_worker))
+        results = await pipe.execute()
+        remote_in_flight = {}
+        for counts in results[len(results) - len(other_workers):]:
+            for key, count in counts.items():
+                remote_in_flight[key] = remote_in_flight.get(key, 0) + int(count)
+        streak_values = results[len(results) - len(other_workers) - 1] if changed_streaks else []
+        shared_streaks = {key: int(streak) for key, streak in zip(changed_streaks, streak_values) if streak is not None}
+        self._streaks_seen_at = now - self.worker_ttl
+
+        shared_cooldowns = []
+        expired = []
+        for field, until in raw_cooldowns.items():
+            key, model = field.split('\t', 1)
+            if float(until) < now:
+                expired.append(field)
+            else:
+                shared_cooldowns.append((key, model, float(until)))
+        if expired:
+            await self._redis.hdel(cooldowns_key, *expired)
+        return remote_in_flight, shared_cooldowns, shared_streaks
+
+    async def close(self, worker_id):
+        await self._redis.delete(self._in_flight_key(worker_id))
+        await self._redis.zrem(f"{self.prefix}workers", worker_id)
+        await self._redis.aclose()
+
+
+def create_key_state_backend():
+    """Returns the configured backend, or None when workers do not share key state."""
+    worker_ttl = KEY_STATE_SYNC_INTERVAL * WORKER_TTL_INTERVALS
+    if KEY_STATE_BACKEND == 'sqlite':
+        return SqliteKeyStateBackend(DATABASE_FILE, worker_ttl)
+    if KEY_STATE_BACKEND == 'redis':
+        return RedisKeyStateBackend(KEY_STATE_REDIS_URL, KEY_STATE_REDIS_PREFIX, worker_ttl)
+    return None
+
+
+class KeyStateSync:
+    """Exchanges in-flight counts, 429 cooldowns and error streaks of keys with other workers.
+
+    Requests only touch in-memory state (KeyScheduler and RateLimiter); the exchange runs
+    in the background every KEY_STATE_SYNC_INTERVAL seconds, so sharing adds no work to
+    the request path. Keys are stored in the backend as fingerprints (see key_id()).
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._keys_by_id = {}
+        self._failing = False
+
+    async def sync(self):
+        if len(self._keys_by_id) != key_scheduler.key_count():
+            # Набор ключей изменился: пересобираем отображение отпечатков в ключи
+            self._keys_by_id = {key_id(key): key for key in key_scheduler.all_keys()}
+
+        in_flight = key_scheduler.local_in_flight()
+        streaks = key_scheduler.take_changed_streaks()
+        cooldowns = rate_limiter.take_new_cooldowns()
+        try:
+            remote_in_flight, shared_cooldowns, shared_streaks = await self.backend.exchange(
+                WORKER_ID,
+                {key_id(key): count for key, count in in_flight.items()},
+                [(key_id(key), model or '', until) for key, model, until in cooldowns],
+                {key_id(key): streak for key, streak in streaks.items()},
+            )
+        except self.backend.errors as e:
+            key_state_stats['sync_errors'] += 1
+            # Пока бэкенд недоступен, воркер работает на локальном состоянии; пишем в лог только первую ошибку
+            if not self._failing:
+                logging.warning("Key state sync failed, using local key state until the backend is back: %s", e)
+                self._failing = True
+            key_scheduler.restore_changed_streaks(streaks)
+            rate_limiter.restore_new_cooldowns(cooldowns)
+            return
+        key_state_stats['syncs'] += 1
+        if self._failing:
+            logging.info("Key state sync restored")
+            self._failing = False
+
+        # Ключи, которых нет у этого воркера (например, другой набор ключей на другом хосте), пропускаются
+        keys_by_id = self._keys_by_id
+        key_scheduler.set_remote_in_flight({keys_by_id[shared_id]: count for shared_id, count in remote_in_flight.items() if shared_id in keys_by_id})
+        key_scheduler.apply_shared_streaks({keys_by_id[shared_id]: streak for shared_id, streak in shared_streaks.items() if shared_id in keys_by_id})
+        rate_limiter.apply_shared_cooldowns([(keys_by_id[shared_id], model or None, until) for shared_id, model, until in shared_cooldowns if shared_id in keys_by_id])
+
+
+async def run_key_state_sync(interval=None):
+    """Background task that shares key state with other workers until cancelled."""
+    backend = create_key_state_backend()
+    if backend is None:
+        return
+    interval = interval or KEY_STATE_SYNC_INTERVAL
+    key_state_sync = KeyStateSync(backend)
+    rate_limiter.share_cooldowns = True
+    logging.info("Key state is shared through %s backend as worker %s", KEY_STATE_BACKEND, WORKER_ID)
+    try:
+        while True:
+            await key_state_sync.sync()
+            await asyncio.sleep(interval)
+    finally:
+        rate_limiter.share_cooldowns = False
+        try:
+            await backend.close(WORKER_ID)
+        except backend.errors as e:
+            logging.warning("Error unregistering worker from key state backend: %s", e)
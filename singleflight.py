@@ -0,0 +1,177 @@
+import os
+import asyncio
+import logging
+from collections import deque
+from quart import Response
+from upstream import StreamBody
+
+# Объединение одинаковых одновременных запросов в один вызов апстрима
+SINGLE_FLIGHT_ENABLED = os.environ.get('SINGLE_FLIGHT_ENABLED', '0').lower() in ('1', 'true', 'yes')
+# Разрешить раздачу одного стрима нескольким клиентам
+SINGLE_FLIGHT_STREAMING = os.environ.get('SINGLE_FLIGHT_STREAMING', '0').lower() in ('1', 'true', 'yes')
+# Сколько байт общего стрима хранится для клиентов, подключившихся позже; дальше они делают свой запрос
+SINGLE_FLIGHT_STREAM_BUFFER = int(os.environ.get('SINGLE_FLIGHT_STREAM_BUFFER', str(1024 * 1024)))
+SINGLE_FLIGHT_ROUTES = {route.strip() for route in os.environ.get('SINGLE_FLIGHT_ROUTES', 'generateContent|streamGenerateContent|embedContent|batchEmbedContents|countTokens').split('|') if route.strip()}
+
+
+class StreamBroadcast:
+    """Reads one upstream stream and replays it to every subscriber from the beginning.
+
+    Up to SINGLE_FLIGHT_STREAM_BUFFER bytes are kept for clients that join late. Past that
+    no one can join any more, chunks every subscriber has read are dropped and the upstream
+    is read at the pace of the slowest subscriber. The upstream is cancelled once the last
+    subscriber goes away.
+    """
+
+    def __init__(self, body):
+        self._body = body
+        self._chunks = deque()
+        # Номер первого хранимого чанка и размер хранимых чанков в байтах
+        self._base = 0
+        self._size = 0
+        self._joinable = True
+        self._done = False
+        self._changed = asyncio.Event()
+        # Подписчик -> номер следующего чанка для него
+        self._positions = {}
+        self._closing = None
+        self._task = asyncio.ensure_future(self._pump())
+        self._task.add_done_callback(self._on_pump_done)
+
+    async def _pump(self):
+        try:
+            async with self._body:
+                async for chunk in self._body:
+                    self._chunks.append(chunk)
+                    self._size += len(chunk)
+                    if self._joinable and self._size > SINGLE_FLIGHT_STREAM_BUFFER:
+                        self._joinable = False
+                        self._trim()
+                    self._notify()
+                    if not self._joinable and not self._positions:
+                        # Подписчиков нет, и новые уже не подключатся
+                        break
+                    # Не читаем апстрим дальше, пока самый медленный подписчик не разгрузит буфер
+                    while not self._joinable and self._size > SINGLE_FLIGHT_STREAM_BUFFER:
+                        await self._changed.wait()
+        except Exception as e:
+            logging.error("Error reading shared stream: %s", e)
+        finally:
+            self._done = True
+            self._notify()
+
+    def _on_pump_done(self, task):
+        if self._done:
+            return
+        # Задача отменена до запуска _pump: тело апстрима нужно закрыть отдельно
+        self._done = True
+        self._notify()
+        self._closing = asyncio.ensure_future(self._close_body())
+
+    async def _close_body(self):
+        async with self._body:
+            pass
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _trim(self):
+        """Drops the chunks every subscriber has already read."""
+        low = min(self._positions.values(), default=self._base + len(self._chunks))
+        if low <= self._base:
+            return
+        while self._base < low:
+            self._size -= len(self._chunks.popleft())
+            self._base += 1
+        self._notify()
+
+    def join(self):
+        """Returns a body replaying the stream from its start, or None if the start is no longer kept."""
+        if not self._joinable:
+            return None
+        subscriber = object()
+        self._positions[subscriber] = 0
+
+        async def leave_unstarted():
+            self._leave(subscriber)
+
+        return StreamBody(self._read(subscriber), leave_unstarted)
+
+    async def _read(self, subscriber):
+        try:
+            while True:
+                index = self._positions[subscriber]
+                while index < self._base + len(self._chunks):
+                    yield self._chunks[index - self._base]
+                    index += 1
+                    self._positions[subscriber] = index
+                    if not self._joinable:
+                        self._trim()
+                if self._done:
+                    return
+                await self._changed.wait()
+        finally:
+            self._leave(subscriber)
+
+    def _leave(self, subscriber):
+        if self._positions.pop(subscriber, None) is None:
+            return
+        if not self._positions and not self._done:
+            self._task.cancel()
+        elif not self._joinable:
+            self._trim()
+
+
+class SharedResponse:
+    """A response that can be handed out to several waiting clients."""
+
+    def __init__(self, status, headers, body=None, broadcast=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.broadcast = broadcast
+
+    @classmethod
+    async def from_response(cls, response):
+        # Пары, а не словарь: повторяющиеся заголовки (Set-Cookie, Vary) должны дойти до каждого клиента
+        headers = list(response.headers.items())
+        if response.mimetype == 'text/event-stream':
+            return cls(response.status_code, headers, broadcast=StreamBroadcast(response.response))
+        return cls(response.status_code, headers, body=await response.get_data())
+
+    def to_response(self):
+        """Returns a Quart response, or None for a stream that can no longer be joined from the start."""
+        if self.broadcast is not None:
+            body = self.broadcast.join()
+            if body is None:
+                return None
+            response = Response(body, status=self.status, headers=self.headers)
+            response.timeout = None
+            return response
+        return Response(self.body, status=self.status, headers=self.headers)
+
+
+class SingleFlight:
+    """Runs one call per key at a time; concurrent callers with the same key share its result."""
+
+    def __init__(self):
+        self._calls = {}
+        self.stats = {'leaders': 0, 'shared': 0, 'late_joins_refused': 0}
+
+    async def do(self, key, fn):
+        """Returns (result, shared); `shared` is True if the caller joined an in-flight call."""
+        task = self._calls.get(key)
+        shared = task is not None
+        if shared:
+            self.stats['shared'] += 1
+        else:
+            self.stats['leaders'] += 1
+            # Вызов идет в отдельной задаче, чтобы отключение первого клиента не отменило его для остальных
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None) if self._calls.get(key) is task else None)
+        return await asyncio.shield(task), shared
+
+
+single_flight = SingleFlight()
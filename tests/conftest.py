@@ -0,0 +1,83 @@
+import os
+import sys
+import socket
+import asyncio
+import tempfile
+import contextlib
+import pytest
+
+# Модули прокси лежат в корне репозитория и создают keys.db в текущем каталоге
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix='gemini-proxy-tests-'))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def key_pool(tmp_path, monkeypatch):
+    """Returns setup(google_keys, user_keys) creating keys.db in a temporary directory and loading it into the key scheduler."""
+    import key_config
+    import key_manager
+    from rate_limits import rate_limiter
+    monkeypatch.chdir(tmp_path)
+
+    def setup(google_keys, user_keys=('user-key',)):
+        key_manager.initialize_db()
+        key_manager.apply_config_keys(google_keys, [])
+        # Планировщик и лимиты - общие объекты всех модулей, поэтому сбрасываются на месте
+        key_manager.key_scheduler.__init__()
+        key_manager.key_scheduler.load()
+        rate_limiter.__init__()
+        monkeypatch.setattr(key_config, '_user_keys', frozenset(user_keys))
+        return key_manager.key_scheduler
+
+    yield setup
+    key_manager.key_scheduler.__init__()
+    rate_limiter.__init__()
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    """Returns an async context manager serving benchmark/fake_gemini.py locally, with the proxy sending upstream calls to it."""
+    import main
+    import upstream
+    import context_cache
+    import key_probe
+    from hypercorn.config import Config
+    from hypercorn.asyncio import serve
+    from benchmark import fake_gemini as fake_gemini_app
+
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    for module in (main, context_cache, key_probe):
+        monkeypatch.setattr(module, 'GOOGLE_API_BASE_URL', base_url)
+    monkeypatch.setattr(fake_gemini_app, 'LATENCY', 0.0)
+
+    @contextlib.asynccontextmanager
+    async def serving():
+        config = Config()
+        config.bind = [f'127.0.0.1:{port}']
+        config.accesslog = None
+        shutdown = asyncio.Event()
+        server = asyncio.ensure_future(serve(fake_gemini_app.app, config, shutdown_trigger=shutdown.wait))
+        await upstream.start_upstream_client()
+        try:
+            for _ in range(50):
+                try:
+                    _, writer = await asyncio.open_connection('127.0.0.1', port)
+                except OSError:
+                    await asyncio.sleep(0.05)
+                    continue
+                writer.close()
+                break
+            yield fake_gemini_app
+        finally:
+            await upstream.close_upstream_client()
+            shutdown.set()
+            await server
+
+    return serving
@@ -0,0 +1,66 @@
+import asyncio
+from admission import AdmissionController, AdmissionTicket
+
+
+def test_slot_skips_waiter_cancelled_before_it_left_the_queue():
+    async def run():
+        controller = AdmissionController()
+        controller.limit.limit = 1
+        ticket = await controller.acquire('user', 'generateContent')
+        gone = asyncio.ensure_future(controller.acquire('user', 'generateContent'))
+        waiting = asyncio.ensure_future(controller.acquire('user', 'generateContent'))
+        await asyncio.sleep(0)
+        assert controller.queued == 2
+
+        # Ожидание первого в очереди отменено, но его задача еще не успела убрать себя из очереди
+        controller._queues['user'][0].cancel()
+        controller.release(ticket)
+        assert controller.in_flight == 1
+        assert isinstance(await waiting, AdmissionTicket)
+        assert gone.cancelled()
+        assert controller.queued == 0
+
+        controller.release(AdmissionTicket('generateContent'))
+        assert controller.get_state()['in_flight'] == 0
+
+    asyncio.run(run())
+
+
+def test_stream_holds_slot_until_it_ends(monkeypatch):
+    import main
+    from quart import Response
+    from upstream import StreamBody
+
+    async def run():
+        controller = AdmissionController()
+        monkeypatch.setattr(main, 'ADMISSION_ENABLED', True)
+        monkeypatch.setattr(main, 'admission', controller)
+        closed = []
+
+        async def close_unstarted():
+            closed.append(True)
+
+        async def chunks():
+            yield b'data: 1\n\n'
+            yield b'data: 2\n\n'
+
+        async def forward():
+            return Response(StreamBody(chunks(), close_unstarted), mimetype='text/event-stream')
+
+        async with main.app.test_request_context('/v1beta/models/m:streamGenerateContent'):
+            response = await main.forward_admitted('user', 'models/m:streamGenerateContent', forward)
+            assert controller.in_flight == 1
+            async with response.response as body:
+                async for _ in body:
+                    # Пока стрим открыт, слот занят
+                    assert controller.in_flight == 1
+            assert controller.in_flight == 0
+
+            # Стрим, который клиент так и не начал читать, тоже освобождает слот
+            response = await main.forward_admitted('user', 'models/m:streamGenerateContent', forward)
+            assert controller.in_flight == 1
+            await response.response.iter.aclose()
+            assert controller.in_flight == 0
+            assert closed
+
+    asyncio.run(run())
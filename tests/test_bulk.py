@@ -0,0 +1,89 @@
+import json
+import asyncio
+import main
+import bulk
+from bulk import iter_ndjson_items, run_bulk
+
+
+async def chunked(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def collect(items):
+    return [item async for item in items]
+
+
+def test_ndjson_lines_split_across_chunks():
+    items = asyncio.run(collect(iter_ndjson_items(chunked(b'{"a": 1}\n{"b"', b': 2}\n\n', b'not json\n', b'{"c": 3}'))))
+    # Пустые строки пропускаются, невалидная строка дает элемент без тела
+    assert items == [(0, b'{"a": 1}'), (1, b'{"b": 2}'), (2, None), (3, b'{"c": 3}')]
+
+
+def test_ndjson_stops_at_max_items(monkeypatch):
+    monkeypatch.setattr(bulk, 'BULK_MAX_ITEMS', 2)
+    items = asyncio.run(collect(iter_ndjson_items(chunked(b'{}\n' * 5))))
+    assert [index for index, _ in items] == [0, 1]
+
+
+def test_run_bulk_bounds_workers_and_queue():
+    async def run():
+        running = 0
+        peak = 0
+        started = []
+
+        async def run_item(index, body):
+            nonlocal running, peak
+            started.append(index)
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.001 * (5 - index % 5))
+            running -= 1
+            return 200, json.dumps({'echo': json.loads(body)}).encode()
+
+        items = chunked(*(json.dumps({'n': n}).encode() + b'\n' for n in range(20)))
+        results = run_bulk(iter_ndjson_items(items), run_item, 3)
+        first = await results.__anext__()
+        # Клиент не читает: в работу уходит не больше, чем влезает в очередь результатов и в воркеры
+        await asyncio.sleep(0.05)
+        started_while_blocked = len(started)
+        lines = [first] + [line async for line in results]
+        return peak, started_while_blocked, [json.loads(line) for line in lines]
+
+    peak, started_while_blocked, results = asyncio.run(run())
+    assert peak == 3
+    assert started_while_blocked <= 3 + 3 + 1
+    assert sorted(result['index'] for result in results) == list(range(20))
+    for result in results:
+        assert result['status'] == 200
+        assert result['response'] == {'echo': {'n': result['index']}}
+
+
+def test_bulk_endpoint(key_pool, fake_gemini):
+    key_pool(['pool-key'])
+    headers = {'X-Goog-Api-Key': 'user-key'}
+
+    async def post(body, content_type):
+        response = await main.app.test_client().post('/bulk/v1beta/models/gemini:generateContent', data=body, headers={**headers, 'Content-Type': content_type, 'Content-Length': str(len(body))})
+        return response.status_code, await response.get_data()
+
+    async def run():
+        async with fake_gemini():
+            request = {'contents': [{'parts': [{'text': 'hi'}]}]}
+            array = await post(json.dumps([request] * 3).encode(), 'application/json')
+            ndjson = await post(json.dumps(request).encode() + b'\n{broken\n' + json.dumps(request).encode(), 'application/x-ndjson')
+            not_array = await post(b'{}', 'application/json')
+            return array, ndjson, not_array
+
+    array, ndjson, not_array = asyncio.run(run())
+    assert array[0] == 200
+    results = [json.loads(line) for line in array[1].splitlines()]
+    assert sorted(result['index'] for result in results) == [0, 1, 2]
+    assert all(result['status'] == 200 and 'candidates' in result['response'] for result in results)
+
+    results = {result['index']: result for result in map(json.loads, ndjson[1].splitlines())}
+    assert sorted(results) == [0, 1, 2]
+    assert results[1] == {'index': 1, 'status': 400, 'error': 'Item is not valid JSON'}
+    assert results[0]['status'] == results[2]['status'] == 200
+
+    assert not_array[0] == 400
@@ -0,0 +1,103 @@
+import json
+import asyncio
+import main
+import context_cache
+from context_cache import ContextCache, ContextCacheEntry, iter_prefixes, context_cache_stats
+from benchmark import fake_gemini as fake
+
+MODEL_PATH = 'models/gemini'
+SYSTEM = {'parts': [{'text': 'You are a careful assistant. ' * 20}]}
+
+
+def turn(role, text):
+    return {'role': role, 'parts': [{'text': text}]}
+
+
+def conversation(turns):
+    return {'systemInstruction': SYSTEM, 'generationConfig': {'temperature': 0.5}, 'contents': [turn('user' if i % 2 == 0 else 'model', f"message {i}") for i in range(turns)]}
+
+
+def test_chained_fingerprints_match_a_grown_conversation():
+    short = list(iter_prefixes(MODEL_PATH, conversation(3)))
+    grown = list(iter_prefixes(MODEL_PATH, conversation(5)))
+    # Префиксы без последнего сообщения: у выросшего разговора начало то же
+    assert [prefix_len for prefix_len, _, _ in short] == [0, 1, 2]
+    assert grown[:3] == short
+    assert len(grown) == 5
+    assert [size for _, _, size in grown] == sorted(size for _, _, size in grown)
+    # Другая модель или другая инструкция - другие отпечатки
+    assert list(iter_prefixes('models/other', conversation(3)))[0][1] != short[0][1]
+    changed = dict(conversation(3), systemInstruction={'parts': [{'text': 'x'}]})
+    assert list(iter_prefixes(MODEL_PATH, changed))[2][1] != short[2][1]
+
+
+def test_rewrite_drops_cached_fields_and_contents():
+    request_json = dict(conversation(5), tools=[{'functionDeclarations': []}], toolConfig={'functionCallingConfig': {'mode': 'AUTO'}})
+    rewritten = json.loads(ContextCache._rewrite(request_json, 3, 'cachedContents/abc'))
+    assert rewritten == {'generationConfig': {'temperature': 0.5}, 'contents': request_json['contents'][3:], 'cachedContent': 'cachedContents/abc'}
+
+
+def test_cache_is_created_after_repeats_and_used_for_longer_prompts(monkeypatch):
+    monkeypatch.setattr(context_cache, 'CONTEXT_CACHE_MIN_TOKENS', 1)
+    monkeypatch.setattr(context_cache, 'CONTEXT_CACHE_MIN_REPEATS', 3)
+    cache = ContextCache()
+    created = []
+
+    async def create(fingerprint, model_path, request_json, prefix_len, api_key):
+        created.append(prefix_len)
+        cache._store(ContextCacheEntry(fingerprint, 'cachedContents/abc', api_key, prefix_len, 10 ** 10))
+
+    monkeypatch.setattr(cache, '_create', create)
+    body = json.dumps(conversation(3))
+
+    async def run():
+        results = [cache.prepare(f"{MODEL_PATH}:generateContent", body, lambda: 'key') for _ in range(3)]
+        await asyncio.sleep(0)
+        return results
+
+    assert asyncio.run(run()) == [None, None, None]
+    assert created == [2]
+    entry, rewritten = cache.prepare(f"{MODEL_PATH}:generateContent", json.dumps(conversation(5)), lambda: 'key')
+    assert entry.prefix_len == 2
+    assert json.loads(rewritten)['contents'] == conversation(5)['contents'][2:]
+    # Запросы со своим кэшем не трогаются, а короткие префиксы не считаются, сколько бы ни повторялись
+    assert cache.prepare(f"{MODEL_PATH}:generateContent", json.dumps(dict(conversation(3), cachedContent='x')), lambda: 'key') is None
+    monkeypatch.setattr(context_cache, 'CONTEXT_CACHE_MIN_TOKENS', 10 ** 6)
+    other = json.dumps(dict(conversation(3), systemInstruction={'parts': [{'text': 'short'}]}))
+    assert [cache.prepare(f"{MODEL_PATH}:generateContent", other, lambda: 'key') for _ in range(5)] == [None] * 5
+    assert created == [2]
+
+
+def test_deleted_cache_is_invalidated_and_request_falls_back(key_pool, fake_gemini, monkeypatch):
+    key_pool(['pool-key'])
+    monkeypatch.setattr(main, 'CONTEXT_CACHE_ENABLED', True)
+    monkeypatch.setattr(main, 'context_cache', ContextCache())
+    monkeypatch.setattr(context_cache, 'CONTEXT_CACHE_MIN_TOKENS', 1)
+    body = json.dumps(conversation(3))
+    headers = {'X-Goog-Api-Key': 'user-key', 'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+    stats = dict(context_cache_stats)
+
+    async def generate(client):
+        response = await client.post(f"/v1beta/{MODEL_PATH}:generateContent", data=body, headers=headers)
+        return response.status_code
+
+    async def run():
+        async with fake_gemini():
+            client = main.app.test_client()
+            statuses = [await generate(client), await generate(client)]
+            # Кэш создается в фоне после второго запроса
+            for _ in range(100):
+                if main.context_cache._entries:
+                    break
+                await asyncio.sleep(0.01)
+            statuses.append(await generate(client))
+            # Кэш удален в Google: запрос получает 403, кэш забывается, запрос идет без него
+            fake.cached_contents.clear()
+            statuses.append(await generate(client))
+            return statuses
+
+    assert asyncio.run(run()) == [200] * 4
+    assert context_cache_stats['created'] == stats['created'] + 1
+    assert context_cache_stats['hits'] == stats['hits'] + 2
+    assert context_cache_stats['fallbacks'] == stats['fallbacks'] + 1
+    assert not main.context_cache._entries
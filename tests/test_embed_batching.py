@@ -0,0 +1,104 @@
+import json
+import asyncio
+import main
+import embed_batching
+from embed_batching import EmbedBatcher, split_batch_response
+
+EMBED_PATH = '/v1beta/models/text-embedding-004:embedContent'
+
+
+def post_embed(client, text, path=EMBED_PATH):
+    parts = [{'text': text}] if text is not None else []
+    body = json.dumps({'content': {'parts': parts}})
+    # Тестовый клиент Quart сам не указывает Content-Length, а без него тело не считается маленьким
+    headers = {'X-Goog-Api-Key': 'user-key', 'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+    return client.post(path, data=body, headers=headers)
+
+
+def test_embed_batching_works_with_single_flight(key_pool, fake_gemini, monkeypatch):
+    key_pool(['pool-key'])
+    monkeypatch.setattr(main, 'EMBED_BATCHING_ENABLED', True)
+    monkeypatch.setattr(main, 'SINGLE_FLIGHT_ENABLED', True)
+    batches = embed_batching.embed_batch_stats['batches']
+    shared = main.single_flight.stats['shared']
+
+    async def run():
+        async with fake_gemini():
+            client = main.app.test_client()
+            # Разные тексты собираются в пачку, одинаковые объединяются в один вызов
+            texts = ['a', 'b', 'c', 'c']
+            return await asyncio.gather(*(post_embed(client, text) for text in texts))
+
+    responses = asyncio.run(run())
+    assert [response.status_code for response in responses] == [200] * 4
+    for response in responses:
+        assert len(json.loads(asyncio.run(response.get_data()))['embedding']['values']) == 768
+    assert embed_batching.embed_batch_stats['batches'] > batches
+    assert main.single_flight.stats['shared'] > shared
+
+
+def test_split_batch_response():
+    body = json.dumps({'embeddings': [{'values': [1.0]}, {'values': [2.0]}]}).encode()
+    results = split_batch_response(200, {'Content-Type': 'application/json'}, body, 2)
+    assert [json.loads(result[2]) for result in results] == [{'embedding': {'values': [1.0]}}, {'embedding': {'values': [2.0]}}]
+    assert all(result[:2] == (200, {'Content-Type': 'application/json'}) for result in results)
+    # Число эмбеддингов не совпало с числом запросов или пачка отклонена из-за какого-то запроса
+    assert split_batch_response(200, {}, body, 3) is None
+    assert split_batch_response(400, {}, b'{"error": {"code": 400}}', 2) is None
+    assert split_batch_response(500, {}, b'{"error": {"code": 400}}', 2) is None
+    # Ошибка всей пачки достается каждому запросу
+    assert split_batch_response(429, {}, b'{"error": {"code": 429}}', 2) == [(429, {}, b'{"error": {"code": 429}}')] * 2
+
+
+def test_batcher_groups_and_flushes():
+    async def run():
+        batcher = EmbedBatcher(window=0.01, max_size=3)
+        sent = []
+
+        async def send(items):
+            sent.append(list(items))
+            return [(200, {}, item) for item in items]
+
+        # Пачка из трех отправляется сразу, четвертый запрос ждет окна в новой пачке; у другой модели своя пачка
+        results = await asyncio.gather(*(batcher.submit(group, group, f"{group}-{n}", send) for group, n in [('a', 1), ('b', 1), ('a', 2), ('a', 3), ('a', 4)]))
+        return sent, results
+
+    sent, results = asyncio.run(run())
+    assert sorted(sent) == [['a-1', 'a-2', 'a-3'], ['a-4'], ['b-1']]
+    assert [result[2] for result in results] == ['a-1', 'b-1', 'a-2', 'a-3', 'a-4']
+
+
+def test_batcher_failure_reaches_every_request():
+    async def run():
+        batcher = EmbedBatcher(window=0.001)
+
+        async def send(items):
+            raise RuntimeError('upstream is down')
+
+        return await asyncio.gather(*(batcher.submit('a', 'a', n, send) for n in range(3)), return_exceptions=True)
+
+    assert [str(result) for result in asyncio.run(run())] == ['upstream is down'] * 3
+
+
+def test_rejected_batch_falls_back_to_single_requests(key_pool, fake_gemini, monkeypatch):
+    key_pool(['pool-key'])
+    monkeypatch.setattr(main, 'EMBED_BATCHING_ENABLED', True)
+    fallbacks = embed_batching.embed_batch_stats['fallbacks']
+    batches = embed_batching.embed_batch_stats['batches']
+
+    async def run():
+        async with fake_gemini():
+            client = main.app.test_client()
+            # Запрос без parts отклоняет всю пачку, а двух моделей - две пачки
+            return await asyncio.gather(
+                post_embed(client, 'a'), post_embed(client, None), post_embed(client, 'b'),
+                post_embed(client, 'c', '/v1beta/models/embedding-001:embedContent'), post_embed(client, 'd', '/v1beta/models/embedding-001:embedContent'),
+            )
+
+    responses = asyncio.run(run())
+    # Пул ключей отдает исчерпанную ошибку апстрима со статусом 500, но с ее телом
+    assert [response.status_code for response in responses] == [200, 500, 200, 200, 200]
+    assert b'Content has no parts' in asyncio.run(responses[1].get_data())
+    assert embed_batching.embed_batch_stats['fallbacks'] == fallbacks + 1
+    assert embed_batching.embed_batch_stats['batches'] == batches + 2
+    assert 'embedding' in json.loads(asyncio.run(responses[0].get_data()))
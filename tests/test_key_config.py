@@ -0,0 +1,34 @@
+import asyncio
+import key_config
+from key_config import reload_key_config, is_user_key
+
+
+def write_keys(path, user_keys, google_keys, removed_keys=()):
+    path.write_text(f"USER_KEYS={'|'.join(user_keys)}\nGOOGLE_KEYS={'|'.join(google_keys)}\nREMOVE_GOOGLE_KEYS={'|'.join(removed_keys)}\n")
+
+
+def test_reload_adds_and_removes_keys_and_keeps_stats(key_pool, tmp_path, monkeypatch):
+    scheduler = key_pool(['key-a', 'key-b'])
+    keys_file = tmp_path / 'keys.env'
+    monkeypatch.setattr(key_config, 'KEYS_FILE', str(keys_file))
+    scheduler.record_result('key-b', success=True)
+    scheduler.record_result('key-b', success=False)
+    scheduler.acquire('key-a')
+
+    write_keys(keys_file, ['new-user'], ['key-a', 'key-b', 'key-c'], ['key-a'])
+    summary = asyncio.run(reload_key_config())
+    assert summary == {'added': 1, 'removed': 1, 'pool_changes': 2, 'user_keys': 1, 'active_keys': 2}
+    # Новые запросы сразу видят новый набор ключей пользователей и пул
+    assert is_user_key('new-user') and not is_user_key('user-key')
+    assert sorted(scheduler.sorted_keys()) == ['key-b', 'key-c']
+    assert scheduler.select_key(exclude={'key-b', 'key-c'}) is None
+    # Запрос, начатый на отключенном ключе, завершается на нем
+    assert scheduler.local_in_flight() == {'key-a': 1}
+    scheduler.release('key-a')
+    rows = {row['key']: row for row in scheduler.get_rows()}
+    assert (rows['key-b']['successful_requests'], rows['key-b']['error_requests'], rows['key-b']['errors_since_last_success']) == (1, 1, 1)
+    assert rows['key-a']['removed'] == 1
+
+    # Повторная перезагрузка без изменений ничего не меняет
+    summary = asyncio.run(reload_key_config())
+    assert (summary['added'], summary['removed'], summary['pool_changes']) == (0, 0, 0)
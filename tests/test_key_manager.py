@@ -0,0 +1,131 @@
+import base64
+import asyncio
+import sqlite3
+import main
+import key_manager
+from key_manager import DATABASE_FILE, load_key_rows, write_pending_stats
+
+ADMIN_AUTH = {'Authorization': 'Basic ' + base64.b64encode(b'admin:user-key').decode()}
+
+
+def db_counters(key):
+    conn = sqlite3.connect(DATABASE_FILE)
+    try:
+        return conn.execute("SELECT successful_requests, error_requests, errors_since_last_success FROM api_keys WHERE key = ?", (key,)).fetchone()
+    finally:
+        conn.close()
+
+
+def test_select_key_prefers_keys_without_errors(key_pool):
+    scheduler = key_pool(['key-a', 'key-b', 'key-c'])
+    scheduler.record_result('key-a', success=False)
+    scheduler.record_result('key-b', success=True)
+    # Ключ с ошибкой последним, среди равных - с меньшим числом запросов
+    assert scheduler.sorted_keys() == ['key-c', 'key-b', 'key-a']
+    assert scheduler.select_key() == 'key-c'
+    assert scheduler.select_key(exclude={'key-c'}) == 'key-b'
+    assert scheduler.select_key(is_available=lambda key: key == 'key-a') == 'key-a'
+    assert scheduler.select_key(exclude={'key-a', 'key-b', 'key-c'}) is None
+    # Выбор ключа не убирает его из кучи
+    assert scheduler.active_count() == 3
+
+
+def test_requests_in_flight_spread_over_keys(key_pool):
+    scheduler = key_pool(['key-a', 'key-b'])
+    first = scheduler.select_key()
+    scheduler.acquire(first)
+    second = scheduler.select_key()
+    assert second != first
+    scheduler.acquire(second)
+    scheduler.acquire(second)
+    assert scheduler.select_key() == first
+    scheduler.release(second)
+    scheduler.release(second)
+    scheduler.release(first)
+    assert scheduler.local_in_flight() == {}
+    # Ключ не из пула (собственный ключ клиента) не учитывается
+    scheduler.acquire('own-key')
+    scheduler.release('own-key')
+    assert scheduler.local_in_flight() == {}
+
+
+def test_heap_skips_and_compacts_stale_entries(key_pool):
+    scheduler = key_pool(['key-a', 'key-b'])
+    for _ in range(200):
+        scheduler.record_result('key-a', success=True)
+    assert len(scheduler._heap) <= 2 * len(scheduler._entries) + 64
+    assert sum(entry[-1] is not None for entry in scheduler._heap) == 2
+    assert scheduler.select_key() == 'key-b'
+    scheduler.set_removed('key-b', 1)
+    assert scheduler.select_key() == 'key-a'
+    assert scheduler.sorted_keys() == ['key-a']
+
+
+def test_sync_rows_adds_and_toggles_keys_and_keeps_stats(key_pool):
+    scheduler = key_pool(['key-a'])
+    scheduler.record_result('key-a', success=True)
+    # Другой воркер добавил ключ и отключил key-a
+    key_manager.apply_config_keys(['key-b'], ['key-a'])
+    assert scheduler.sync_rows(load_key_rows()) == 2
+    assert scheduler.sorted_keys() == ['key-b']
+    assert scheduler._rows['key-a']['successful_requests'] == 1
+    assert scheduler.sync_rows(load_key_rows()) == 0
+
+
+def test_write_pending_stats_adds_deltas(key_pool):
+    scheduler = key_pool(['key-a', 'key-b'])
+    scheduler.record_result('key-a', success=False)
+    scheduler.record_result('key-a', success=True)
+    scheduler.record_result('key-a', success=False)
+    scheduler.record_result('key-b', success=False)
+    write_pending_stats(scheduler.take_pending())
+    assert db_counters('key-a') == (1, 2, 1)
+    assert db_counters('key-b') == (0, 1, 1)
+
+    # Без успеха серия ошибок продолжается от записанной в БД
+    scheduler.record_result('key-b', success=False)
+    batch = scheduler.take_pending()
+    assert scheduler.take_pending() == []
+    scheduler.restore_pending(batch)
+    write_pending_stats(scheduler.take_pending())
+    assert db_counters('key-b') == (0, 2, 2)
+
+
+def test_admin_page_shows_totals_of_all_workers(key_pool):
+    scheduler = key_pool(['key-a'])
+    scheduler.record_result('key-a', success=True)
+    # Успехи, которые записал другой воркер
+    conn = sqlite3.connect(DATABASE_FILE)
+    with conn:
+        conn.execute("UPDATE api_keys SET successful_requests = successful_requests + 41 WHERE key = 'key-a'")
+    conn.close()
+
+    async def run():
+        response = await main.app.test_client().get('/admin/keys', headers=ADMIN_AUTH)
+        return response.status_code, (await response.get_data()).decode()
+
+    status, page = asyncio.run(run())
+    assert status == 200
+    assert '<td>42</td>' in page
+    assert db_counters('key-a')[0] == 42
+
+
+def test_admin_page_is_paginated(key_pool):
+    scheduler = key_pool([f"key-{n:02d}" for n in range(25)])
+    scheduler.acquire('key-07')
+
+    async def get(query):
+        response = await main.app.test_client().get(f"/admin/keys?{query}", headers=ADMIN_AUTH)
+        return (await response.get_data()).decode()
+
+    def shown(page):
+        return [line.strip()[4:-5] for line in page.splitlines() if line.strip().startswith('<td>key-')]
+
+    page = asyncio.run(get('sort_by=key&per_page=10&page=2'))
+    assert shown(page) == [f"key-{n:02d}" for n in range(10, 20)]
+    assert 'Страница 2 из 3, всего ключей: 25' in page
+    assert shown(asyncio.run(get('sort_by=key&sort_order=desc&per_page=10&page=3'))) == [f"key-{n:02d}" for n in range(4, -1, -1)]
+    # Сортировка по текущему состоянию ключа идет в памяти, по всем ключам
+    assert shown(asyncio.run(get('sort_by=in_flight&sort_order=desc&per_page=1'))) == ['key-07']
+    # Неверные параметры заменяются допустимыми
+    assert len(shown(asyncio.run(get('per_page=abc&page=-1')))) == 25
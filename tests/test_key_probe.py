@@ -0,0 +1,80 @@
+import json
+import key_manager
+from key_probe import KEY_PROBE_INTERVAL, KEY_PROBE_QUARANTINE_INTERVAL, KEY_PROBE_READMIT_SUCCESSES, claim_due_keys, record_probe_result, is_key_error, get_error_reason
+
+
+def error_body(code, status, message, reason=None):
+    error = {'code': code, 'status': status, 'message': message}
+    if reason:
+        error['details'] = [{'@type': 'type.googleapis.com/google.rpc.ErrorInfo', 'reason': reason}]
+    return json.dumps({'error': error}).encode()
+
+
+INVALID_KEY = error_body(400, 'INVALID_ARGUMENT', 'API key not valid. Please pass a valid API key.', 'API_KEY_INVALID')
+NO_ACCESS = error_body(403, 'PERMISSION_DENIED', 'Permission denied on resource project.', 'CONSUMER_INVALID')
+
+
+def probe(key, status, body):
+    key_error = is_key_error(status, body)
+    return record_probe_result(key, status, key_error, get_error_reason(status, body) if key_error else None)
+
+
+def test_only_invalid_key_errors_are_key_errors():
+    assert is_key_error(400, INVALID_KEY)
+    assert is_key_error(403, error_body(403, 'PERMISSION_DENIED', 'API key not valid.'))
+    assert not is_key_error(403, NO_ACCESS)
+    assert not is_key_error(401, b'Unauthorized')
+    assert not is_key_error(429, INVALID_KEY)
+    assert get_error_reason(400, INVALID_KEY) == 'API_KEY_INVALID'
+
+
+def test_claim_due_keys(key_pool):
+    key_pool(['key-a', 'key-b', 'key-c'])
+    key_manager.apply_config_keys([], ['key-c'])
+    now = 1000000.0
+    # Новые ключи проверяются сразу, отключенные - никогда
+    assert sorted(claim_due_keys(now, set())) == ['key-a', 'key-b']
+    assert claim_due_keys(now + 1, set()) == []
+    assert claim_due_keys(now + 1, {'key-a', 'key-c', 'unknown'}) == ['key-a']
+    assert sorted(claim_due_keys(now + KEY_PROBE_INTERVAL + 2, set())) == ['key-a', 'key-b']
+
+
+def test_quarantine_only_on_invalid_key(key_pool):
+    key_pool(['key-a', 'key-b'])
+    state, change = probe('key-a', 403, NO_ACCESS)
+    assert change is None
+    assert state['quarantined_at'] is None
+    assert state['probe_failures'] == 1
+
+    state, change = probe('key-b', 400, INVALID_KEY)
+    assert change == 'quarantined'
+    assert state['quarantine_reason'] == 'API_KEY_INVALID'
+    assert probe('key-b', 400, INVALID_KEY)[1] is None
+
+    for _ in range(KEY_PROBE_READMIT_SUCCESSES - 1):
+        assert probe('key-b', 200, b'{}')[1] is None
+    state, change = probe('key-b', 200, b'{}')
+    assert change == 'readmitted'
+    assert state['quarantined_at'] is None
+    assert record_probe_result('unknown', 200, False, None) == (None, None)
+
+
+def test_failed_probes_back_off(key_pool):
+    key_pool(['key-a', 'key-b'])
+    now = 1000000.0
+    claim_due_keys(now, set())
+    probe('key-a', 503, b'')
+    probe('key-a', 403, NO_ACCESS)
+    probe('key-b', 200, b'{}')
+    # Две неудачи подряд: следующая проверка через 4 интервала
+    assert claim_due_keys(now + KEY_PROBE_INTERVAL + 1, set()) == ['key-b']
+    assert 'key-a' not in claim_due_keys(now + 3 * KEY_PROBE_INTERVAL + 1, set())
+    assert 'key-a' in claim_due_keys(now + 4 * KEY_PROBE_INTERVAL + 1, set())
+    # Успех сбрасывает отсрочку
+    assert probe('key-a', 200, b'{}')[0]['probe_failures'] == 0
+
+    # Ключ в карантине проверяется со своим, более коротким интервалом
+    probe('key-b', 400, INVALID_KEY)
+    later = now + 10 * KEY_PROBE_INTERVAL
+    claim_due_keys(later, set())
+    assert claim_due_keys(later + KEY_PROBE_QUARANTINE_INTERVAL + 1, set()) == ['key-b']
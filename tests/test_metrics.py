@@ -0,0 +1,41 @@
+import asyncio
+import main
+from metrics import ModelLabels, render_stats, route_label, requests_total
+
+
+def test_unknown_models_share_one_label():
+    labels = ModelLabels(max_models=2)
+    # Модель из пути запроса, на которую апстрим ответил ошибкой, своей метки не получает
+    assert labels.label('made-up-model', success=False) == 'other'
+    assert labels.label('gemini-a', success=True) == 'gemini-a'
+    assert labels.label('gemini-a') == 'gemini-a'
+    assert labels.label('gemini-b', success=True) == 'gemini-b'
+    assert labels.label('gemini-c', success=True) == 'other'
+    assert labels.label('') == ''
+
+
+def test_stats_are_rendered_with_their_type():
+    assert render_stats('gemini_proxy_context_cache_', {'hits': 3, 'created': 1}) == [
+        '# TYPE gemini_proxy_context_cache_hits_total counter',
+        'gemini_proxy_context_cache_hits_total 3',
+        '# TYPE gemini_proxy_context_cache_created_total counter',
+        'gemini_proxy_context_cache_created_total 1',
+    ]
+    assert render_stats('gemini_proxy_response_cache_', {'bytes': 10}, suffix='', metric_type='gauge') == [
+        '# TYPE gemini_proxy_response_cache_bytes gauge',
+        'gemini_proxy_response_cache_bytes 10',
+    ]
+
+
+def test_route_label_is_bounded_for_unauthenticated_requests(key_pool):
+    key_pool(['pool-key'])
+
+    async def run():
+        client = main.app.test_client()
+        return [(await client.get(f'/v1beta/foo{index}')).status_code for index in range(20)]
+
+    assert asyncio.run(run()) == [401] * 20
+    routes = {labels[0] for labels in requests_total._values}
+    assert not any(route.startswith('foo') for route in routes)
+    assert ('other', '', '401') in requests_total._values
+    assert route_label('generateContent') == 'generateContent'
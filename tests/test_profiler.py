@@ -0,0 +1,31 @@
+import asyncio
+from profiler import Profiler, StackSampler
+
+
+def test_sampler_stops_without_blocking_the_loop():
+    async def run():
+        sampler = StackSampler(0, interval=0.01)
+        sampler.start()
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0)
+
+        ticker = asyncio.ensure_future(tick())
+        await asyncio.sleep(0.03)
+        before = ticks
+        # Остановка ждет поток сэмплера в executor, цикл событий тем временем работает
+        await sampler.stop()
+        ticker.cancel()
+        return ticks > before, sampler._thread.is_alive()
+
+    assert asyncio.run(run()) == (True, False)
+
+
+def test_sampling_profile_report():
+    report = asyncio.run(Profiler().run('sampling', seconds=0.05))
+    assert report.startswith('# sampling profile of worker')
+    assert 'samples every' in report
@@ -0,0 +1,94 @@
+import json
+import asyncio
+import main
+import rate_limits
+from benchmark import fake_gemini as fake
+from rate_limits import RateLimiter, TokenBucket, parse_retry_delay
+
+
+def test_parse_retry_delay():
+    body = json.dumps({'error': {'code': 429, 'details': [{'@type': 'type.googleapis.com/google.rpc.RetryInfo', 'retryDelay': '39s'}]}})
+    assert parse_retry_delay(body) == 39.0
+    assert parse_retry_delay(json.dumps({'error': {'details': [{'retryDelay': '1.5s'}]}})) == 1.5
+    assert parse_retry_delay(json.dumps({'error': {'details': [{'retryDelay': 'soon'}]}})) is None
+    assert parse_retry_delay(json.dumps({'error': {'code': 429}})) is None
+    assert parse_retry_delay('Quota exceeded') is None
+    assert parse_retry_delay('[]') is None
+
+
+def test_token_bucket_refills_continuously():
+    bucket = TokenBucket(60, 60.0)
+    now = bucket.updated_at
+    bucket.consume(60, now)
+    assert bucket.seconds_until_available(now) == 1.0
+    assert bucket.seconds_until_available(now + 0.5) == 0.5
+    assert bucket.seconds_until_available(now + 1) == 0.0
+    # Бакет не наполняется сверх емкости
+    bucket.refill(now + 3600)
+    assert bucket.tokens == 60
+
+
+def test_usage_is_debited_from_tpm(monkeypatch):
+    monkeypatch.setattr(rate_limits, 'RATE_LIMITS', {'*': {'rpm': 100, 'tpm': 1000}})
+    limiter = RateLimiter()
+    assert limiter.tracks_tokens('gemini')
+    limiter.record_request('key', 'gemini')
+    assert limiter.is_available('key', 'gemini')
+    # Реальный расход может увести бакет в минус: ключ свободен снова, когда TPM восполнится
+    limiter.record_usage('key', 'gemini', 1500)
+    assert not limiter.is_available('key', 'gemini')
+    assert limiter.get_unavailable_keys() == {'key'}
+    assert 30 < limiter.seconds_until_available(['key'], 'gemini') <= 31
+
+
+def test_states_are_bounded(monkeypatch):
+    monkeypatch.setattr(rate_limits, 'RATE_LIMITS', {'*': {'rpm': 10}})
+    limiter = RateLimiter(max_states=3)
+    for i in range(10):
+        limiter.record_request('key', f'model-{i}')
+    assert len(limiter._states) == 3
+    assert ('key', 'model-9') in limiter._states
+
+    # Без лимитов состояние заводится только для паузы после 429
+    monkeypatch.setattr(rate_limits, 'RATE_LIMITS', {})
+    limiter = RateLimiter()
+    limiter.record_request('key', 'model')
+    limiter.record_usage('key', 'model', 100)
+    assert not limiter._states
+    assert limiter.seconds_until_available(['key'], 'model') == 0.0
+    assert not limiter._states
+
+
+def test_idle_states_are_pruned(monkeypatch):
+    monkeypatch.setattr(rate_limits, 'RATE_LIMITS', {'*': {'rpm': 60}})
+    monkeypatch.setattr(rate_limits, 'RATE_LIMIT_PRUNE_INTERVAL', 0)
+    limiter = RateLimiter()
+    limiter.record_request('key', 'used')
+    limiter.record_rate_limited('key', 'cooling', 60)
+    limiter._states[('key', 'used')].buckets['rpm'].updated_at -= 60
+    # Полный бакет без паузы удаляется, пара на паузе остается
+    assert limiter.get_unavailable_keys() == {'key'}
+    assert set(limiter._states) == {('key', 'cooling')}
+
+
+def test_rate_limited_keys_answer_429_with_retry_after(key_pool, fake_gemini, monkeypatch):
+    key_pool(['key-a', 'key-b'])
+    monkeypatch.setattr(fake, 'RATE_429', 1.0)
+    body = json.dumps({'contents': [{'parts': [{'text': 'hi'}]}]})
+    headers = {'X-Goog-Api-Key': 'user-key', 'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+
+    async def run():
+        async with fake_gemini():
+            client = main.app.test_client()
+            first = await client.post('/v1beta/models/gemini:generateContent', data=body, headers=headers)
+            # Оба ключа на паузе: второй запрос отклоняется, не доходя до апстрима
+            second = await client.post('/v1beta/models/gemini:generateContent', data=body, headers=headers)
+            return first, second
+
+    first, second = asyncio.run(run())
+    assert first.status_code == 429
+    assert first.headers['Retry-After'] == '5'
+    assert b'RESOURCE_EXHAUSTED' in asyncio.run(first.get_data())
+    assert second.status_code == 429
+    assert second.headers['Retry-After'] == '5'
+    assert main.rate_limiter.get_unavailable_keys() == {'key-a', 'key-b'}
@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+import request_body
+from werkzeug.exceptions import RequestEntityTooLarge
+from request_body import REQUEST_BODY_MEMORY_LIMIT, RequestBody
+from request_timing import RequestTiming, request_timing_var
+
+
+class StreamedRequest:
+    """Stand-in for a Quart request whose body arrives in chunks."""
+
+    method = 'POST'
+
+    def __init__(self, chunks, content_length):
+        self._chunks = chunks
+        self.content_length = content_length
+
+    @property
+    def body(self):
+        async def iterate():
+            for chunk in self._chunks:
+                await asyncio.sleep(0)
+                yield chunk
+        return iterate()
+
+
+async def read_all(chunks):
+    return b''.join([chunk async for chunk in chunks])
+
+
+def test_large_body_is_spooled_and_replayed():
+    chunks = [bytes([i]) * (256 * 1024) for i in range(8)]
+    expected = b''.join(chunks)
+    assert len(expected) > REQUEST_BODY_MEMORY_LIMIT
+
+    async def run():
+        timing = RequestTiming('test', 'POST', '/v1beta/files', 'upload')
+        request_timing_var.set(timing)
+        request_body = RequestBody(StreamedRequest(chunks, len(expected)), replayable=True)
+        try:
+            # Две попытки одновременно (хеджирование) и повтор после них видят все тело
+            first, second = await asyncio.gather(read_all(await request_body.content()), read_all(await request_body.content()))
+            retry = await read_all(await request_body.content())
+        finally:
+            request_body.close()
+        return first, second, retry, timing
+
+    first, second, retry, timing = asyncio.run(run())
+    assert first == second == retry == expected
+    assert 'thread_wait' in timing.phases
+
+
+def test_body_of_unknown_length_is_spooled():
+    chunks = [b'{"a":', b' 1}']
+
+    async def run():
+        request_body = RequestBody(StreamedRequest(chunks, None), replayable=True)
+        try:
+            return await read_all(await request_body.content()), await read_all(await request_body.content())
+        finally:
+            request_body.close()
+
+    assert asyncio.run(run()) == (b'{"a": 1}', b'{"a": 1}')
+
+
+def test_streamed_body_over_size_limit_is_refused(monkeypatch):
+    monkeypatch.setattr(request_body, 'MAX_REQUEST_BODY_SIZE', 3 * 1024 * 1024)
+    chunks = [b'x' * (1024 * 1024)] * 4
+
+    async def run(replayable):
+        # Без Content-Length размер тела становится известен только по мере чтения
+        body = RequestBody(StreamedRequest(chunks, None), replayable=replayable)
+        try:
+            return await read_all(await body.content())
+        finally:
+            body.close()
+
+    for replayable in (False, True):
+        with pytest.raises(RequestEntityTooLarge):
+            asyncio.run(run(replayable))
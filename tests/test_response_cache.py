@@ -0,0 +1,38 @@
+import os
+import time
+import asyncio
+from response_cache import ResponseCache
+
+
+def test_repeated_headers_survive_the_disk_tier(tmp_path):
+    headers = [('Content-Type', 'application/json'), ('Set-Cookie', 'a=1'), ('Set-Cookie', 'b=2')]
+
+    async def run():
+        await ResponseCache(1024, str(tmp_path)).put('k', 'countTokens', 200, headers, b'{}')
+        # Новый экземпляр (другой воркер или перезапуск) читает запись с диска
+        return await ResponseCache(1024, str(tmp_path)).get('k')
+
+    assert asyncio.run(run()) == (200, headers, b'{}')
+
+
+def test_sweep_removes_expired_and_least_recently_used_files(tmp_path):
+    cache = ResponseCache(1024 * 1024, str(tmp_path), disk_max_bytes=400)
+
+    async def run():
+        for name in ('old', 'used', 'new'):
+            await cache.put(name, 'countTokens', 200, [], b'x' * 100)
+        # Запись "used" читали недавно, "old" - давно
+        os.utime(cache._path('old'), (time.time() - 30, time.time() - 30))
+        os.utime(cache._path('used'), (time.time() - 20, time.time() - 20))
+        await ResponseCache(1024, str(tmp_path)).get('used')
+        # Истекшая запись и временный файл прерванной записи
+        cache._write_file('expired', (time.time() - 1, 200, [], b'x' * 10))
+        with open(cache._path('abandoned') + '.tmp', 'wb') as f:
+            f.write(b'partial')
+        os.utime(cache._path('abandoned') + '.tmp', (0, 0))
+        await cache.sweep_disk()
+
+    asyncio.run(run())
+    assert sorted(os.listdir(tmp_path)) == ['new.bin', 'used.bin']
+    assert cache.stats['disk_removed'] == 3
+    assert cache.get_stats()['disk_bytes'] <= 400
@@ -0,0 +1,129 @@
+import time
+import sqlite3
+import asyncio
+import shared_state
+from shared_state import SqliteKeyStateBackend, RedisKeyStateBackend
+
+
+class LocalRedis:
+    """In-process stand-in for the Redis commands used by RedisKeyStateBackend (values kept as strings, like decode_responses=True)."""
+
+    def __init__(self):
+        self.data = {}
+
+    def delete(self, name):
+        self.data.pop(name, None)
+
+    def expire(self, name, seconds):
+        pass
+
+    def hset(self, name, mapping):
+        self.data.setdefault(name, {}).update({field: str(value) for field, value in mapping.items()})
+
+    def hgetall(self, name):
+        return dict(self.data.get(name, {}))
+
+    def hmget(self, name, fields):
+        values = self.data.get(name, {})
+        return [values.get(field) for field in fields]
+
+    def hdel(self, name, *fields):
+        for field in fields:
+            self.data.get(name, {}).pop(field, None)
+
+    def zadd(self, name, mapping):
+        self.data.setdefault(name, {}).update(mapping)
+
+    zrem = hdel
+
+    def zrangebyscore(self, name, low, high):
+        items = sorted(self.data.get(name, {}).items(), key=lambda item: item[1])
+        return [member for member, score in items if float(low) <= score <= float(high)]
+
+    def zrange(self, name, start, end):
+        return self.zrangebyscore(name, '-inf', '+inf')
+
+    def zremrangebyscore(self, name, low, high):
+        self.zrem(name, *self.zrangebyscore(name, low, high))
+
+
+class LocalRedisClient:
+    def __init__(self, server):
+        self.server = server
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self.server)
+
+    async def aclose(self):
+        pass
+
+    def __getattr__(self, command):
+        async def call(*args, **kwargs):
+            return getattr(self.server, command)(*args, **kwargs)
+        return call
+
+
+class LocalPipeline:
+    def __init__(self, server):
+        self.server = server
+        self.commands = []
+
+    def __getattr__(self, command):
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+        return queue
+
+    async def execute(self):
+        return [getattr(self.server, command)(*args, **kwargs) for command, args, kwargs in self.commands]
+
+
+def redis_backend(server):
+    backend = RedisKeyStateBackend('redis://localhost:6379/0', 'test:', worker_ttl=0.05)
+    backend._redis = LocalRedisClient(server)
+    return backend
+
+
+def test_default_backend_does_not_share_state():
+    assert shared_state.KEY_STATE_BACKEND == 'local'
+    assert shared_state.create_key_state_backend() is None
+
+
+def test_sqlite_workers_exchange_state_and_prune_old_streaks(tmp_path):
+    database_file = str(tmp_path / 'keys.db')
+    first = SqliteKeyStateBackend(database_file, worker_ttl=5)
+    second = SqliteKeyStateBackend(database_file, worker_ttl=5)
+
+    async def run():
+        await first.exchange('first', {'key-a': 2}, [('key-a', 'gemini', time.time() + 60)], {'key-a': 3, 'key-old': 1})
+        # Серия, которая не менялась дольше STREAK_RETENTION
+        conn = sqlite3.connect(database_file)
+        with conn:
+            conn.execute("UPDATE key_state_streaks SET updated_at = ? WHERE key_id = 'key-old'", (time.time() - shared_state.STREAK_RETENTION - 1,))
+        conn.close()
+        return await second.exchange('second', {}, [], {})
+
+    remote_in_flight, cooldowns, streaks = asyncio.run(run())
+    assert remote_in_flight == {'key-a': 2}
+    assert [(key, model) for key, model, _ in cooldowns] == [('key-a', 'gemini')]
+    assert streaks == {'key-a': 3}
+
+
+def test_redis_streaks_are_read_when_changed_and_pruned_when_stale():
+    server = LocalRedis()
+    first = redis_backend(server)
+    second = redis_backend(server)
+
+    async def run():
+        await first.exchange('first', {'key-a': 1}, [], {'key-a': 3, 'key-old': 1})
+        seen = await second.exchange('second', {}, [], {})
+        server.data['test:streaks_updated']['key-a'] = time.time() - 1
+        server.data['test:streaks_updated']['key-old'] = time.time() - shared_state.STREAK_RETENTION - 1
+        # Без новых изменений второй воркер не перечитывает серии
+        unchanged = await second.exchange('second', {}, [], {})
+        return seen, unchanged
+
+    seen, unchanged = asyncio.run(run())
+    assert seen == ({'key-a': 1}, [], {'key-a': 3, 'key-old': 1})
+    assert unchanged[2] == {}
+    assert server.data['test:streaks'] == {'key-a': '3'}
+    assert set(server.data['test:streaks_updated']) == {'key-a'}
@@ -0,0 +1,94 @@
+import asyncio
+from quart import Response
+import singleflight
+from singleflight import StreamBroadcast
+from upstream import StreamBody
+
+
+class UpstreamBody:
+    """Stand-in for a relayed upstream stream that records how far it was read and whether it was released."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.sent = 0
+        self.released = False
+
+    async def iterate(self):
+        try:
+            for chunk in self.chunks:
+                self.sent += 1
+                yield chunk
+                await asyncio.sleep(0)
+        finally:
+            self.released = True
+
+    async def release_unstarted(self):
+        self.released = True
+
+    def response_body(self):
+        return Response(StreamBody(self.iterate(), self.release_unstarted)).response
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_stream_cancelled_before_it_started_releases_upstream():
+    async def run():
+        upstream = UpstreamBody([b'data: {}\r\n\r\n'] * 3)
+        broadcast = StreamBroadcast(upstream.response_body())
+        # Единственный подписчик уходит до первого шага задачи чтения
+        await broadcast.join().aclose()
+        await settle()
+        assert upstream.sent == 0
+        assert upstream.released
+
+    asyncio.run(run())
+
+
+def test_late_joins_stop_once_the_buffer_is_full(monkeypatch):
+    monkeypatch.setattr(singleflight, 'SINGLE_FLIGHT_STREAM_BUFFER', 100)
+    chunks = [bytes([i]) * 40 for i in range(10)]
+
+    async def run():
+        upstream = UpstreamBody(chunks)
+        broadcast = StreamBroadcast(upstream.response_body())
+        first = broadcast.join()
+        assert await first.__anext__() == chunks[0]
+        await settle()
+        # В буфере не больше лимита и одного чанка сверх него; начало стрима уже не хранится
+        assert broadcast._size <= 140
+        assert upstream.sent < len(chunks)
+        assert broadcast.join() is None
+
+        received = [chunks[0]] + [chunk async for chunk in first]
+        assert received == chunks
+        assert upstream.released
+
+    asyncio.run(run())
+
+
+def test_pump_stops_when_no_one_can_join(monkeypatch):
+    monkeypatch.setattr(singleflight, 'SINGLE_FLIGHT_STREAM_BUFFER', 100)
+
+    async def run():
+        upstream = UpstreamBody([b'x' * 40] * 10)
+        broadcast = StreamBroadcast(upstream.response_body())
+        await settle()
+        assert broadcast.join() is None
+        assert upstream.released
+        assert upstream.sent < 10
+
+    asyncio.run(run())
+
+
+def test_shared_response_keeps_repeated_headers():
+    async def run():
+        response = Response(b'{}', headers=[('Vary', 'Origin'), ('Vary', 'Accept-Encoding'), ('X-Trace', '1')])
+        shared = await singleflight.SharedResponse.from_response(response)
+        return [shared.to_response() for _ in range(2)]
+
+    for response in asyncio.run(run()):
+        assert response.headers.getlist('Vary') == ['Origin', 'Accept-Encoding']
+        assert response.headers['X-Trace'] == '1'
@@ -0,0 +1,65 @@
+import asyncio
+import httpx
+import main
+from quart import request
+from hedging import discard_response
+from metrics import streams_in_flight
+
+SUBPATH = 'models/gemini-test:streamGenerateContent'
+
+
+class UpstreamStream(httpx.AsyncByteStream):
+    """Stand-in for an upstream SSE body that records whether it was closed."""
+
+    def __init__(self, events):
+        self.events = events
+        self.closed = False
+
+    async def __aiter__(self):
+        for event in self.events:
+            yield event
+
+    async def aclose(self):
+        self.closed = True
+
+
+def open_stream(monkeypatch, stream):
+    async def send_upstream_request(method, url, **kwargs):
+        return httpx.Response(200, headers={'Content-Type': 'text/event-stream'}, stream=stream)
+
+    monkeypatch.setattr(main, 'send_upstream_request', send_upstream_request)
+    done = []
+
+    async def run(consume):
+        async with main.app.test_request_context(f'/v1beta/{SUBPATH}', method='POST', data=b'{}'):
+            response, success = await main.make_google_api_request('test-key', SUBPATH, request, 'header_goog', on_done=lambda: done.append(True))
+            assert success and done == []
+            return await consume(response)
+
+    return done, run
+
+
+def test_discarded_stream_releases_upstream_and_key(monkeypatch):
+    stream = UpstreamStream([b'data: {}\r\n\r\n'] * 3)
+    done, run = open_stream(monkeypatch, stream)
+    in_flight = dict(streams_in_flight._values)
+
+    # Так хеджирование закрывает успешный ответ проигравшей попытки, который клиенту не отправлялся
+    asyncio.run(run(discard_response))
+
+    assert stream.closed
+    assert done == [True]
+    assert dict(streams_in_flight._values) == in_flight
+
+
+def test_relayed_stream_releases_key_once(monkeypatch):
+    stream = UpstreamStream([b'data: {}\r\n\r\n'] * 3)
+    done, run = open_stream(monkeypatch, stream)
+
+    async def relay(response):
+        async with response.response as body:
+            return [chunk async for chunk in body]
+
+    assert asyncio.run(run(relay)) == [b'data: {}\r\n\r\n'] * 3
+    assert stream.closed
+    assert done == [True]
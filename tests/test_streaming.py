@@ -0,0 +1,43 @@
+import time
+import asyncio
+from quart import request
+import main
+
+STREAMS = 8
+EVENTS = 10
+EVENT_INTERVAL = 0.05
+SUBPATH = 'models/gemini-test:streamGenerateContent'
+
+
+async def relay_one(started_at):
+    """Streams one response through the proxy; returns (first event time, end time, events)."""
+    async with main.app.test_request_context(f'/v1beta/{SUBPATH}', method='POST', data=b'{}'):
+        response, success = await main.make_google_api_request('test-key', SUBPATH, request, 'header_goog')
+    assert success
+    first_at = None
+    body = b''
+    async with response.response as chunks:
+        async for chunk in chunks:
+            if first_at is None:
+                first_at = time.monotonic() - started_at
+            body += chunk
+    return first_at, time.monotonic() - started_at, body.count(b'data: ')
+
+
+def test_concurrent_streams_do_not_block_each_other(fake_gemini, monkeypatch):
+    """Streams from a local fake SSE server are relayed side by side, not one after another."""
+
+    async def run():
+        async with fake_gemini() as fake:
+            monkeypatch.setattr(fake, 'STREAM_CHUNKS', EVENTS)
+            monkeypatch.setattr(fake, 'TOKEN_INTERVAL', EVENT_INTERVAL)
+            started_at = time.monotonic()
+            return await asyncio.gather(*(relay_one(started_at) for _ in range(STREAMS))), time.monotonic() - started_at
+
+    results, elapsed = asyncio.run(run())
+    stream_time = (EVENTS - 1) * EVENT_INTERVAL
+    assert all(events == EVENTS for _, _, events in results)
+    # Каждый стрим получил первое событие раньше, чем закончился любой другой
+    assert max(first_at for first_at, _, _ in results) < min(ended_at for _, ended_at, _ in results)
+    # Поочередная пересылка заняла бы STREAMS * stream_time
+    assert elapsed < stream_time * STREAMS / 2
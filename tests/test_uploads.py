@@ -0,0 +1,28 @@
+import asyncio
+from urllib.parse import urlsplit
+import main
+import uploads
+
+
+def test_upload_session_requires_user_key(key_pool, fake_gemini, monkeypatch):
+    key_pool(['pool-key'])
+    monkeypatch.setattr(main, 'UPLOAD_SESSION_REQUIRE_KEY', True)
+
+    async def run():
+        async with fake_gemini():
+            client = main.app.test_client()
+            start = await client.post('/upload/v1beta/files', data=b'{}', headers={'X-Goog-Api-Key': 'user-key', 'Content-Length': '2', 'X-Goog-Upload-Protocol': 'resumable'})
+            upload_url = urlsplit(start.headers['X-Goog-Upload-URL'])
+            session_path = f"{upload_url.path}?{upload_url.query}"
+            headers = {'Content-Length': '4', 'X-Goog-Upload-Offset': '0', 'X-Goog-Upload-Command': 'upload, finalize'}
+            # Одной ссылки на загрузку недостаточно, чтобы воспользоваться ключом из пула
+            anonymous = await client.post(session_path, data=b'data', headers=headers)
+            authorized = await client.post(session_path, data=b'data', headers={**headers, 'X-Goog-Api-Key': 'user-key'})
+            return start, anonymous, authorized
+
+    start, anonymous, authorized = asyncio.run(run())
+    assert start.status_code == 200
+    assert uploads.UPLOAD_KEY_PARAM in start.headers['X-Goog-Upload-URL']
+    assert anonymous.status_code == 401
+    assert authorized.status_code == 200
+    assert b'"sizeBytes"' in asyncio.run(authorized.get_data())
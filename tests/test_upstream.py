@@ -0,0 +1,87 @@
+import gzip
+import json
+import zlib
+import asyncio
+import httpx
+import main
+from response_cache import ResponseCache
+from upstream import get_passthrough_encoding, decode_for_client, make_decoder
+
+COUNT_TOKENS_PATH = '/v1beta/models/gemini:countTokens'
+
+
+def decode_in_pieces(coding, data, size=7):
+    decoder = make_decoder(coding)
+    return b''.join(decoder.decompress(data[i:i + size]) for i in range(0, len(data), size))
+
+
+def test_decoders_accept_zlib_and_raw_deflate():
+    body = b'{"totalTokens": 42}' * 20
+    raw = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    assert decode_in_pieces('deflate', zlib.compress(body)) == body
+    assert decode_in_pieces('deflate', raw.compress(body) + raw.flush()) == body
+    assert decode_in_pieces('gzip', gzip.compress(body)) == body
+
+
+def test_passthrough_encoding_follows_client_accept_encoding():
+    response = httpx.Response(200, headers={'Content-Encoding': 'gzip'})
+    assert get_passthrough_encoding(response, 'gzip, deflate') == 'gzip'
+    assert get_passthrough_encoding(response, 'identity') is None
+    assert get_passthrough_encoding(response, None) is None
+    assert get_passthrough_encoding(httpx.Response(200), 'gzip') is None
+
+
+def test_decode_for_client():
+    body = b'{"totalTokens": 42}'
+    headers = [('Content-Type', 'application/json'), ('Content-Encoding', 'gzip'), ('Content-Length', '39')]
+    compressed = gzip.compress(body)
+    assert decode_for_client(headers, compressed, 'gzip') == (headers, compressed)
+    assert decode_for_client(headers, compressed, 'identity') == ([('Content-Type', 'application/json')], body)
+
+
+def test_clients_get_their_encoding_also_from_the_cache(key_pool, fake_gemini, monkeypatch):
+    key_pool(['pool-key'])
+    monkeypatch.setattr(main, 'RESPONSE_CACHE_ENABLED', True)
+    monkeypatch.setattr(main, 'response_cache', ResponseCache(1024 * 1024))
+    body = json.dumps({'contents': [{'parts': [{'text': 'hi'}]}]})
+
+    async def count_tokens(client, accept_encoding):
+        headers = {'X-Goog-Api-Key': 'user-key', 'Content-Type': 'application/json', 'Content-Length': str(len(body)), 'Accept-Encoding': accept_encoding}
+        response = await client.post(COUNT_TOKENS_PATH, data=body, headers=headers)
+        return response, await response.get_data()
+
+    async def run():
+        async with fake_gemini():
+            client = main.app.test_client()
+            return [await count_tokens(client, accept_encoding) for accept_encoding in ('gzip', 'gzip', 'identity')]
+
+    (miss, miss_body), (hit, hit_body), (decoded, decoded_body) = asyncio.run(run())
+    # Сжатый ответ апстрима уходит клиенту с gzip без распаковки
+    assert miss.headers['X-Cache'] == 'MISS'
+    assert miss.headers['Content-Encoding'] == 'gzip'
+    assert 'totalTokens' in json.loads(gzip.decompress(miss_body))
+    assert hit.headers['X-Cache'] == 'HIT'
+    assert hit.headers['Content-Encoding'] == 'gzip'
+    assert hit_body == miss_body
+    # Клиенту без gzip тот же ответ из кэша отдается распакованным
+    assert decoded.headers['X-Cache'] == 'HIT'
+    assert 'Content-Encoding' not in decoded.headers
+    assert int(decoded.headers['Content-Length']) == len(decoded_body)
+    assert json.loads(decoded_body) == json.loads(gzip.decompress(miss_body))
+
+
+def test_identity_client_gets_decoded_response(key_pool, fake_gemini):
+    key_pool(['pool-key'])
+    body = json.dumps({'contents': [{'parts': [{'text': 'hi'}]}]})
+
+    async def run():
+        async with fake_gemini():
+            headers = {'X-Goog-Api-Key': 'user-key', 'Content-Type': 'application/json', 'Content-Length': str(len(body)), 'Accept-Encoding': 'identity'}
+            response = await main.app.test_client().post('/v1beta/models/gemini:generateContent', data=body, headers=headers)
+            return response, await response.get_data()
+
+    response, data = asyncio.run(run())
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert int(response.headers['Content-Length']) == len(data)
+    assert 'candidates' in json.loads(data)
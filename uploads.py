@@ -0,0 +1,54 @@
+import os
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from shared_state import key_id
+
+# Внешний адрес прокси для ссылок на загрузку, например https://your-domain.com; пусто - из заголовков запроса
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', '').rstrip('/')
+
+# Параметр ссылки на загрузку, которым сессия загрузки привязана к ключу из пула (отпечаток ключа, не сам ключ)
+UPLOAD_KEY_PARAM = 'proxy_key_id'
+# Сколько ключей из пула пробовать при начале загрузки
+UPLOAD_START_ATTEMPTS = int(os.environ.get('UPLOAD_START_ATTEMPTS', '3'))
+# Требовать ключ пользователя прокси в запросах сессии загрузки; без этого upload_id из ссылки сам дает доступ к ключу из пула
+UPLOAD_SESSION_REQUIRE_KEY = os.environ.get('UPLOAD_SESSION_REQUIRE_KEY', '1').lower() not in ('0', 'false', 'no')
+
+
+def is_upload_session_request(args):
+    """True for requests of an already started resumable upload (upload, query, cancel)."""
+    return 'upload_id' in args
+
+
+def get_public_base_url(request):
+    """Address clients use to reach the proxy, honouring X-Forwarded-* headers of a reverse proxy."""
+    if PUBLIC_BASE_URL:
+        return PUBLIC_BASE_URL
+    scheme = request.headers.get('X-Forwarded-Proto', request.scheme).split(',')[0].strip()
+    host = request.headers.get('X-Forwarded-Host', request.host).split(',')[0].strip()
+    return f"{scheme}://{host}"
+
+
+def rewrite_upload_url(upload_url, public_base_url, pinned_key=None):
+    """Points an `X-Goog-Upload-URL` of Google at the proxy.
+
+    With `pinned_key` the pool key is dropped from the URL and its fingerprint is added
+    instead, so every request of the upload session goes upstream with the same key,
+    whichever worker or replica receives it.
+    """
+    parts = urlsplit(upload_url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if pinned_key is not None:
+        query = [(name, value) for name, value in query if name not in ('key', UPLOAD_KEY_PARAM)]
+        query.append((UPLOAD_KEY_PARAM, key_id(pinned_key)))
+    base = urlsplit(public_base_url)
+    return urlunsplit((base.scheme, base.netloc, base.path + parts.path, urlencode(query), ''))
+
+
+def find_pinned_key(args, keys):
+    """Returns the pool key an upload session is pinned to, or None."""
+    pinned_id = args.get(UPLOAD_KEY_PARAM)
+    if not pinned_id:
+        return None
+    for key in keys:
+        if key_id(key) == pinned_id:
+            return key
+    return None
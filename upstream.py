@@ -0,0 +1,291 @@
+import os
+import zlib
+import asyncio
+import logging
+import httpx
+from quart.wrappers.response import IterableBody
+from logging_setup import LOG_STREAM_CHUNK_SAMPLE
+
+try:
+    # Необязательная зависимость: с ней прокси принимает от апстрима и ответы в br
+    import brotli
+except ImportError:
+    brotli = None
+
+GOOGLE_API_HOST = "generativelanguage.googleapis.com"
+# Можно переопределить, например, чтобы направить прокси на локальный фейковый сервер (benchmark/fake_gemini.py)
+GOOGLE_API_BASE_URL = os.environ.get('GOOGLE_API_BASE_URL', f"https://{GOOGLE_API_HOST}").rstrip('/')
+
+# Настройки пула соединений к Google API
+UPSTREAM_HTTP2 = os.environ.get('UPSTREAM_HTTP2', '1').lower() not in ('0', 'false', 'no')
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get('UPSTREAM_MAX_CONNECTIONS', '200'))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('UPSTREAM_MAX_KEEPALIVE_CONNECTIONS', '50'))
+UPSTREAM_MAX_CONNECTIONS_PER_HOST = int(os.environ.get('UPSTREAM_MAX_CONNECTIONS_PER_HOST', '100'))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get('UPSTREAM_KEEPALIVE_EXPIRY', '60'))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '10'))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', '300'))
+# Размер чанка при стриминге; 0 - пересылать данные такими, какими они пришли от апстрима
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', '0')) or None
+# Сжатый ответ апстрима передается клиенту как есть, если клиент принимает эту кодировку
+RESPONSE_COMPRESSION_PASSTHROUGH = os.environ.get('RESPONSE_COMPRESSION_PASSTHROUGH', '1').lower() not in ('0', 'false', 'no')
+
+# Кодировки, которые прокси умеет распаковать сам, если клиент их не принимает
+SUPPORTED_ENCODINGS = ('gzip', 'deflate', 'br') if brotli is not None else ('gzip', 'deflate')
+
+# Hop-by-hop заголовки не должны пересылаться апстриму (а в HTTP/2 они запрещены)
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade', 'te', 'trailer', 'content-length'}
+
+_client = None
+
+
+def _host_limits():
+    """Builds connection limits for the upstream host transport."""
+    return httpx.Limits(
+        max_connections=min(UPSTREAM_MAX_CONNECTIONS, UPSTREAM_MAX_CONNECTIONS_PER_HOST),
+        max_keepalive_connections=min(UPSTREAM_MAX_KEEPALIVE_CONNECTIONS, UPSTREAM_MAX_CONNECTIONS_PER_HOST),
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+
+
+async def start_upstream_client():
+    """Creates the shared upstream HTTP client. Called once from the app startup hook."""
+    global _client
+    if _client is not None:
+        return _client
+
+    timeout = httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT)
+    limits = httpx.Limits(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+    # Отдельный транспорт для хоста Google API, чтобы ограничения на хост задавались независимо от общего пула
+    mounts = {
+        f"https://{GOOGLE_API_HOST}": httpx.AsyncHTTPTransport(http2=UPSTREAM_HTTP2, limits=_host_limits()),
+    }
+    _client = httpx.AsyncClient(http2=UPSTREAM_HTTP2, timeout=timeout, limits=limits, mounts=mounts)
+    logging.info("Upstream client started (http2=%s, max_connections=%d, per_host=%d)", UPSTREAM_HTTP2, UPSTREAM_MAX_CONNECTIONS, UPSTREAM_MAX_CONNECTIONS_PER_HOST)
+    return _client
+
+
+async def close_upstream_client():
+    """Closes the shared upstream HTTP client. Called from the app shutdown hook."""
+    global _client
+    if _client is None:
+        return
+    await _client.aclose()
+    _client = None
+    logging.info("Upstream client closed")
+
+
+def get_upstream_client():
+    """Returns the shared upstream client, failing loudly if startup hook has not run."""
+    if _client is None:
+        raise RuntimeError("Upstream client is not started")
+    return _client
+
+
+def filter_request_headers(headers):
+    """Drops headers that must not be forwarded to the upstream."""
+    return {key: value for key, value in headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+
+
+async def send_upstream_request(method, url, headers=None, params=None, content=None, content_length=None, stream=False, trace=None):
+    """Sends a request through the shared pool.
+
+    `content` may be an async iterable of bytes; its `content_length`, if known, is sent
+    instead of chunked transfer encoding. `trace` is an httpx trace extension callback.
+    With stream=True the caller owns the response and must close it with `await response.aclose()`.
+    """
+    client = get_upstream_client()
+    headers = filter_request_headers(headers or {})
+    if content_length is not None:
+        headers['Content-Length'] = str(content_length)
+    upstream_request = client.build_request(
+        method,
+        url,
+        headers=headers,
+        params=params,
+        content=content,
+        extensions={'trace': trace} if trace is not None else None,
+    )
+    return await client.send(upstream_request, stream=stream)
+
+
+def parse_accept_encoding(value):
+    """Returns {coding: q} of an Accept-Encoding header."""
+    codings = {}
+    for part in (value or '').split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, q_value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(q_value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def accepts_encoding(accept_encoding, coding):
+    """Checks whether a client sending `accept_encoding` takes a body in `coding`; no header means identity only."""
+    codings = parse_accept_encoding(accept_encoding)
+    return codings.get(coding, codings.get('*', 0.0)) > 0
+
+
+def upstream_accept_encoding(client_accept_encoding):
+    """Accept-Encoding for the upstream: the client's codings the proxy can also decode, or all of those."""
+    accepted = [coding for coding in SUPPORTED_ENCODINGS if accepts_encoding(client_accept_encoding, coding)]
+    return ', '.join(accepted or SUPPORTED_ENCODINGS)
+
+
+def get_passthrough_encoding(response, client_accept_encoding):
+    """Returns the upstream Content-Encoding if the body can go to the client without decoding, else None."""
+    coding = response.headers.get('Content-Encoding', '').strip().lower()
+    if not RESPONSE_COMPRESSION_PASSTHROUGH or coding in ('', 'identity') or coding not in SUPPORTED_ENCODINGS:
+        return None
+    return coding if accepts_encoding(client_accept_encoding, coding) else None
+
+
+class _BrotliDecoder:
+    def __init__(self):
+        self._decoder = brotli.Decompressor()
+
+    def decompress(self, data):
+        return self._decoder.process(data)
+
+
+class _DeflateDecoder:
+    """`deflate` is meant to be zlib-wrapped, but some servers send raw deflate; like httpx, both are accepted."""
+
+    def __init__(self):
+        self._decoder = zlib.decompressobj()
+        self._first = True
+
+    def decompress(self, data):
+        first, self._first = self._first, False
+        try:
+            return self._decoder.decompress(data)
+        except zlib.error:
+            if not first:
+                raise
+            # Без заголовка zlib ошибка видна уже на первом чанке
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decoder.decompress(data)
+
+
+def make_decoder(coding):
+    """Incremental decoder of a SUPPORTED_ENCODINGS coding with a zlib-like decompress(data)."""
+    if coding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if coding == 'deflate':
+        return _DeflateDecoder()
+    return _BrotliDecoder()
+
+
+def decode_body(body, coding):
+    return make_decoder(coding).decompress(body)
+
+
+def decode_for_client(headers, body, client_accept_encoding):
+    """Returns (headers, body) of a stored response decoded if the client does not accept its encoding.
+
+    `headers` is a list of (name, value) pairs.
+    """
+    coding = next((value.strip().lower() for name, value in headers if name.lower() == 'content-encoding'), '')
+    if coding in ('', 'identity') or accepts_encoding(client_accept_encoding, coding):
+        return headers, body
+    headers = [(name, value) for name, value in headers if name.lower() not in ('content-encoding', 'content-length')]
+    return headers, decode_body(body, coding)
+
+
+async def read_body(response, raw=False):
+    """Reads the whole body of a streamed response, as sent (raw) or decoded, and releases the connection."""
+    try:
+        if not raw:
+            return await response.aread()
+        # Один чанк join возвращает без копирования
+        return b''.join([chunk async for chunk in response.aiter_raw()])
+    finally:
+        await response.aclose()
+
+
+async def relay_stream(response, chunk_size=None, raw=False):
+    """Yields upstream body bytes as they arrive and always releases the upstream connection.
+
+    With raw=True the bytes are relayed still compressed, exactly as the upstream sent them.
+    The ASGI server pulls the next chunk only after the previous one was sent to the client,
+    so a slow client slows down reading from the upstream instead of growing a buffer.
+    If the client disconnects, the generator is closed and the upstream stream is cancelled.
+    """
+    chunks = 0
+    # Решение логировать чанки принимается один раз на стрим, а не на каждый чанк
+    sample_chunks = LOG_STREAM_CHUNK_SAMPLE > 0 and logging.root.isEnabledFor(logging.DEBUG)
+    try:
+        async for chunk in (response.aiter_raw(chunk_size=chunk_size) if raw else response.aiter_bytes(chunk_size=chunk_size)):
+            chunks += 1
+            if sample_chunks and chunks % LOG_STREAM_CHUNK_SAMPLE == 0:
+                logging.debug("Streaming chunk %d: %d bytes", chunks, len(chunk))
+            yield chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        logging.info("Client disconnected, cancelling upstream stream after %d chunks", chunks)
+        raise
+    finally:
+        await response.aclose()
+
+
+class StreamBody:
+    """Async iterator over a relayed stream that can also be closed before it was started.
+
+    Closing an async generator that never ran skips its `finally` blocks, so a stream that
+    is discarded before the first chunk (a losing hedged attempt, a client gone before the
+    response was sent) would keep its upstream connection and key. If the body was never
+    iterated, `aclose()` also awaits `close_unstarted()` to release them.
+    """
+
+    def __init__(self, chunks, close_unstarted):
+        self._chunks = chunks
+        self._close_unstarted = close_unstarted
+        self._started = False
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self._started = True
+        return await self._chunks.__anext__()
+
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        await self._chunks.aclose()
+        if not self._started:
+            await self._close_unstarted()
+
+
+async def finish_stream(chunks, on_done):
+    """Passes stream chunks through and calls `on_done()` once the stream is over, however it ends."""
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+        on_done()
+
+
+def release_after_stream(response, on_done):
+    """Defers `on_done()` until the streamed body of `response` ends, fails or is discarded unread."""
+    chunks = response.response.iter
+
+    async def close_unstarted():
+        await chunks.aclose()
+        on_done()
+
+    response.response = IterableBody(StreamBody(finish_stream(chunks, on_done), close_unstarted))
@@ -3,7 +3,17 @@ import logging
 import sqlite3
 from quart import Quart, request, Response, render_template, jsonify
 from datetime import datetime
-from key_manager import get_db_connection, get_sorted_keys, DATABASE_FILE, toggle_key_removed_status, add_new_key
+from response_cache import RESPONSE_CACHE_ENABLED, response_cache
+from key_manager import get_db_connection, get_sorted_keys, DATABASE_FILE, toggle_key_removed_status, add_new_key, key_scheduler, load_key_rows, load_key_page, flush_key_stats
+from key_config import is_user_key, reload_key_config
+from request_timing import timing_history, to_thread
+from profiler import PROFILE_MODES, ProfilerBusy, profiler
+
+# Сколько ключей показывается на одной странице веб-интерфейса; параметром per_page можно выбрать до ADMIN_KEYS_MAX_PER_PAGE
+ADMIN_KEYS_PER_PAGE = int(os.environ.get('ADMIN_KEYS_PER_PAGE', '100'))
+ADMIN_KEYS_MAX_PER_PAGE = 1000
+# Колонки, которых нет в БД (текущее здоровье ключа): по ним сортируются все строки в памяти
+LIVE_SORT_COLUMNS = ('recent_success_rate', 'ttfb_ratio', 'in_flight', 'cost')
 
 # Assuming 'app' is initialized in main.py and imported here
 # from main import app
@@ -13,16 +23,19 @@ from key_manager import get_db_connection, get_sorted_keys, DATABASE_FILE, toggl
 # If running web_interface.py directly, you would need to initialize Flask here.
 # For now, we'll define the functions and assume they are registered with the app in main.py
 
+def _int_arg(name, default, low, high):
+    try:
+        value = int(request.args.get(name, default))
+    except ValueError:
+        value = default
+    return max(low, min(value, high))
+
 def authenticate(username, password):
     """Basic authentication check against USER_KEYS."""
     # In a real application, use a secure method for username/password.
     # Here, we'll just check if the provided password is one of the USER_KEYS.
-    # Assuming USER_KEYS is accessible, perhaps passed or imported from main.py
-    # For now, let's assume it's imported or passed.
-    # If imported, need to add 'from main import USER_KEYS'
-    # Let's add the import for now, assuming USER_KEYS is in main.py
-    from main import USER_KEYS
-    return password in USER_KEYS
+    # Ключи пользователей читаются при каждой проверке: они меняются при перезагрузке конфигурации
+    return is_user_key(password)
 
 # This route needs to be registered with the Flask app instance.
 # Assuming 'app' is imported or available.
@@ -39,27 +52,37 @@ async def manage_keys():
     sort_by = request.args.get('sort_by', 'added_at')
     sort_order = request.args.get('sort_order', 'asc').lower()
 
-    allowed_sort_columns = ['key', 'added_at', 'successful_requests', 'error_requests', 'errors_since_last_success', 'first_error_at', 'error_counter_started_at', 'removed']
+    allowed_sort_columns = ['key', 'added_at', 'successful_requests', 'error_requests', 'errors_since_last_success', 'first_error_at', 'error_counter_started_at', 'removed', 'recent_success_rate', 'ttfb_ratio', 'in_flight', 'cost', 'quarantined_at', 'quarantine_reason', 'last_probe_at', 'last_probe_status']
     if sort_by not in allowed_sort_columns:
         sort_by = 'added_at' # Default sort
 
     if sort_order not in ['asc', 'desc']:
         sort_order = 'asc' # Default order
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    try:
-        cursor.execute(f"SELECT * FROM api_keys ORDER BY {sort_by} {sort_order}")
-        keys_data = cursor.fetchall()
-    except sqlite3.Error as e:
-        logging.error(f"Error fetching data from database: {e}")
-        keys_data = []
-    finally:
-        conn.close()
+    per_page = _int_arg('per_page', ADMIN_KEYS_PER_PAGE, 1, ADMIN_KEYS_MAX_PER_PAGE)
+    page = _int_arg('page', 1, 1, 10 ** 9)
+    offset = (page - 1) * per_page
+
+    # Счетчики берутся из БД, где они суммируются по всем воркерам (сначала туда пишутся накопленные здесь),
+    # а текущее здоровье и запросы в работе - из планировщика ключей
+    await flush_key_stats()
+    if sort_by in LIVE_SORT_COLUMNS:
+        keys_data = sorted(
+            key_scheduler.get_rows(await to_thread(load_key_rows)),
+            key=lambda row: (row[sort_by] is not None, row[sort_by]), # NULL первыми, как в SQLite
+            reverse=sort_order == 'desc'
+        )
+        total = len(keys_data)
+        keys_data = keys_data[offset:offset + per_page]
+    else:
+        # Сортировка и выборка страницы в БД: здоровье считается только для ключей этой страницы
+        rows, total = await to_thread(load_key_page, sort_by, sort_order == 'desc', per_page, offset)
+        keys_data = key_scheduler.get_rows(rows)
+    pages = max(1, (total + per_page - 1) // per_page)
 
     # Render an HTML template (we'll create this next)
-    return await render_template('keys_table.html', keys=keys_data, sort_by=sort_by, sort_order=sort_order)
+    cache_stats = response_cache.get_stats() if RESPONSE_CACHE_ENABLED else None
+    return await render_template('keys_table.html', keys=keys_data, sort_by=sort_by, sort_order=sort_order, page=page, pages=pages, per_page=per_page, total=total, cache_stats=cache_stats, slow_requests=timing_history.slowest(20))
 
 # This template filter needs to be registered with the Flask app instance.
 # Assuming 'app' is imported or available.
@@ -118,9 +141,72 @@ async def add_key():
     else:
         return jsonify({'success': False, 'message': f'Key {new_key} already exists or failed to add'}), 400
 
+async def reload_keys():
+    """Reloads USER_KEYS, GOOGLE_KEYS and REMOVE_GOOGLE_KEYS without a restart (this worker; others follow via keys.db and KEYS_FILE)."""
+    auth = request.authorization # Removed await
+    if not auth or not authenticate(auth.username, auth.password):
+        return Response(
+            'Could not verify your access level for that URL.\n'
+            'You have to login with proper credentials', 401,
+            {'WWW-Authenticate': 'Basic realm="Login Required"'})
+
+    try:
+        summary = await reload_key_config()
+    except (OSError, sqlite3.Error) as e:
+        return jsonify({'success': False, 'message': f'Failed to reload keys: {e}'}), 500
+    return jsonify({'success': True, **summary})
+
+async def slow_requests():
+    """Returns the slowest recent requests of this worker with their time by phase."""
+    auth = request.authorization # Removed await
+    if not auth or not authenticate(auth.username, auth.password):
+        return Response(
+            'Could not verify your access level for that URL.\n'
+            'You have to login with proper credentials', 401,
+            {'WWW-Authenticate': 'Basic realm="Login Required"'})
+
+    try:
+        limit = int(request.args.get('limit', '50'))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'limit must be an integer'}), 400
+    return jsonify({'requests': timing_history.slowest(limit)})
+
+async def profile_worker():
+    """Profiles this worker for `seconds` or `requests` (query parameters) and returns the text report."""
+    auth = request.authorization # Removed await
+    if not auth or not authenticate(auth.username, auth.password):
+        return Response(
+            'Could not verify your access level for that URL.\n'
+            'You have to login with proper credentials', 401,
+            {'WWW-Authenticate': 'Basic realm="Login Required"'})
+
+    mode = request.args.get('mode', 'sampling')
+    if mode not in PROFILE_MODES:
+        return jsonify({'success': False, 'message': f"mode must be one of {', '.join(PROFILE_MODES)}"}), 400
+    try:
+        seconds = float(request.args['seconds']) if 'seconds' in request.args else None
+        requests = int(request.args['requests']) if 'requests' in request.args else None
+        limit = int(request.args.get('limit', '40'))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'seconds, requests and limit must be numbers'}), 400
+    if seconds is None and requests is None:
+        seconds = 10
+
+    try:
+        report = await profiler.run(mode, seconds=seconds, requests=requests, limit=limit)
+    except ProfilerBusy as e:
+        return jsonify({'success': False, 'message': str(e)}), 409
+    response = Response(report, content_type='text/plain; charset=utf-8')
+    # Профилирование может длиться дольше RESPONSE_TIMEOUT Quart
+    response.timeout = None
+    return response
+
 
 def register_web_interface(app):
     app.add_url_rule('/admin/keys', 'manage_keys', manage_keys, methods=['GET'])
     app.add_url_rule('/toggle_key/<key>/<action>', 'toggle_key', toggle_key, methods=['POST'])
     app.add_url_rule('/add_key', 'add_key', add_key, methods=['POST'])
+    app.add_url_rule('/admin/reload', 'reload_keys', reload_keys, methods=['POST'])
+    app.add_url_rule('/admin/slow_requests', 'slow_requests', slow_requests, methods=['GET'])
+    app.add_url_rule('/admin/profile', 'profile_worker', profile_worker, methods=['POST'])
     app.template_filter('format_timestamp')(format_timestamp_filter)
\ No newline at end of file